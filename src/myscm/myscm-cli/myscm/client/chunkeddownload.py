@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+import collections
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from tempfile import NamedTemporaryFile
+
+from myscm.client.error import ClientError
+from myscm.common.chunklist import ChunkList, ChunkListError
+
+logger = logging.getLogger(__name__)
+
+
+class ChunkedDownloadError(ClientError):
+    pass
+
+
+class ChunkedDownload:
+    """Download of the file in chunks (written in any order, e.g. by many
+       connections at once) into the preallocated `.part` file, which is
+       renamed to the downloaded file's path once all of its chunks are
+       written and verified.
+
+       SHA-256 digests of the written chunks are saved in the `.part.json`
+       state file, so interrupted download is resumed (only chunks missing on
+       disk are downloaded again) as long as the same version of the remote
+       file (identified by `source_id`) is downloaded. Chunks read back from
+       the `.part` file are verified against saved digests before renaming,
+       so chunks whose writing was interrupted (e.g. by power loss) are
+       downloaded again. If digests of the chunks are known in advance (see
+       `ChunkList`), then every chunk is verified before it's written.
+
+       Chunk list of the downloaded file is saved next to it, so the client
+       can share downloaded file with the other peers."""
+
+    PART_EXT = ".part"
+    STATE_EXT = ".part.json"
+    STATE_FORMAT_VERSION = 1
+    CHUNK_SIZE = ChunkList.CHUNK_SIZE
+
+    def __init__(self, path, size, source_id, chunk_size=CHUNK_SIZE,
+                 expected_digests=None):
+        """Constructor initialized by the path of the downloaded file, its
+           size, identifier of its remote version (e.g. its name, size and
+           modification time), size of the chunks and optional list of the
+           expected SHA-256 hex digests of the chunks."""
+
+        self.path = path
+        self.part_path = path + self.PART_EXT
+        self.state_path = path + self.STATE_EXT
+        self.size = size
+        self.source_id = source_id
+        self.chunk_size = chunk_size
+        self.chunks_count = -(-size // chunk_size)
+        self.digests = {}  # index of the written chunk: SHA256 hex digest
+        self.expected_digests = expected_digests
+        self.part_fd = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        """Open (or create) the `.part` file. Return number of the chunks
+           already written by the previous, interrupted download."""
+
+        try:
+            self._open()
+        except OSError as e:
+            m = "Failed to prepare '{}' file for downloading".format(
+                    self.part_path)
+            raise ChunkedDownloadError(m, e) from e
+
+        return len(self.digests)
+
+    def _open(self):
+        state = self._load_state()
+
+        if state and os.path.isfile(self.part_path):
+            self.digests = {int(i): d for i, d in state["digests"].items()}
+            logger.info("Resuming download of '{}' ({} of {} chunks already "
+                        "downloaded).".format(self.path, len(self.digests),
+                                              self.chunks_count))
+        else:
+            self.digests = {}
+            self._save_state()
+
+        self.part_fd = os.open(self.part_path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        try:
+            os.posix_fallocate(self.part_fd, 0, self.size)
+        except (AttributeError, OSError):  # e.g. not supported by filesystem
+            os.ftruncate(self.part_fd, self.size)
+
+    def get_missing_chunks(self):
+        """Return list of (index, offset, length) tuples of the chunks that
+           were not written yet."""
+
+        return [self.get_chunk(i) for i in range(self.chunks_count)
+                if i not in self.digests]
+
+    def get_chunk(self, i):
+        offset = i * self.chunk_size
+        return i, offset, min(self.chunk_size, self.size - offset)
+
+    def write_chunk(self, i, data):
+        """Write downloaded chunk (thread-safe)."""
+
+        _, offset, length = self.get_chunk(i)
+
+        if len(data) != length:
+            m = "Unexpected size of the downloaded chunk #{} of '{}' ({} "\
+                "bytes instead of {})".format(i, self.path, len(data), length)
+            raise ChunkedDownloadError(m)
+
+        digest = hashlib.sha256(data).hexdigest()
+
+        if self.expected_digests and digest != self.expected_digests[i]:
+            m = "SHA-256 checksum mismatch of the downloaded chunk #{} of "\
+                "'{}'".format(i, self.path)
+            raise ChunkedDownloadError(m)
+
+        try:
+            os.pwrite(self.part_fd, data, offset)
+
+            with self.lock:
+                self.digests[i] = digest
+                self._save_state()
+        except OSError as e:
+            m = "Failed to write downloaded chunk to '{}'".format(
+                    self.part_path)
+            raise ChunkedDownloadError(m, e) from e
+
+    def finish(self):
+        """Verify all of the chunks and rename `.part` file to the path of
+           the downloaded file. Corrupted chunks are forgotten (so they are
+           downloaded again by the next download) and ChunkedDownloadError is
+           raised."""
+
+        missing = self.chunks_count - len(self.digests)
+
+        if missing:
+            m = "Download of '{}' is not complete ({} chunk{} missing)"\
+                .format(self.path, missing, "s" if missing > 1 else "")
+            raise ChunkedDownloadError(m)
+
+        try:
+            os.fsync(self.part_fd)
+            corrupted = self._get_corrupted_chunks()
+
+            if corrupted:
+                for i in corrupted:
+                    del self.digests[i]
+
+                self._save_state()
+                n = len(corrupted)
+                m = "{} chunk{} of '{}' {} corrupted and will be downloaded "\
+                    "again".format(n, "s" if n > 1 else "", self.part_path,
+                                   "are" if n > 1 else "is")
+                raise ChunkedDownloadError(m)
+
+            self.close()
+            os.replace(self.part_path, self.path)
+            os.remove(self.state_path)
+        except OSError as e:
+            m = "Failed to finish download of '{}'".format(self.path)
+            raise ChunkedDownloadError(m, e) from e
+
+        self._save_chunk_list()
+
+    def close(self):
+        if self.part_fd is not None:
+            os.close(self.part_fd)
+            self.part_fd = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _get_corrupted_chunks(self):
+        corrupted = []
+
+        for i in range(self.chunks_count):
+            _, offset, length = self.get_chunk(i)
+            data = os.pread(self.part_fd, length, offset)
+
+            if hashlib.sha256(data).hexdigest() != self.digests[i]:
+                corrupted.append(i)
+
+        return corrupted
+
+    def _save_chunk_list(self):
+        digests = [self.digests[i] for i in range(self.chunks_count)]
+        chunk_list = ChunkList(self.size, self.chunk_size, digests)
+
+        try:
+            chunk_list.save(self.path + ChunkList.CHUNK_LIST_EXT)
+        except ChunkListError as e:
+            logger.warning("{} - '{}' can't be downloaded from this client by "
+                           "many peers at once.".format(e, self.path))
+
+    def _load_state(self):
+        """Return state saved by the previous download of the same version
+           of the file or None."""
+
+        try:
+            with open(self.state_path) as state_f:
+                state = json.load(state_f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring malformed state '{}' of the interrupted "
+                           "download ({}).".format(self.state_path, e))
+            return None
+
+        if state.get("format_version") != self.STATE_FORMAT_VERSION or\
+           state.get("source_id") != self.source_id or\
+           state.get("size") != self.size or\
+           state.get("chunk_size") != self.chunk_size:
+            logger.info("Remote file was changed since download of '{}' was "
+                        "interrupted - downloading it from scratch.".format(
+                            self.path))
+            return None
+
+        return state
+
+    def _save_state(self):
+        state = {
+            "format_version": self.STATE_FORMAT_VERSION,
+            "source_id": self.source_id,
+            "size": self.size,
+            "chunk_size": self.chunk_size,
+            "digests": self.digests
+        }
+        state_dir = os.path.dirname(self.state_path) or "."
+
+        with NamedTemporaryFile(mode="w", dir=state_dir, prefix=".",
+                                delete=False) as state_f:
+            try:
+                json.dump(state, state_f)
+            except BaseException:
+                with contextlib.suppress(OSError):
+                    os.remove(state_f.name)
+                raise
+
+        os.replace(state_f.name, self.state_path)
+
+
+class ChunkScheduler:
+    """Thread-safe scheduler of the chunks downloaded concurrently from one or
+       many sources (e.g. peers). Chunks are taken by the workers on demand,
+       so faster sources download more chunks. Once no chunks are left,
+       chunks still downloaded from the other (slower) sources are downloaded
+       again (first downloaded copy is used) and chunks whose download failed
+       are taken over by the remaining workers, so download doesn't wait for
+       the slowest (or failed) source. Download is aborted by `abort()` or
+       by setting optional `abort_event` shared with the other downloads
+       (then workers stop once their current chunks are downloaded)."""
+
+    def __init__(self, chunks, abort_event=None):
+        self.pending = collections.deque(chunks)
+        self.in_progress = {}  # chunk: sources downloading it
+        self.done = set()
+        self.downloaded = collections.Counter()  # source: downloaded bytes
+        self.aborted = False
+        self.abort_event = abort_event
+        self.condition = threading.Condition()
+
+    def get_chunk(self, source=None):
+        """Return (index, offset, length) tuple of the next chunk to download
+           from given source or None if there are no chunks left for it. Wait
+           if the remaining chunks are being downloaded by the other workers
+           of the same source."""
+
+        with self.condition:
+            while not self._is_aborted():
+                chunk = self._get_next_chunk(source)
+
+                if chunk:
+                    self.in_progress.setdefault(chunk, []).append(source)
+                    return chunk
+
+                if not self.in_progress:
+                    return None
+
+                self.condition.wait()
+
+            return None
+
+    def complete(self, chunk, source=None):
+        with self.condition:
+            if chunk not in self.done:
+                self.done.add(chunk)
+                self.downloaded[source] += chunk[2]
+
+            self.in_progress.pop(chunk, None)
+            self.condition.notify_all()
+
+    def release(self, chunk, source=None):
+        """Give back chunk whose download from given source failed."""
+
+        with self.condition:
+            sources = self.in_progress.get(chunk, [])
+
+            if source in sources:
+                sources.remove(source)
+
+            if not sources and chunk not in self.done:
+                self.in_progress.pop(chunk, None)
+                self.pending.appendleft(chunk)
+
+            self.condition.notify_all()
+
+    def abort(self):
+        with self.condition:
+            self.aborted = True
+            self.condition.notify_all()
+
+    def _is_aborted(self):
+        return self.aborted or bool(self.abort_event and
+                                    self.abort_event.is_set())
+
+    def _get_next_chunk(self, source):
+        if self.pending:
+            return self.pending.popleft()
+
+        # Chunk downloaded by the least number of the other sources
+
+        chunks = [c for c, sources in self.in_progress.items()
+                  if source not in sources]
+
+        return min(chunks, key=lambda c: len(self.in_progress[c]),
+                   default=None)
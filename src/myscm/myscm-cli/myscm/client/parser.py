@@ -118,9 +118,10 @@ class UpgradeSysImgConfigOption(ValidatedCommandLineConfigOption):
             "UpgradeSysImg", None, self._assert_sys_img_version_valid,
             "--upgrade", metavar="SYS_IMG_VER", nargs="?", const=True,
             type=self._assert_sys_img_version_valid,
-            help="equivalent of running --update and --apply-img SYS_IMG_VER "
-                 "option; if SYS_IMG_VER is not given, then downloaded mySCM "
-                 "will be applied")
+            help="download and apply chain of the mySCM system images "
+                 "(cheapest in terms of downloaded bytes) leading to the "
+                 "SYS_IMG_VER version; if SYS_IMG_VER is not given, then "
+                 "system is upgraded to the newest available version")
 
     def _assert_sys_img_version_valid(self, sys_img_ver):
         return myscm.common.parser.assert_sys_img_ver_valid(sys_img_ver)
@@ -371,6 +372,146 @@ class SysImgExtractDirConfigOption(ValidatedFileConfigOption):
         return sys_img_extract_dir
 
 
+class ApplyModeConfigOption(GeneralChoiceConfigOption):
+    """Configuration option read from file and/or CLI specifying how files
+       from the mySCM system image are applied with --apply-img option."""
+
+    STREAM_APPLY_MODE = "stream"
+    EXTRACT_APPLY_MODE = "extract"
+    APPLY_MODES = [STREAM_APPLY_MODE, EXTRACT_APPLY_MODE]
+    DEFAULT_APPLY_MODE = STREAM_APPLY_MODE
+
+    def __init__(self, apply_mode=None):
+        super().__init__(
+            "ApplyMode", apply_mode or self.DEFAULT_APPLY_MODE,
+            self.APPLY_MODES, False, "--apply-mode", metavar="MODE",
+            help="method of applying system image with --apply-img option; "
+                 "'{}' writes files read in a single pass over the system "
+                 "image directly to their destinations, '{}' extracts whole "
+                 "system image to the SysImgExtractDir directory first "
+                 "(default value: '{}')".format(
+                    self.STREAM_APPLY_MODE, self.EXTRACT_APPLY_MODE,
+                    self.DEFAULT_APPLY_MODE))
+
+
+class DownloadChannelsConfigOption(GeneralConfigOption):
+    """Configuration option read from file and/or CLI specifying number of
+       the concurrent SFTP channels (sharing single SSH connection) used to
+       download chunks of the mySCM system image."""
+
+    DEFAULT_DOWNLOAD_CHANNELS = 4
+    MIN_DOWNLOAD_CHANNELS = 1
+
+    def __init__(self, channels=None):
+        super().__init__(
+            "DownloadChannels",
+            channels or self.DEFAULT_DOWNLOAD_CHANNELS,
+            self._assert_channels_valid, False,
+            "--download-channels", metavar="N",
+            type=self._assert_channels_valid,
+            help="number of the concurrent SFTP channels used to download "
+                 "chunks of the system image with --update and --upgrade "
+                 "options (default value: {})".format(
+                    self.DEFAULT_DOWNLOAD_CHANNELS))
+
+    def _assert_channels_valid(self, channels_string):
+        channels = None
+
+        try:
+            channels = int(channels_string)
+        except ValueError:
+            m = "Given number of the download channels is not integer (given "\
+                "value: '{}')".format(channels_string)
+            raise ClientParserError(m)
+
+        if channels < self.MIN_DOWNLOAD_CHANNELS:
+            m = "Number of the download channels must be an integer not "\
+                "lower than {} (given value: {})".format(
+                    self.MIN_DOWNLOAD_CHANNELS, channels)
+            raise ClientParserError(m)
+
+        return channels
+
+
+class SwarmPeersConfigOption(GeneralConfigOption):
+    """Configuration option read from file and/or CLI specifying maximum
+       number of the peers the mySCM system image is downloaded from at
+       once."""
+
+    DEFAULT_SWARM_PEERS = 1
+    MIN_SWARM_PEERS = 1
+
+    def __init__(self, swarm_peers=None):
+        super().__init__(
+            "SwarmPeers",
+            swarm_peers or self.DEFAULT_SWARM_PEERS,
+            self._assert_swarm_peers_valid, False,
+            "--swarm-peers", metavar="N",
+            type=self._assert_swarm_peers_valid,
+            help="maximum number of the peers from PeersList the system "
+                 "image is downloaded from at once with --update and "
+                 "--upgrade options if no HOST was given; 1 disables "
+                 "downloading from many peers (default value: {})".format(
+                    self.DEFAULT_SWARM_PEERS))
+
+    def _assert_swarm_peers_valid(self, swarm_peers_string):
+        swarm_peers = None
+
+        try:
+            swarm_peers = int(swarm_peers_string)
+        except ValueError:
+            m = "Given number of the swarm peers is not integer (given "\
+                "value: '{}')".format(swarm_peers_string)
+            raise ClientParserError(m)
+
+        if swarm_peers < self.MIN_SWARM_PEERS:
+            m = "Number of the swarm peers must be an integer not lower "\
+                "than {} (given value: {})".format(self.MIN_SWARM_PEERS,
+                                                   swarm_peers)
+            raise ClientParserError(m)
+
+        return swarm_peers
+
+
+class DiscoveryTimeoutConfigOption(GeneralConfigOption):
+    """Configuration option read from file and/or CLI specifying time limit
+       of searching for the peers holding applicable mySCM system image."""
+
+    DEFAULT_DISCOVERY_TIMEOUT = 10
+    MIN_DISCOVERY_TIMEOUT = 1
+
+    def __init__(self, timeout=None):
+        super().__init__(
+            "DiscoveryTimeout",
+            timeout or self.DEFAULT_DISCOVERY_TIMEOUT,
+            self._assert_timeout_valid, False,
+            "--discovery-timeout", metavar="SECONDS",
+            type=self._assert_timeout_valid,
+            help="time limit of probing all of the peers from PeersList "
+                 "for the newest applicable system image with --update and "
+                 "--upgrade options if no HOST was given; peers which don't "
+                 "respond in time are skipped (default value: {})".format(
+                    self.DEFAULT_DISCOVERY_TIMEOUT))
+
+    def _assert_timeout_valid(self, timeout_string):
+        timeout = None
+
+        try:
+            timeout = int(timeout_string)
+        except ValueError:
+            m = "Given discovery timeout is not integer (given value: '{}')"\
+                .format(timeout_string)
+            raise ClientParserError(m)
+
+        if timeout < self.MIN_DISCOVERY_TIMEOUT:
+            m = "Discovery timeout must be an integer not lower than {} "\
+                "(given value: {})".format(self.MIN_DISCOVERY_TIMEOUT,
+                                           timeout)
+            raise ClientParserError(m)
+
+        return timeout
+
+
 class SysImgDownloadDirConfigOption(ValidatedFileConfigOption):
 
     DEFAULT_SYS_IMG_DOWNLOAD_DIR = "/var/lib/myscm-cli/downloaded"
@@ -472,7 +613,11 @@ class ClientConfigParser(ConfigParser):
             ForceApplyConfigOption(),
             ListSysImgConfigOption(),
             SysImgExtractDirConfigOption(),
+            ApplyModeConfigOption(),
             SysImgDownloadDirConfigOption(),
+            DownloadChannelsConfigOption(),
+            SwarmPeersConfigOption(),
+            DiscoveryTimeoutConfigOption(),
             RecentlyAppliedSysImgVerPathConfigOption(),
             DryRunConfigOption(),
             PrintSysImgVerConfigOption()
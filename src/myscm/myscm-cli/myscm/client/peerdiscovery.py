@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import threading
+
+from myscm.client.error import ClientError
+
+logger = logging.getLogger(__name__)
+
+
+class Peer(collections.namedtuple("Peer", [
+        "host_details", "img_name", "target_id", "img_size", "latency",
+        "throughput"])):
+    """Peer holding applicable system image together with its measured
+       latency (in seconds) and throughput (in B/s)."""
+
+    def get_estimated_download_time(self):
+        return self.latency + self.img_size / self.throughput
+
+
+class PeerDiscovery:
+    """Discovery of the peers holding applicable system images. All of the
+       peers are probed concurrently within the time limit, so unreachable
+       peers cost at most the time limit instead of the connection timeout
+       each. Latency is measured by asynchronous connection receiving SSH
+       banner of the peer (unreachable peers are filtered out at this stage)
+       and then newest applicable system image of the peer and throughput of
+       reading its first bytes are found by the downloader's `probe()` method
+       run in the daemon thread (SFTP client is blocking), so probes still
+       running after the time limit don't delay exit of the interpreter."""
+
+    SAMPLE_SIZE = 256 * 1024
+
+    def __init__(self, downloader, timeout):
+        """Constructor initialized by the downloader of the system images and
+           time limit of the discovery in seconds."""
+
+        self.downloader = downloader
+        self.timeout = timeout
+
+    def discover(self, hosts_details):
+        """Return list of the `Peer`s holding applicable system images. Peers
+           holding the newest system image come first and peers holding the
+           same system image are ordered by the estimated download time."""
+
+        peers = asyncio.run(self._discover(hosts_details))
+        peers.sort(key=lambda p: (-p.target_id,
+                                  p.get_estimated_download_time()))
+
+        for peer in peers:
+            logger.debug("Peer '{}' holds '{}' system image (latency: {:.0f} "
+                         "ms, throughput: {:.1f} MiB/s).".format(
+                             peer.host_details["host"], peer.img_name,
+                             peer.latency * 1000,
+                             peer.throughput / (1024 * 1024)))
+
+        return peers
+
+    async def _discover(self, hosts_details):
+        if not hosts_details:
+            return []
+
+        tasks = [asyncio.ensure_future(self._probe(h)) for h in hosts_details]
+        done, pending = await asyncio.wait(tasks, timeout=self.timeout)
+
+        for task in pending:
+            task.cancel()
+
+        if pending:
+            n = len(pending)
+            logger.warning("{} peer{} didn't respond within {}s - skipping "
+                           "{}.".format(n, "s" if n > 1 else "", self.timeout,
+                                        "them" if n > 1 else "it"))
+
+        return [t.result() for t in done if t.result()]
+
+    async def _probe(self, host_details):
+        """Return `Peer` or None if peer is unreachable or it has no
+           applicable system image."""
+
+        from myscm.client.sysimgupdater import SysImgDownloaderNoImageFoundError
+
+        loop = asyncio.get_running_loop()
+        host = host_details["host"]
+        start = loop.time()
+
+        try:
+            reader, writer = await asyncio.open_connection(
+                host, host_details["port"])
+
+            try:
+                await reader.readline()  # SSH banner
+            finally:
+                writer.close()
+        except OSError as e:
+            logger.info("Peer '{}' is unreachable ({}).".format(host, e))
+            return None
+
+        latency = loop.time() - start
+
+        try:
+            img_name, target_id, img_size, throughput =\
+                await self._run_in_daemon_thread(self.downloader.probe,
+                                                 host_details, self.SAMPLE_SIZE)
+        except SysImgDownloaderNoImageFoundError as e:
+            logger.info("{} (peer: '{}')".format(e, host))
+            return None
+        except ClientError as e:
+            logger.warning("{}.".format(e))
+            return None
+
+        if not img_size or not throughput:  # e.g. half-uploaded system image
+            logger.warning("Peer '{}' skipped (its '{}' system image is "
+                           "empty).".format(host, img_name))
+            return None
+
+        return Peer(host_details, img_name, target_id, img_size, latency,
+                    throughput)
+
+    def _run_in_daemon_thread(self, fun, *args):
+        """Return asyncio future of the blocking function run in the daemon
+           thread. Unlike threads of the `ThreadPoolExecutor` (which are
+           joined at exit), daemon thread is abandoned once discovery is
+           finished."""
+
+        future = concurrent.futures.Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+
+            try:
+                future.set_result(fun(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, daemon=True).start()
+
+        return asyncio.wrap_future(future)
@@ -1,12 +1,22 @@
 # -*- coding: utf-8 -*-
+import concurrent.futures
+import contextlib
+import hashlib
 import logging
 import os
 import paramiko
 import pysftp
 import re
+import time
 
+from myscm.client.chunkeddownload import ChunkedDownload
+from myscm.client.chunkeddownload import ChunkedDownloadError
+from myscm.client.chunkeddownload import ChunkScheduler
 from myscm.client.error import ClientError
+from myscm.common.chunklist import ChunkList
 from myscm.common.signaturemanager import SignatureManager
+from myscm.common.signaturemanager import SignatureManagerError
+from myscm.common.sysimgcatalog import SysImgCatalog, SysImgCatalogError
 from myscm.server.sysimggenerator import SystemImageGenerator
 
 logger = logging.getLogger(__name__)
@@ -17,20 +27,84 @@ class SFTPSysImgDownloaderError(ClientError):
 
 
 class SFTPSysImgDownloader:
-    """SFTP system image downloader."""
-
-    def __init__(self, client_config):
+    """SFTP system image downloader. System image is downloaded in chunks by
+       many concurrent SFTP channels opened on the same SSH connection (single
+       channel rarely fills the high latency link), and resumed from the chunks
+       already downloaded by the interrupted download (see
+       `ChunkedDownload`). Applicable system image is found in the catalog
+       published by the peer (see `SysImgCatalog`) if there is any. Setting
+       optional `abort_event` aborts downloads in progress (see
+       `ChunkScheduler`)."""
+
+    CATALOGS_DIR_NAME = ".catalogs"
+
+    def __init__(self, client_config, abort_event=None):
         super().__init__()
         self.client_config = client_config
+        self.abort_event = abort_event
+
+    def download(self, host_details, img_name=None):
+        """Download given system image (newest applicable one by default)."""
+
+        return self._sftp_download_myscm_img(host_details, img_name)
 
-    def download(self, host_details):
-        return self._sftp_download_myscm_img(host_details)
+    def list_imgs(self, host_details):
+        """Return list of the (name, size) pairs of all of the system images
+           published by the peer."""
+
+        regex = re.compile(SystemImageGenerator.MYSCM_IMG_FILE_NAME_REGEX)
+
+        try:
+            with self._sftp_connect(host_details) as sftp:
+                sftp.chdir(host_details["remote_dir"])
+                catalog = self._sftp_get_catalog(sftp, host_details)
+
+                if catalog:
+                    return [(e["name"], e["size"]) for e in catalog.images]
+
+                return [(a.filename, a.st_size) for a in sftp.listdir_attr()
+                        if regex.fullmatch(a.filename)]
+        except (paramiko.ssh_exception.SSHException, OSError, EOFError) as e:
+            m = "Failed to list system images of SFTP peer '{}'".format(
+                    host_details["host"])
+            raise SFTPSysImgDownloaderError(m, e) from e
+
+    def probe(self, host_details, sample_size):
+        """Return (name, target version, size, throughput in B/s) tuple of
+           the newest applicable system image of the peer. Throughput is
+           measured by reading up to `sample_size` first bytes of the system
+           image."""
+
+        try:
+            with self._sftp_connect(host_details) as sftp:
+                sftp.chdir(host_details["remote_dir"])
+                catalog = self._sftp_get_catalog(sftp, host_details)
+                img_name = self._get_newest_myscm_sys_img_fname(sftp, catalog)
+                target_id = int(re.fullmatch(
+                    SystemImageGenerator.MYSCM_IMG_FILE_NAME_REGEX,
+                    img_name).group(2))
+                img_size, _ = self._sftp_get_img_size_and_id(sftp, img_name,
+                                                             catalog)
+                start = time.monotonic()
+
+                with sftp.open(img_name, "rb") as remote_f:
+                    sample = remote_f.readv([(0, min(sample_size,
+                                                     img_size))])
+                    sample_size = sum(len(data) for data in sample)
+
+                seconds = max(time.monotonic() - start, 1e-6)
+        except (paramiko.ssh_exception.SSHException, OSError, EOFError) as e:
+            m = "Failed to probe SFTP peer '{}'".format(host_details["host"])
+            raise SFTPSysImgDownloaderError(m, e) from e
 
-    def _sftp_download_myscm_img(self, host_details):
+        return img_name, target_id, img_size, sample_size / seconds
+
+    def _sftp_download_myscm_img(self, host_details, img_name=None):
         img_local_path = None
 
         try:
-            img_local_path = self.__sftp_download_myscm_img(host_details)
+            img_local_path = self.__sftp_download_myscm_img(host_details,
+                                                            img_name)
         except (paramiko.ssh_exception.AuthenticationException,
                 FileNotFoundError) as e:
             m = "Connection to SFTP peer failed"
@@ -41,18 +115,48 @@ class SFTPSysImgDownloader:
                 "connect to the server, check if password provided in "\
                 "configuration file is correct".format(host_details["host"])
             raise SFTPSysImgDownloaderError(m, e) from e
+        except (ChunkedDownloadError, OSError, EOFError) as e:
+            m = "Failed to download mySCM system image from '{}'".format(
+                    host_details["host"])
+            raise SFTPSysImgDownloaderError(m, e) from e
 
         return img_local_path
 
-    def __sftp_download_myscm_img(self, host_details):
+    def __sftp_download_myscm_img(self, host_details, img_name=None):
         protocol = host_details["protocol"]
+        host = host_details["host"]
+        port = host_details["port"]
+        remote_dir = host_details["remote_dir"]
+        download_dir = self.client_config.options.sys_img_download_dir
+
+        logger.info("Downloading mySCM system image from {} (port: {}) "
+                    "using {} protocol.".format(host, port, protocol))
+
+        with self._sftp_connect(host_details) as sftp:
+            with sftp.cd(remote_dir):
+                catalog = self._sftp_get_catalog(sftp, host_details)
+                img_local_path = self._sftp_get_myscm_img(sftp, download_dir,
+                                                          catalog, img_name)
+                signature_img_path = self._sftp_get_myscm_img_signature(
+                                            sftp, download_dir, img_local_path,
+                                            catalog)
+
+        logger.info("mySCM system image successfully downloaded{} from '{}' "
+                    "(port: {}, remote file: '{}') and saved in '{}'."
+                    .format(" with signature" if signature_img_path else "",
+                            host, port,
+                            os.path.join(remote_dir, img_local_path),
+                            img_local_path))
+
+        return img_local_path
+
+    def _sftp_connect(self, host_details):
         host = host_details["host"]
         port = host_details["port"]
         username = host_details["username"]
         password = host_details["password"]
         private_key = host_details["private_key"]
         private_key_pass = host_details["private_key_pass"]
-        remote_dir = host_details["remote_dir"]
 
         conn_details = {
             "host": host,
@@ -62,10 +166,6 @@ class SFTPSysImgDownloader:
             "private_key": private_key,
             "private_key_pass": private_key_pass,
         }
-        download_dir = self.client_config.options.sys_img_download_dir
-
-        logger.info("Downloading mySCM system image from {} (port: {}) "
-                    "using {} protocol.".format(host, port, protocol))
 
         if private_key:  # prefer public key authentication over password
             del conn_details["password"]
@@ -79,41 +179,231 @@ class SFTPSysImgDownloader:
 
         _tmp_del = pysftp.Connection.__del__
         pysftp.Connection.__del__ = lambda x: None  # in case of failure
-        img_local_path = None
 
-        with pysftp.Connection(**conn_details) as sftp:
-            # Revert hotfix is success
-            pysftp.Connection.__del__ = _tmp_del
-            sftp.__del__ = _tmp_del
+        sftp = pysftp.Connection(**conn_details)
 
-            with sftp.cd(remote_dir):
-                img_local_path = self._sftp_get_myscm_img(sftp, download_dir)
-                signature_img_path = self._sftp_get_myscm_img_signature(
-                                            sftp, download_dir, img_local_path)
+        # Revert hotfix is success
+        pysftp.Connection.__del__ = _tmp_del
+        sftp.__del__ = _tmp_del
 
-        logger.info("mySCM system image successfully downloaded{} from '{}' "
-                    "(port: {}, remote file: '{}') and saved in '{}'."
-                    .format(" with signature" if signature_img_path else "",
-                            host, port,
-                            os.path.join(remote_dir, img_local_path),
-                            img_local_path))
+        return sftp
 
-        return img_local_path
+    def _sftp_get_catalog(self, sftp_conn, host_details):
+        """Return catalog of the system images published by the peer or None
+           if there is no (valid) catalog. Catalog is cached and fetched again
+           only if its size or modification time changed. Catalog with
+           invalid signature is ignored. Catalog with valid signature is
+           marked as signed, so downloaded system images are checked against
+           its SHA-256 digests (see `_assert_img_digest_valid()`). Not signed
+           catalog (e.g. published by the other client or stripped of its
+           signature) only tells which system images the peer holds - it
+           doesn't make them trusted."""
+
+        catalog_name = SysImgCatalog.CATALOG_FILE_NAME
+        catalog_sig_name = catalog_name + SignatureManager.SIGNATURE_EXT
+        host = host_details["host"]
+
+        try:
+            remote_stat = sftp_conn.stat(catalog_name)
+        except FileNotFoundError:
+            logger.debug("Peer '{}' doesn't publish catalog of the system "
+                         "images.".format(host))
+            return None
+
+        cache_path = self._get_cached_catalog_path(host_details)
+        cache_sig_path = cache_path + SignatureManager.SIGNATURE_EXT
+
+        try:
+            cache_stat = os.stat(cache_path)
+            cached = cache_stat.st_size == remote_stat.st_size and\
+                int(cache_stat.st_mtime) == int(remote_stat.st_mtime)
+        except FileNotFoundError:
+            cached = False
+
+        try:
+            if cached:
+                logger.debug("Catalog of the system images published by '{}' "
+                             "didn't change - using its cached copy.".format(
+                                 host))
+            else:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+                if os.path.exists(cache_sig_path):
+                    os.remove(cache_sig_path)
+
+                sftp_conn.get(catalog_name, localpath=cache_path)
+
+                if sftp_conn.exists(catalog_sig_name):
+                    sftp_conn.get(catalog_sig_name, localpath=cache_sig_path)
+
+                os.utime(cache_path, (remote_stat.st_atime,
+                                      remote_stat.st_mtime))
+
+            with open(cache_path, "rb") as catalog_f:
+                catalog = SysImgCatalog.loads(catalog_f.read())
+
+            if os.path.exists(cache_sig_path):
+                if not SignatureManager().ssl_verify(
+                        cache_path, cache_sig_path,
+                        self.client_config.options.SSL_cert_public_key_path):
+                    logger.warning("Signature of the catalog of the system "
+                                   "images published by '{}' is invalid - "
+                                   "ignoring catalog.".format(host))
+                    return None
+
+                catalog.signed = True
+            else:
+                logger.debug("Catalog of the system images published by '{}' "
+                             "is not signed.".format(host))
+        except (SysImgCatalogError, SignatureManagerError, OSError) as e:
+            logger.warning("Ignoring catalog of the system images published "
+                           "by '{}' ({}).".format(host, e))
+            return None
+
+        return catalog
+
+    def _get_cached_catalog_path(self, host_details):
+        download_dir = self.client_config.options.sys_img_download_dir
+        remote_dir_hash = hashlib.sha1(
+            host_details["remote_dir"].encode()).hexdigest()[:8]
+        fname = "{}-{}-{}.json".format(host_details["host"],
+                                       host_details["port"], remote_dir_hash)
+
+        return os.path.join(download_dir, self.CATALOGS_DIR_NAME, fname)
+
+    def _sftp_get_img_size_and_id(self, sftp_conn, img_name, catalog=None):
+        """Return size of the peer's system image and identifier of its
+           version (see `ChunkedDownload`)."""
+
+        entry = catalog.get_img(img_name) if catalog else None
+
+        if entry:
+            return entry["size"], entry["sha256"]
+
+        img_stat = sftp_conn.stat(img_name)
+        source_id = "{}:{}:{}".format(img_name, img_stat.st_size,
+                                      img_stat.st_mtime)
 
-    def _sftp_get_myscm_img(self, sftp_conn, download_dir):
-        img_name = self._get_newest_myscm_sys_img_fname(sftp_conn)
+        return img_stat.st_size, source_id
+
+    def _sftp_get_myscm_img(self, sftp_conn, download_dir, catalog=None,
+                            img_name=None):
+        img_name = img_name or self._get_newest_myscm_sys_img_fname(sftp_conn,
+                                                                    catalog)
         img_local_path = os.path.join(download_dir, img_name)
-        sftp_conn.get(img_name, localpath=img_local_path)
+        img_size, source_id = self._sftp_get_img_size_and_id(
+            sftp_conn, img_name, catalog)
+
+        with ChunkedDownload(img_local_path, img_size,
+                             source_id) as download:
+            chunks = download.get_missing_chunks()
+
+            if chunks:
+                self._sftp_get_chunks(sftp_conn, sftp_conn.normalize(img_name),
+                                      download, chunks)
+
+            download.finish()
+
+        self._assert_img_digest_valid(img_local_path, [catalog])
 
         return img_local_path
 
-    def _sftp_get_myscm_img_signature(self, sftp_conn, download_dir, img_path):
+    def _assert_img_digest_valid(self, img_path, catalogs):
+        """Check downloaded system image against its SHA-256 digests listed
+           in the signed catalogs and remove it (together with its chunk
+           list) if it doesn't match. System image not listed in any signed
+           catalog is not checked."""
+
+        img_name = os.path.basename(img_path)
+        entries = [c.get_img(img_name) for c in catalogs if c and c.signed]
+        digests = {e["sha256"] for e in entries if e}
+
+        if not digests:
+            return
+
+        try:
+            digest = SysImgCatalog.get_sha256(img_path)
+        except OSError as e:
+            m = "Failed to compute SHA-256 digest of the downloaded mySCM "\
+                "system image '{}'".format(img_path)
+            raise SFTPSysImgDownloaderError(m, e) from e
+
+        if digests != {digest}:
+            for path in [img_path, img_path + ChunkList.CHUNK_LIST_EXT]:
+                with contextlib.suppress(OSError):
+                    os.remove(path)
+
+            m = "Downloaded mySCM system image '{}' doesn't match SHA-256 "\
+                "digest listed in the signed catalog of the system images "\
+                "(removed it)".format(img_path)
+            raise SFTPSysImgDownloaderError(m)
+
+        logger.debug("Downloaded mySCM system image '{}' matches SHA-256 "
+                     "digest listed in the signed catalog.".format(img_path))
+
+    def _sftp_get_chunks(self, sftp_conn, remote_path, download, chunks):
+        transport = sftp_conn.sftp_client.get_channel().get_transport()
+        channels = min(self.client_config.options.download_channels,
+                       len(chunks))
+        scheduler = ChunkScheduler(chunks, self.abort_event)
+
+        logger.debug("Downloading {} chunk{} of '{}' using {} SFTP channel{}."
+                     .format(len(chunks), "s" if len(chunks) > 1 else "",
+                             remote_path, channels,
+                             "s" if channels > 1 else ""))
+
+        with concurrent.futures.ThreadPoolExecutor(channels) as executor:
+            futures = [executor.submit(self._sftp_get_chunks_on_channel,
+                                       transport, remote_path, download,
+                                       scheduler)
+                       for _ in range(channels)]
+
+        for future in futures:
+            future.result()  # reraises exception of the failed channel
+
+    @staticmethod
+    def _sftp_get_chunks_on_channel(transport, remote_path, download,
+                                    scheduler, source=None,
+                                    abort_on_error=True):
+        """Download chunks taken from the scheduler for the given source
+           using new SFTP channel until there are no chunks left. Failure
+           aborts download on all of the other channels unless
+           `abort_on_error` is False (then chunk is taken over by them)."""
+
+        try:
+            with paramiko.SFTPClient.from_transport(transport) as sftp_client,\
+                 sftp_client.open(remote_path, "rb") as remote_f:
+                while True:
+                    chunk = scheduler.get_chunk(source)
+
+                    if chunk is None:
+                        break
+
+                    i, offset, length = chunk
+
+                    try:
+                        # readv() pipelines read requests of the whole chunk
+                        data = b"".join(remote_f.readv([(offset, length)]))
+                        download.write_chunk(i, data)
+                    except BaseException:
+                        scheduler.release(chunk, source)
+                        raise
+
+                    scheduler.complete(chunk, source)
+        except BaseException:
+            if abort_on_error:
+                scheduler.abort()
+            raise
+
+    def _sftp_get_myscm_img_signature(self, sftp_conn, download_dir, img_path,
+                                      catalog=None):
         img_name = os.path.basename(img_path)
         img_sign_name = img_name + SignatureManager.SIGNATURE_EXT
         img_sign_local_path = os.path.join(download_dir, img_sign_name)
         signature_downloaded = False
+        entry = catalog.get_img(img_name) if catalog else None
 
-        if sftp_conn.exists(img_sign_name):
+        if entry["signature"] if entry else sftp_conn.exists(img_sign_name):
             sftp_conn.get(img_sign_name, localpath=img_sign_local_path)
             signature_downloaded = True
         else:
@@ -122,8 +412,21 @@ class SFTPSysImgDownloader:
 
         return img_sign_local_path if signature_downloaded else None
 
-    def _get_newest_myscm_sys_img_fname(self, sftp_conn):
+    def _get_newest_myscm_sys_img_fname(self, sftp_conn, catalog=None):
         current_id = self.client_config.img_ver_file.get_version(create=False)
+
+        if catalog:
+            entry = catalog.get_newest_img(current_id)
+
+            if entry:
+                return entry["name"]
+
+            m = "No mySCM system images matching current system ID (which is "\
+                "{}) found in the catalog of the connected peer.".format(
+                    current_id)
+            from myscm.client.sysimgupdater import SysImgDownloaderNoImageFoundError
+            raise SysImgDownloaderNoImageFoundError(m)
+
         regex_str = SystemImageGenerator.MYSCM_IMG_FILE_NAME.format(current_id,
                                                                     r"(\d+)")
         regex = re.compile(regex_str)
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+import collections
+import concurrent.futures
+import contextlib
+import logging
+import os
+import paramiko
+import re
+
+from myscm.client.chunkeddownload import ChunkedDownload
+from myscm.client.chunkeddownload import ChunkedDownloadError
+from myscm.client.chunkeddownload import ChunkScheduler
+from myscm.client.sftpdownloader import SFTPSysImgDownloader
+from myscm.client.sftpdownloader import SFTPSysImgDownloaderError
+from myscm.common.chunklist import ChunkList, ChunkListError
+from myscm.server.sysimggenerator import SystemImageGenerator
+
+logger = logging.getLogger(__name__)
+
+_Seed = collections.namedtuple("_Seed", ["host", "sftp", "img_name",
+                                         "target_id", "chunk_list",
+                                         "catalog"])
+
+
+class SFTPSwarmSysImgDownloaderError(SFTPSysImgDownloaderError):
+    pass
+
+
+class SFTPSwarmSysImgDownloader(SFTPSysImgDownloader):
+    """SFTP downloader of the system image from many peers at once. Peers
+       holding the newest applicable system image together with its chunk
+       list (see `ChunkList`) are the seeds of the swarm. Every seed downloads
+       chunks of the system image on its own SFTP channels taking them on
+       demand from the shared `ChunkScheduler`, so faster seeds download more
+       chunks and chunks of the slow or failed seeds are taken over by the
+       other ones. Every chunk is verified against the chunk list before it's
+       written."""
+
+    def download_from_swarm(self, hosts_details, img_name=None):
+        """Download given system image (newest applicable one by default)
+           from up to `SwarmPeers` of the given peers. Return its local path
+           or None if none of the peers publishes chunk list of the system
+           image."""
+
+        try:
+            with contextlib.ExitStack() as stack:
+                seeds = self._find_seeds(hosts_details, stack, img_name)
+
+                if not seeds:
+                    return None
+
+                return self._swarm_download(seeds)
+        except (ChunkedDownloadError, OSError, EOFError) as e:
+            m = "Failed to download mySCM system image from the swarm of "\
+                "the peers"
+            raise SFTPSwarmSysImgDownloaderError(m, e) from e
+
+    def _find_seeds(self, hosts_details, stack, img_name=None):
+        """Return seeds holding the same newest applicable system image. SFTP
+           connections to the seeds are closed by the given exit stack."""
+
+        seeds = []
+
+        for host_details in hosts_details:
+            seed = self._get_seed(host_details, img_name)
+
+            if seed:
+                stack.enter_context(seed.sftp)
+                seeds.append(seed)
+
+        if not seeds:
+            logger.info("None of the {} peer{} publishes chunk list of the "
+                        "applicable mySCM system image.".format(
+                            len(hosts_details),
+                            "s" if len(hosts_details) > 1 else ""))
+            return []
+
+        # Seeds of the newest system image publishing the same chunk list
+
+        target_id = max(s.target_id for s in seeds)
+
+        for seed in seeds:
+            if seed.target_id != target_id:
+                seed.sftp.close()
+
+        seeds = [s for s in seeds if s.target_id == target_id]
+        ids = collections.Counter(s.chunk_list.get_id() for s in seeds)
+        chunk_list_id = ids.most_common(1)[0][0]
+
+        for seed in seeds:
+            if seed.chunk_list.get_id() != chunk_list_id:
+                seed.sftp.close()
+
+        seeds = [s for s in seeds if s.chunk_list.get_id() == chunk_list_id]
+        swarm_peers = self.client_config.options.swarm_peers
+
+        for seed in seeds[swarm_peers:]:
+            seed.sftp.close()
+
+        return seeds[:swarm_peers]
+
+    def _get_seed(self, host_details, img_name=None):
+        """Return `_Seed` of the peer or None if it can't be used as a seed
+           (e.g. it's unreachable or it has no chunk list)."""
+
+        from myscm.client.sysimgupdater import SysImgDownloaderNoImageFoundError
+
+        host = host_details["host"]
+        sftp = None
+
+        try:
+            sftp = self._sftp_connect(host_details)
+            sftp.chdir(host_details["remote_dir"])
+            catalog = self._sftp_get_catalog(sftp, host_details)
+            img_name = img_name or self._get_newest_myscm_sys_img_fname(
+                sftp, catalog)
+            target_id = int(re.fullmatch(
+                SystemImageGenerator.MYSCM_IMG_FILE_NAME_REGEX,
+                img_name).group(2))
+            entry = catalog.get_img(img_name) if catalog else None
+
+            if entry and not entry["chunk_list"]:
+                raise FileNotFoundError(img_name + ChunkList.CHUNK_LIST_EXT)
+
+            with sftp.open(img_name + ChunkList.CHUNK_LIST_EXT, "rb") as f:
+                chunk_list = ChunkList.loads(f.read())
+
+            img_size, _ = self._sftp_get_img_size_and_id(sftp, img_name,
+                                                         catalog)
+
+            if img_size != chunk_list.size:
+                raise ChunkListError("Chunk list doesn't match system image")
+        except FileNotFoundError:
+            logger.info("Peer '{}' doesn't publish chunk list of the mySCM "
+                        "system image.".format(host))
+        except SysImgDownloaderNoImageFoundError as e:
+            logger.info("{} (peer: '{}')".format(e, host))
+        except (paramiko.ssh_exception.SSHException, ChunkListError, OSError,
+                EOFError) as e:
+            logger.warning("Peer '{}' skipped ({}).".format(host, e))
+        else:
+            logger.debug("Peer '{}' holds '{}' system image.".format(
+                         host, img_name))
+            return _Seed(host, sftp, img_name, target_id, chunk_list, catalog)
+
+        if sftp:
+            sftp.close()
+
+        return None
+
+    def _swarm_download(self, seeds):
+        img_name = seeds[0].img_name
+        chunk_list = seeds[0].chunk_list
+        download_dir = self.client_config.options.sys_img_download_dir
+        img_local_path = os.path.join(download_dir, img_name)
+
+        logger.info("Downloading mySCM system image '{}' from {} peer{} at "
+                    "once ('{}').".format(
+                        img_name, len(seeds), "s" if len(seeds) > 1 else "",
+                        "', '".join(s.host for s in seeds)))
+
+        with ChunkedDownload(img_local_path, chunk_list.size,
+                             chunk_list.get_id(), chunk_list.chunk_size,
+                             chunk_list.digests) as download:
+            chunks = download.get_missing_chunks()
+
+            if chunks:
+                self._swarm_get_chunks(seeds, download, chunks)
+
+            download.finish()
+
+        self._assert_img_digest_valid(img_local_path,
+                                      [s.catalog for s in seeds])
+
+        signature_img_path = None
+
+        for seed in seeds:
+            signature_img_path = self._sftp_get_myscm_img_signature(
+                seed.sftp, download_dir, img_local_path, seed.catalog)
+
+            if signature_img_path:
+                break
+
+        logger.info("mySCM system image successfully downloaded{} from the "
+                    "swarm of the peers and saved in '{}'.".format(
+                        " with signature" if signature_img_path else "",
+                        img_local_path))
+
+        return img_local_path
+
+    def _swarm_get_chunks(self, seeds, download, chunks):
+        channels = self.client_config.options.download_channels
+        scheduler = ChunkScheduler(chunks, self.abort_event)
+        futures = {}
+
+        with concurrent.futures.ThreadPoolExecutor(
+                len(seeds) * channels) as executor:
+            for seed in seeds:
+                transport = seed.sftp.sftp_client.get_channel().get_transport()
+                remote_path = seed.sftp.normalize(seed.img_name)
+
+                for _ in range(channels):
+                    future = executor.submit(
+                        self._sftp_get_chunks_on_channel, transport,
+                        remote_path, download, scheduler, seed.host,
+                        abort_on_error=False)
+                    futures[future] = seed.host
+
+        failed_hosts = set()
+
+        for future, host in futures.items():
+            e = future.exception()
+
+            if e and host not in failed_hosts:
+                failed_hosts.add(host)
+                logger.warning("Downloading chunks from peer '{}' failed - "
+                               "its chunks were taken over by the other "
+                               "peers ({}).".format(host, e))
+
+        for seed in seeds:
+            downloaded = scheduler.downloaded[seed.host]
+            logger.info("{:.1f} MiB of '{}' downloaded from peer '{}'.".format(
+                        downloaded / (1024 * 1024), seed.img_name, seed.host))
@@ -1,19 +1,24 @@
 # -*- coding: utf-8 -*-
+import io
 import logging
 import os
 import progressbar
 import shutil
 import stat
-import tarfile
 
 import diff_match_patch as patcher
 
 from myscm.client.error import ClientError
+from myscm.client.parser import ApplyModeConfigOption
 from myscm.client.sysimgmanager import SysImgManager
+from myscm.client.sysimgstreamapplier import SysImgStreamApplier
+from myscm.client.sysimgstreamapplier import SysImgStreamApplierError
 from myscm.client.sysimgvalidator import SysImgValidator
 from myscm.client.sysimgvalidator import get_new_old_property_from_string
 from myscm.client.sysimgvalidator import run_fun_for_each_report_line
 from myscm.client.templatefile import TemplateFile
+from myscm.common.blockdelta import apply_delta, BlockDeltaError
+from myscm.common.sysimgarchive import open_sys_img
 from myscm.server.aideentry import AIDEEntry
 from myscm.server.aideentry import FileType
 from myscm.server.sysimggenerator import SystemImageGenerator
@@ -32,9 +37,11 @@ class SysImgExtractor:
     def __init__(self, client_config):
         self.client_config = client_config
         self.sys_img_manager = SysImgManager(client_config)
+        options = self.client_config.options
         self.sys_img_validator = SysImgValidator(
                                         self.client_config.distro_name,
-                                        self.client_config.options.force_apply)
+                                        options.force_apply,
+                                        options.worker_threads)
 
     def apply_sys_img(self):
         """Extract, validate and apply mySCM system image."""
@@ -44,19 +51,18 @@ class SysImgExtractor:
                                                                   sys_img_path)
         self.extracted_sys_img_dir = None
 
+        apply_mode = self.client_config.options.apply_mode
+        threads = self.client_config.options.worker_threads
+
         try:
-            with tarfile.open(sys_img_path) as sys_img_f:
+            with open_sys_img(sys_img_path, threads) as sys_img_f:
                 self.sys_img_validator.assert_sys_img_valid(sys_img_f)
-                self.extracted_sys_img_dir = self._extract_sys_img(sys_img_f)
-
-            logger.info("Applying changes from '{}' directory extracted from "
-                        "'{}' mySCM system image.".format(
-                            self.extracted_sys_img_dir, sys_img_path))
 
-            self._apply_added_files(sys_img_f)
-            self._apply_changed_files(sys_img_f)
-            self._apply_removed_files(sys_img_f)
-        except SysImgExtractorError:
+                if apply_mode == ApplyModeConfigOption.EXTRACT_APPLY_MODE:
+                    self._apply_extracted_sys_img(sys_img_f)
+                else:
+                    self._apply_streamed_sys_img(sys_img_f)
+        except (SysImgExtractorError, SysImgStreamApplierError):
             raise
         except Exception as e:
             m = "Failed to apply '{}' mySCM system image".format(
@@ -66,11 +72,52 @@ class SysImgExtractor:
         if not self.client_config.options.dry_run:
             self.sys_img_manager.update_current_system_state_version(sys_img_ver)
 
-        self._remove_extracted_sys_img_dir()
+        if self.extracted_sys_img_dir:
+            self._remove_extracted_sys_img_dir()
 
         logger.info("Applying changes from '{}' mySCM system image ended "
                     "successfully.".format(sys_img_f.name))
 
+    def _apply_extracted_sys_img(self, sys_img_f):
+        """Extract whole system image to the temporary directory and then
+           move extracted files to their destinations."""
+
+        self.extracted_sys_img_dir = self._extract_sys_img(sys_img_f)
+
+        logger.info("Applying changes from '{}' directory extracted from "
+                    "'{}' mySCM system image.".format(
+                        self.extracted_sys_img_dir, sys_img_f.name))
+
+        self._apply_added_files(sys_img_f)
+        self._apply_changed_files(sys_img_f)
+        self._apply_removed_files(sys_img_f)
+
+    def _apply_streamed_sys_img(self, sys_img_f):
+        """Apply content of the files read in a single pass over the system
+           image and then apply changed.txt and removed.txt reports read
+           directly from the system image."""
+
+        SysImgStreamApplier(self.client_config).apply_sys_img(sys_img_f)
+        added_packages = self._get_packages_of_added_files(sys_img_f)
+        n = len(added_packages)
+
+        logger.info("Newly added files belong to {} package{}.".format(
+                    n, "s" if n != 1 else ""))
+        logger.debug("Packages of the added files: '{}'".format(
+                     "', '".join(added_packages)))
+
+        self._apply_changed_files(sys_img_f)
+        self._apply_removed_files(sys_img_f)
+
+    def _open_report(self, fname, sys_img_f):
+        """Open report (e.g. changed.txt) extracted from the system image or
+           read it directly from the system image if it wasn't extracted."""
+
+        if self.extracted_sys_img_dir:
+            return open(os.path.join(self.extracted_sys_img_dir, fname))
+
+        return io.TextIOWrapper(sys_img_f.extractfile(fname), encoding="utf-8")
+
     def _remove_extracted_sys_img_dir(self):
         logger.debug("Removing temporarily extracted system image '{}'."
                      .format(self.extracted_sys_img_dir))
@@ -130,10 +177,6 @@ class SysImgExtractor:
                      "', '".join(added_packages)))
 
     def _get_packages_of_added_files(self, sys_img_f):
-        added_report_path = os.path.join(
-                                      self.extracted_sys_img_dir,
-                                      SystemImageGenerator.ADDED_FILES_FNAME)
-
         n = self.sys_img_validator.added_entries
         bar = progressbar.ProgressBar(max_value=n)
 
@@ -142,7 +185,8 @@ class SysImgExtractor:
 
         pkg_set = set()
 
-        with open(added_report_path) as f:
+        with self._open_report(SystemImageGenerator.ADDED_FILES_FNAME,
+                               sys_img_f) as f:
             expected_added_count = 2
             run_fun_for_each_report_line(
                 f, sys_img_f, self._added_files_per_line_fun,
@@ -298,9 +342,7 @@ class SysImgExtractor:
     #######################
 
     def _apply_changed_files(self, sys_img_f):
-        changed_report_path = os.path.join(
-                                      self.extracted_sys_img_dir,
-                                      SystemImageGenerator.CHANGED_FILES_FNAME)
+        changed_report_path = SystemImageGenerator.CHANGED_FILES_FNAME
 
         logger.info("Applying changed files listed in '{}' report...".format(
                         changed_report_path))
@@ -308,17 +350,18 @@ class SysImgExtractor:
         n = self.sys_img_validator.changed_entries
         bar = progressbar.ProgressBar(max_value=n)
 
-        with open(changed_report_path) as f:
+        with self._open_report(changed_report_path, sys_img_f) as f:
             run_fun_for_each_report_line(
                 f, sys_img_f, self._changed_files_per_line_fun,
                 AIDEEntry.PROPERTIES_COUNT, self.client_config.distro_name,
                 False, bar)
 
-        changed_dir = os.path.join(
-            self.extracted_sys_img_dir,
-            SystemImageGenerator.IN_ARCHIVE_CHANGED_DIR_NAME)
+        if self.extracted_sys_img_dir:
+            changed_dir = os.path.join(
+                self.extracted_sys_img_dir,
+                SystemImageGenerator.IN_ARCHIVE_CHANGED_DIR_NAME)
 
-        self._remove_empty_dirs(changed_dir)
+            self._remove_empty_dirs(changed_dir)
 
         logger.info("Applying changed files listed in '{}' report ended "
                     "successfully.".format(changed_report_path))
@@ -328,9 +371,11 @@ class SysImgExtractor:
         ftype = values[4]
         size_was_changed = values[5] in {">", "<"}
 
-        # Modify file's content if content was modified
+        # Modify file's content if content was modified (unless it was
+        # already modified while streaming the system image)
 
-        if ftype == FileType.REGULAR_FILE.value and size_was_changed:
+        if ftype == FileType.REGULAR_FILE.value and size_was_changed and\
+           self.extracted_sys_img_dir:
             self._apply_changed_file(path)
 
         # Modify permissions to file if permissions were modified
@@ -387,10 +432,14 @@ class SysImgExtractor:
             SystemImageGenerator.IN_ARCHIVE_CHANGED_DIR_NAME,
             path.lstrip("/"))
         diff_path = orig_path + SystemImageGenerator.PATCH_EXT
+        delta_path = orig_path + SystemImageGenerator.BLOCK_DELTA_EXT
 
         if os.path.isfile(diff_path):
             self._apply_patch_for_file(path, diff_path)
             os.remove(diff_path)
+        elif os.path.isfile(delta_path):
+            self._apply_block_delta_for_file(path, delta_path)
+            os.remove(delta_path)
         elif os.path.isfile(path):
             self._move_changed_file(orig_path, path)
         else:
@@ -430,14 +479,41 @@ class SysImgExtractor:
             f.write(patched_text)
             f.truncate()
 
+    def _apply_block_delta_for_file(self, path, delta_path):
+        """Reconstruct new version of the file in the temporary file placed
+           next to it and atomically rename it to the file, so the file is
+           never left truncated. Owner and mode of the file are kept (the
+           same way patched files do)."""
+
+        logger.debug("Applying block delta '{}' for '{}'.".format(delta_path,
+                                                                  path))
+
+        if self.client_config.options.dry_run:
+            return
+
+        file_stat = os.stat(path)
+
+        try:
+            with SysImgStreamApplier.replaced_atomically(path) as tmp_path:
+                with open(delta_path, "rb") as delta_f,\
+                        open(tmp_path, "xb") as tmp_f:
+                    apply_delta(path, delta_f, tmp_f)
+
+                if os.geteuid() == 0:
+                    os.chown(tmp_path, file_stat.st_uid, file_stat.st_gid)
+
+                os.chmod(tmp_path, stat.S_IMODE(file_stat.st_mode))
+        except BlockDeltaError as e:
+            m = "Failed to apply block delta '{}' for '{}'".format(delta_path,
+                                                                  path)
+            raise SysImgExtractorError(m, e) from e
+
     #######################
     # Apply removed files #
     #######################
 
     def _apply_removed_files(self, sys_img_f):
-        removed_report_path = os.path.join(
-                                      self.extracted_sys_img_dir,
-                                      SystemImageGenerator.REMOVED_FILES_FNAME)
+        removed_report_path = SystemImageGenerator.REMOVED_FILES_FNAME
 
         logger.info("Removing removed files listed in '{}' report...".format(
                         removed_report_path))
@@ -445,7 +521,7 @@ class SysImgExtractor:
         n = self.sys_img_validator.removed_entries
         bar = progressbar.ProgressBar(max_value=n)
 
-        with open(removed_report_path) as f:
+        with self._open_report(removed_report_path, sys_img_f) as f:
             expected_removed_count = 2
             run_fun_for_each_report_line(f, sys_img_f,
                                          self._removed_files_per_line_fun,
@@ -91,6 +91,35 @@ class SysImgManager(SysImgManagerBase):
         info = "SSL signature {}valid".format("" if valid else "in")
         print(info)
 
+    def assert_sys_img_signature_valid(self, sys_img_path):
+        """Raise `SysImgManagerError` if SSL signature of the system image is
+           missing or invalid."""
+
+        signature_path = sys_img_path + SignatureManager.SIGNATURE_EXT
+        ssl_pub_key_path = self.client_config.options.SSL_cert_public_key_path
+
+        if not os.path.isfile(signature_path):
+            m = "mySCM system image '{}' has no SSL signature ('{}' doesn't "\
+                "exist) thus it won't be applied".format(sys_img_path,
+                                                         signature_path)
+            raise SysImgManagerError(m)
+
+        try:
+            valid = SignatureManager().ssl_verify(sys_img_path, signature_path,
+                                                  ssl_pub_key_path)
+        except (SignatureManagerError, OSError) as e:
+            m = "Failed to verify '{}' mySCM system image certificate".format(
+                    signature_path)
+            raise SysImgManagerError(m, e) from e
+
+        if not valid:
+            m = "SSL signature '{}' of the mySCM system image is invalid "\
+                "thus it won't be applied".format(signature_path)
+            raise SysImgManagerError(m)
+
+        logger.debug("SSL signature '{}' of the mySCM system image is "
+                     "valid.".format(signature_path))
+
     def get_target_sys_img_ver_from_fname(self, fname):
         regex_str = SystemImageGenerator.MYSCM_IMG_FILE_NAME_REGEX
         regex = re.compile(regex_str)
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import functools
+import io
+import logging
+import os
+import progressbar
+import shutil
+import stat
+import tarfile
+
+import diff_match_patch as patcher
+
+from myscm.client.error import ClientError
+from myscm.client.templatefile import TemplateFile
+from myscm.common.blockdelta import apply_delta, BlockDeltaError
+from myscm.common.sysimgarchive import IndexedSysImg
+from myscm.server.sysimggenerator import SystemImageGenerator
+
+progressbar.streams.wrap_stderr()
+logger = logging.getLogger(__name__)
+
+
+class SysImgStreamApplierError(ClientError):
+    pass
+
+
+class SysImgStreamApplier:
+    """Applier of the files stored in the mySCM system image which reads the
+       image in a single sequential pass. Nothing is extracted to the
+       temporary directory - every file is written to the temporary file
+       placed next to its destination and then atomically renamed to the
+       destination path. Templates and patches are applied on the fly.
+
+       Only content of the added and changed files is applied. Properties of
+       the changed files (changed.txt) and removed files (removed.txt) are
+       applied by `SysImgExtractor`."""
+
+    TMP_FNAME = ".{}.myscm-cli-{}.tmp"
+    COPY_BUFSIZE = 1024 * 1024
+
+    def __init__(self, client_config):
+        self.client_config = client_config
+        self.dry_run = client_config.options.dry_run
+        self.added_prefix = SystemImageGenerator.IN_ARCHIVE_ADDED_DIR_NAME + "/"
+        self.changed_prefix =\
+            SystemImageGenerator.IN_ARCHIVE_CHANGED_DIR_NAME + "/"
+        self.is_root = os.geteuid() == 0
+
+    def apply_sys_img(self, sys_img_f):
+        """Apply added and changed files from already validated system image
+           (TarFile or IndexedSysImg)."""
+
+        logger.info("Applying added and changed files streamed from '{}' "
+                    "system image...".format(sys_img_f.name))
+
+        if isinstance(sys_img_f, IndexedSysImg):
+            n = len(sys_img_f.getmembers())
+            open_tar = sys_img_f.open_tar  # decompressed with many threads
+        else:
+            n = progressbar.UnknownLength
+            open_tar = functools.partial(tarfile.open, sys_img_f.name)
+
+        bar = progressbar.ProgressBar(max_value=n)
+        added_count, changed_count = 0, 0
+
+        with open_tar() as tar_f:
+            for member in bar(tar_f):
+                if member.name.startswith(self.added_prefix):
+                    self._apply_added_member(member, tar_f)
+                    added_count += 1
+                elif member.name.startswith(self.changed_prefix):
+                    self._apply_changed_member(member, tar_f)
+                    changed_count += 1
+
+        if not self.dry_run:
+            os.sync()
+
+        logger.info("Applying files streamed from '{}' system image ended "
+                    "successfully ({} added, {} changed).".format(
+                        sys_img_f.name, added_count, changed_count))
+
+    #####################
+    # Apply added files #
+    #####################
+
+    def _apply_added_member(self, member, tar_f):
+        dst = os.path.sep + member.name[len(self.added_prefix):]
+        template_ext = SystemImageGenerator.TEMPLATE_PATH_EXT
+
+        if member.isdir():
+            self._apply_added_dir(member, dst)
+            return
+
+        if member.isreg() and dst.endswith(template_ext):
+            self._apply_added_template(member, tar_f, dst[:-len(template_ext)])
+            return
+
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            logger.warning("'{}' already exists and is not symlink - skipping "
+                           "copying.".format(dst))
+            return
+
+        if os.path.lexists(dst):
+            logger.warning("File '{}' already exist - overwritting.".format(
+                           dst))
+
+        logger.debug("Writing '{}' to '{}'.".format(member.name, dst))
+
+        if self.dry_run:
+            return
+
+        with self.replaced_atomically(dst) as tmp_path:
+            if member.isreg():
+                self._write_regular_file(member, tar_f, tmp_path)
+            elif member.issym():
+                os.symlink(member.linkname, tmp_path)
+            elif member.islnk():
+                os.link(self._get_hardlink_target(member), tmp_path)
+                return  # hard link shares properties of its target
+            elif member.isfifo():
+                os.mkfifo(tmp_path)
+            elif member.isdev():
+                self._make_device_file(member, tmp_path)
+            else:
+                m = "Unsupported type of the file '{}' in the system image"\
+                    .format(member.name)
+                raise SysImgStreamApplierError(m)
+
+            self._set_file_properties(member, tmp_path)
+
+    def _apply_added_dir(self, member, dst):
+        if os.path.exists(dst):
+            return
+
+        logger.debug("Creating '{}'.".format(dst))
+
+        if not self.dry_run:
+            os.makedirs(dst, exist_ok=True)
+            self._set_file_properties(member, dst)
+
+    def _apply_added_template(self, member, tar_f, dst):
+        logger.debug("Replacing template file '{}' with values and saving the "
+                     "result in '{}'.".format(member.name, dst))
+
+        if self.dry_run:
+            return
+
+        templater = TemplateFile(member.name)
+
+        with self.replaced_atomically(dst) as tmp_path:
+            with io.TextIOWrapper(tar_f.extractfile(member)) as template_f:
+                with open(tmp_path, "x") as out_f:
+                    templater.write_with_values(template_f, out_f)
+
+            self._set_file_owner(member.uid, member.gid, tmp_path)
+            os.chmod(tmp_path, member.mode)
+
+    def _get_hardlink_target(self, member):
+        if not member.linkname.startswith(self.added_prefix):
+            m = "Hard link '{}' refers to '{}' which is not an added file"\
+                .format(member.name, member.linkname)
+            raise SysImgStreamApplierError(m)
+
+        return os.path.sep + member.linkname[len(self.added_prefix):]
+
+    def _make_device_file(self, member, path):
+        mode = member.mode | (stat.S_IFCHR if member.ischr() else stat.S_IFBLK)
+        os.mknod(path, mode, os.makedev(member.devmajor, member.devminor))
+
+    #######################
+    # Apply changed files #
+    #######################
+
+    def _apply_changed_member(self, member, tar_f):
+        path = os.path.sep + member.name[len(self.changed_prefix):]
+        patch_ext = SystemImageGenerator.PATCH_EXT
+        delta_ext = SystemImageGenerator.BLOCK_DELTA_EXT
+        is_patch = path.endswith(patch_ext)
+        is_delta = path.endswith(delta_ext)
+
+        if is_patch:
+            path = path[:-len(patch_ext)]
+        elif is_delta:
+            path = path[:-len(delta_ext)]
+
+        if not member.isreg() or not os.path.isfile(path):
+            m = "'{}' found in the system image refers to '{}' which doesn't "\
+                "exist or is not a regular file. It is acceptable if "\
+                "myscm-cli applied changes during last run.".format(
+                    member.name, path)
+            logger.warning(m)
+            return
+
+        if is_patch:
+            self._apply_patch_member(member, tar_f, path)
+            return
+
+        if is_delta:
+            self._apply_delta_member(member, tar_f, path)
+            return
+
+        logger.debug("Replacing '{}' with '{}'.".format(path, member.name))
+
+        if not self.dry_run:
+            with self.replaced_atomically(path) as tmp_path:
+                self._write_regular_file(member, tar_f, tmp_path)
+                self._set_file_properties(member, tmp_path)
+
+    def _apply_patch_member(self, member, tar_f, path):
+        logger.debug("Applying patch '{}' for '{}'.".format(member.name, path))
+
+        if self.dry_run:
+            return
+
+        with io.TextIOWrapper(tar_f.extractfile(member)) as patch_f:
+            patch_text = patch_f.read()
+
+        with open(path) as f:
+            text_to_patch = f.read()
+
+        p = patcher.diff_match_patch()
+        patches = p.patch_fromText(patch_text)
+        patched_text, _ = p.patch_apply(patches, text_to_patch)
+        file_stat = os.stat(path)
+
+        with self.replaced_atomically(path) as tmp_path:
+            with open(tmp_path, "x") as f:
+                f.write(patched_text)
+
+            self._set_file_owner(file_stat.st_uid, file_stat.st_gid, tmp_path)
+            os.chmod(tmp_path, stat.S_IMODE(file_stat.st_mode))
+
+    def _apply_delta_member(self, member, tar_f, path):
+        logger.debug("Applying block delta '{}' for '{}'.".format(member.name,
+                                                                  path))
+
+        if self.dry_run:
+            return
+
+        file_stat = os.stat(path)
+
+        with self.replaced_atomically(path) as tmp_path:
+            with tar_f.extractfile(member) as delta_f,\
+                    open(tmp_path, "xb") as f:
+                try:
+                    apply_delta(path, delta_f, f)
+                except BlockDeltaError as e:
+                    m = "Failed to apply block delta '{}' for '{}'".format(
+                            member.name, path)
+                    raise SysImgStreamApplierError(m, e) from e
+
+            self._set_file_owner(file_stat.st_uid, file_stat.st_gid, tmp_path)
+            os.chmod(tmp_path, stat.S_IMODE(file_stat.st_mode))
+
+    ###########
+    # Helpers #
+    ###########
+
+    @classmethod
+    @contextlib.contextmanager
+    def replaced_atomically(cls, dst):
+        """Context manager yielding path of the temporary file (which is not
+           created) in the same directory as `dst`. Temporary file is renamed
+           to `dst` at the exit or removed if exception occurred."""
+
+        dst_dir, dst_fname = os.path.split(dst)
+        tmp_fname = cls.TMP_FNAME.format(dst_fname[:200], os.urandom(4).hex())
+        tmp_path = os.path.join(dst_dir, tmp_fname)
+
+        os.makedirs(dst_dir, exist_ok=True)
+
+        try:
+            yield tmp_path
+            os.replace(tmp_path, dst)
+        except:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+
+    def _write_regular_file(self, member, tar_f, path):
+        with tar_f.extractfile(member) as src_f:
+            with open(path, "xb") as dst_f:
+                shutil.copyfileobj(src_f, dst_f, self.COPY_BUFSIZE)
+
+    def _set_file_properties(self, member, path):
+        self._set_file_owner(member.uid, member.gid, path)
+
+        if not member.issym():
+            os.chmod(path, member.mode)
+            os.utime(path, (member.mtime, member.mtime))
+
+    def _set_file_owner(self, uid, gid, path):
+        if self.is_root:
+            os.chown(path, uid, gid, follow_symlinks=False)
@@ -1,10 +1,17 @@
 # -*- coding: utf-8 -*-
+import concurrent.futures
 import logging
+import os
 import random
+import threading
 
 from myscm.client.error import ClientError
+from myscm.client.peerdiscovery import PeerDiscovery
 from myscm.client.sftpdownloader import SFTPSysImgDownloader
 from myscm.client.sftpdownloader import SFTPSysImgDownloaderError
+from myscm.client.sftpswarmdownloader import SFTPSwarmSysImgDownloader
+from myscm.client.upgradeplanner import UpgradePlanner
+from myscm.common.sysimgcatalog import SysImgCatalog, SysImgCatalogError
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +31,9 @@ class SysImgUpdater:
         "SFTP": SFTPSysImgDownloader
     }
     SUPPORTED_PROTOCOLS = list(SUPPORTED_PROTOCOLS_MAPPING.keys())
+    SWARM_PROTOCOLS_MAPPING = {
+        "SFTP": SFTPSwarmSysImgDownloader
+    }
 
     def __init__(self, client_config):
         super().__init__()
@@ -38,32 +48,238 @@ class SysImgUpdater:
         else:
             img_local_path = self._download_from_selected_host(host)
 
+        if img_local_path:
+            self._update_catalog()
+
         return img_local_path
 
+    def upgrade(self, target_id=None):
+        """Upgrade system to the given version (newest available version by
+           default) applying chain of the system images found by the
+           `UpgradePlanner` if there is no system image leading directly to
+           that version. Next system image of the chain is downloaded while
+           the current one is applied (and aborted if applying fails). Every
+           system image is applied only if its SSL signature is valid."""
+
+        from myscm.client.sysimgextractor import SysImgExtractor
+
+        current_id = self.client_config.img_ver_file.get_version(create=True)
+
+        if target_id is not None and target_id <= current_id:
+            logger.info("Current state of the system (version {}) is not "
+                        "older than requested version {} thus no need to "
+                        "upgrade.".format(current_id, target_id))
+            return
+
+        hops = self._plan_upgrade(current_id, target_id)
+
+        if not hops:
+            logger.info("No mySCM system image newer than current state of "
+                        "the system (version {}) found.".format(current_id))
+            return
+
+        n = len(hops)
+        size = sum(h.size for h in hops)
+        logger.info("Upgrading system from version {} to version {} using "
+                    "{} mySCM system image{} ({:.1f} MiB to download): "
+                    "{}.".format(current_id, hops[-1].to_id, n,
+                                 "s" if n > 1 else "", size / (1024 * 1024),
+                                 " -> ".join([str(current_id)] +
+                                             [str(h.to_id) for h in hops])))
+
+        dry_run = self.client_config.options.dry_run
+        abort_event = threading.Event()
+
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            future = executor.submit(self._download_hop, hops[0], abort_event)
+
+            for i, hop in enumerate(hops):
+                future.result()
+                last_hop = i == n - 1 or dry_run
+
+                if not last_hop:  # prefetch while current one is applied
+                    future = executor.submit(self._download_hop, hops[i + 1],
+                                             abort_event)
+
+                try:
+                    self.client_config.options.apply_img = hop.to_id
+                    extractor = SysImgExtractor(self.client_config)
+                    extractor.sys_img_manager.assert_sys_img_signature_valid(
+                        extractor.sys_img_manager.get_sys_img_path())
+                    extractor.apply_sys_img()
+                except BaseException:
+                    # Don't wait for the prefetched system image at exit
+                    future.cancel()
+                    abort_event.set()
+                    raise
+
+                if last_hop:
+                    break
+
+        if dry_run and n > 1:
+            logger.info("Remaining {} mySCM system image{} of the upgrade "
+                        "skipped in dry run mode.".format(
+                            n - 1, "s" if n > 2 else ""))
+
+    def _plan_upgrade(self, current_id, target_id):
+        """Return list of the `Hop`s leading to the target version. System
+           images already downloaded cost nothing, so interrupted upgrade
+           resumes where it stopped."""
+
+        protocol = self.client_config.options.sys_img_update_protocol
+        filtered_hosts = self._get_filtered_hosts(protocol)
+        downloader = self._get_downloader(protocol)
+        download_dir = self.client_config.options.sys_img_download_dir
+        planner = UpgradePlanner()
+
+        try:
+            for fname in os.listdir(download_dir):
+                planner.add_img(fname, 0)
+        except OSError as e:
+            m = "Failed to list downloaded mySCM system images in '{}'"\
+                .format(download_dir)
+            raise SysImgUpdaterError(m, e) from e
+
+        for host_details, imgs in self._list_peers_imgs(downloader,
+                                                        filtered_hosts):
+            for img_name, size in imgs:
+                planner.add_img(img_name, size, host_details)
+
+        return planner.plan(current_id, target_id)
+
+    def _list_peers_imgs(self, downloader, filtered_hosts):
+        """Return list of the (host details, list of the (name, size) pairs
+           of the system images) pairs of the peers. Peers are listed
+           concurrently in random order within `DiscoveryTimeout`."""
+
+        hosts = random.sample(list(filtered_hosts.keys()), len(filtered_hosts))
+        hosts_details = [self.client_config.options.peers_list[h]
+                         for h in hosts]
+        timeout = self.client_config.options.discovery_timeout
+        executor = concurrent.futures.ThreadPoolExecutor(len(hosts_details))
+        n = len(hosts_details)
+
+        logger.info("Listing mySCM system images of {} peer{}.".format(
+                    n, "s" if n > 1 else ""))
+
+        try:
+            futures = {executor.submit(downloader.list_imgs, h): h
+                       for h in hosts_details}
+            done, pending = concurrent.futures.wait(futures, timeout=timeout)
+        finally:
+            executor.shutdown(wait=False)
+
+        if pending:
+            n = len(pending)
+            logger.warning("{} peer{} didn't respond within {}s - skipping "
+                           "{}.".format(n, "s" if n > 1 else "", timeout,
+                                        "them" if n > 1 else "it"))
+
+        peers_imgs = []
+
+        for future, host_details in futures.items():
+            if future not in done:
+                continue
+
+            try:
+                peers_imgs.append((host_details, future.result()))
+            except SFTPSysImgDownloaderError as e:
+                logger.warning("{}.".format(e))
+
+        return peers_imgs
+
+    def _download_hop(self, hop, abort_event=None):
+        """Download system image of the `Hop` from the peers holding it
+           (from many of them at once if possible). Download is aborted once
+           optional `abort_event` is set."""
+
+        if hop.is_local():
+            logger.info("mySCM system image '{}' is already downloaded."
+                        .format(hop.img_name))
+            return
+
+        protocol = self.client_config.options.sys_img_update_protocol
+        swarm_downloader_class = self.SWARM_PROTOCOLS_MAPPING.get(protocol)
+        downloader = self._get_downloader(protocol, abort_event)
+        img_local_path = None
+
+        if swarm_downloader_class and len(hop.hosts_details) > 1 and\
+           self.client_config.options.swarm_peers > 1:
+            try:
+                img_local_path = swarm_downloader_class(
+                    self.client_config, abort_event).download_from_swarm(
+                        hop.hosts_details, hop.img_name)
+            except SFTPSysImgDownloaderError as e:
+                self._assert_hop_download_not_aborted(hop, abort_event, e)
+                logger.warning("{}. Falling back to downloading from single "
+                               "peer.".format(e))
+
+        hosts_details = [] if img_local_path else hop.hosts_details
+
+        for host_details in hosts_details:
+            try:
+                img_local_path = downloader.download(host_details,
+                                                     hop.img_name)
+                break
+            except SFTPSysImgDownloaderError as e:
+                self._assert_hop_download_not_aborted(hop, abort_event, e)
+                logger.warning("{}. Trying out next host.".format(e))
+
+        if not img_local_path:
+            n = len(hop.hosts_details)
+            m = "Failed to download '{}' mySCM system image from any of the "\
+                "{} peer{} holding it".format(hop.img_name, n,
+                                              "s" if n > 1 else "")
+            raise SysImgUpdaterError(m)
+
+        self._update_catalog()
+
+    def _assert_hop_download_not_aborted(self, hop, abort_event, e):
+        if abort_event and abort_event.is_set():
+            m = "Download of '{}' mySCM system image aborted".format(
+                    hop.img_name)
+            raise SysImgUpdaterError(m, e) from e
+
+    def _update_catalog(self):
+        """Update (not signed) catalog of the downloaded system images, so
+           other clients using this one as a peer find them quickly."""
+
+        download_dir = self.client_config.options.sys_img_download_dir
+
+        try:
+            SysImgCatalog.update(download_dir)
+        except SysImgCatalogError as e:
+            logger.warning("{}.".format(e))
+
     def _download_from_random_host(self):
         protocol = self.client_config.options.sys_img_update_protocol
         filtered_hosts = self._get_filtered_hosts(protocol)
         downloader = self._get_downloader(protocol)
-        filtered_hosts_count = len(filtered_hosts)
+        peers = self._discover_peers(downloader, filtered_hosts)
+
+        if peers and self.client_config.options.swarm_peers > 1:
+            img_local_path = self._download_from_swarm(protocol, peers)
+
+            if img_local_path:
+                return img_local_path
+
         tries = 0
         downloaded = False
         img_local_path = None
 
-        while filtered_hosts and not downloaded:
+        for peer in peers:
             tries += 1
-            host = random.choice(list(filtered_hosts.keys()))
-            host_details = self.client_config.options.peers_list[host]
-            n = len(filtered_hosts)
-            del filtered_hosts[host]
+            host = peer.host_details["host"]
             m = "No host was explicitly specified to download mySCM image "\
-                "from - random host '{}' read from configuration file was "\
-                "selected from {} candidate{} (try #{} out of {}).".format(
-                    host, n, "s" if n > 1 else "", tries, filtered_hosts_count)
+                "from - host '{}' holding '{}' system image was selected "\
+                "(try #{} out of {}).".format(host, peer.img_name, tries,
+                                               len(peers))
             logger.info(m)
 
             try:
-                img_local_path = downloader.download(host_details)
+                img_local_path = downloader.download(peer.host_details)
                 downloaded = True
+                break
             except SysImgDownloaderNoImageFoundError as e:
                 m = "{} Trying out next host.".format(e)
                 logger.info(m)
@@ -72,12 +288,54 @@ class SysImgUpdater:
                 logger.warning(m)
 
         if not downloaded:
+            n = len(filtered_hosts)
             m = "No applicable mySCM system image found ({} host{} checked)."\
-                .format(tries, "s" if tries > 1 else "")
+                .format(n, "s" if n > 1 else "")
             logger.warning(m)
 
         return img_local_path
 
+    def _discover_peers(self, downloader, filtered_hosts):
+        """Return list of the `Peer`s holding applicable system images (best
+           peers first). Peers are probed concurrently in random order, so
+           peers equally good are selected randomly."""
+
+        hosts = random.sample(list(filtered_hosts.keys()), len(filtered_hosts))
+        hosts_details = [self.client_config.options.peers_list[h]
+                         for h in hosts]
+        timeout = self.client_config.options.discovery_timeout
+        n = len(hosts_details)
+
+        logger.info("Searching for the newest applicable mySCM system image "
+                    "on {} peer{}.".format(n, "s" if n > 1 else ""))
+
+        return PeerDiscovery(downloader, timeout).discover(hosts_details)
+
+    def _download_from_swarm(self, protocol, peers):
+        """Download system image from many peers at once. Return None if
+           it's not possible (e.g. none of the peers publishes chunk list of
+           the system image) and system image should be downloaded from
+           single peer."""
+
+        downloader_class = self.SWARM_PROTOCOLS_MAPPING.get(protocol)
+
+        if not downloader_class:
+            return None
+
+        # Only peers holding the newest system image are the swarm's seeds
+
+        hosts_details = [p.host_details for p in peers
+                         if p.target_id == peers[0].target_id]
+        downloader = downloader_class(self.client_config)
+
+        try:
+            return downloader.download_from_swarm(hosts_details)
+        except SFTPSysImgDownloaderError as e:
+            logger.warning("{}. Falling back to downloading from single "
+                           "peer.".format(e))
+
+        return None
+
     def _get_filtered_hosts(self, protocol):
         all_peers = self.client_config.options.peers_list
         selected_peers_list = {k: v for k, v in all_peers.items() if v["protocol"] == protocol}
@@ -89,7 +347,7 @@ class SysImgUpdater:
 
         return selected_peers_list
 
-    def _get_downloader(self, protocol):
+    def _get_downloader(self, protocol, abort_event=None):
         downloader_class = self.SUPPORTED_PROTOCOLS_MAPPING.get(protocol)
 
         if not downloader_class:
@@ -98,7 +356,7 @@ class SysImgUpdater:
                     protocol, "', '".join(self.SUPPORTED_PROTOCOLS))
             raise SysImgUpdaterError(m)
 
-        return downloader_class(self.client_config)
+        return downloader_class(self.client_config, abort_event)
 
     def _download_from_selected_host(self, host):
         host_details = self.client_config.options.peers_list[host]
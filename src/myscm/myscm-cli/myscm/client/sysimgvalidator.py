@@ -1,5 +1,4 @@
 # -*- coding: utf-8 -*-
-import hashlib
 import logging
 import os
 import platform
@@ -7,6 +6,7 @@ import re
 import stat
 
 from myscm.client.error import ClientError
+from myscm.common.filehasher import FileHasher
 from myscm.server.aideentry import AIDEEntry
 from myscm.server.aideentry import FileType
 from myscm.server.sysimggenerator import SystemImageGenerator
@@ -23,10 +23,13 @@ class SysImgValidator:
 
     MD5SUM_LEN = 32
     SHA1SUM_LEN = 40
+    CHECKSUMS = [("md5", "MD5", MD5SUM_LEN), ("sha1", "SHA1", SHA1SUM_LEN)]
 
-    def __init__(self, distro_name, force_apply=False):
+    def __init__(self, distro_name, force_apply=False, threads=1):
         self.distro_name = distro_name
         self.force_apply = force_apply
+        self.file_hasher = FileHasher([c[0] for c in self.CHECKSUMS], threads)
+        self.expected_checksums = {}  # checked after reading changed.txt
 
     def assert_sys_img_valid(self, sys_img_f):
         try:
@@ -65,11 +68,15 @@ class SysImgValidator:
 
     def _assert_changed_summary_valid(self, sys_img_f):
         expected_changed_count = AIDEEntry.PROPERTIES_COUNT
-        return self._assert_summary_valid(
+        self.expected_checksums = {}
+        summary = self._assert_summary_valid(
                                 sys_img_f,
                                 SystemImageGenerator.CHANGED_FILES_FNAME,
                                 expected_changed_count,
                                 self._assert_changed_line_valid)
+        self._assert_files_checksums_valid()
+
+        return summary
 
     def _assert_removed_summary_valid(self, sys_img_f):
         expected_removed_count = 2
@@ -178,7 +185,7 @@ class SysImgValidator:
         if ftype_char == FileType.REGULAR_FILE.value:
             md5sum_str = values[15]
             sha1sum_str = values[16]
-            self._assert_file_checksums_valid(path, md5sum_str, sha1sum_str)
+            self._add_expected_file_checksums(path, md5sum_str, sha1sum_str)
 
             # Check file size
 
@@ -251,14 +258,23 @@ class SysImgValidator:
             found_path = intar_orig_path
         except KeyError:
             intar_diff_path = intar_orig_path + SystemImageGenerator.PATCH_EXT
-            try:
-                sys_img_f.getmember(intar_diff_path)
-                found_path = intar_diff_path
-            except KeyError:
-                m = "File '{}' or its patch '{}' is supposed to be present "\
-                    "in mySCM system image '{}' in '{}' directory but was "\
-                    "not found (info read from added files report)".format(
-                        intar_orig_path, intar_diff_path, sys_img_f.name,
+            intar_delta_path = intar_orig_path +\
+                SystemImageGenerator.BLOCK_DELTA_EXT
+
+            for diff_path in [intar_diff_path, intar_delta_path]:
+                try:
+                    sys_img_f.getmember(diff_path)
+                    found_path = diff_path
+                    break
+                except KeyError:
+                    pass
+            else:
+                m = "File '{}' or its patch '{}' (or block delta '{}') is "\
+                    "supposed to be present in mySCM system image '{}' in "\
+                    "'{}' directory but was not found (info read from added "\
+                    "files report)".format(
+                        intar_orig_path, intar_diff_path, intar_delta_path,
+                        sys_img_f.name,
                         SystemImageGenerator.IN_ARCHIVE_CHANGED_DIR_NAME)
                 raise SysImgValidatorError(m)
 
@@ -307,26 +323,38 @@ class SysImgValidator:
             else:
                 raise SysImgValidatorError(m)
 
-    def _assert_file_checksums_valid(self, path, md5sum_str, sha1sum_str):
-        self._assert_file_md5sum_valid(path, md5sum_str)
-        self._assert_file_sha1sum_valid(path, sha1sum_str)
+    def _add_expected_file_checksums(self, path, md5sum_str, sha1sum_str):
+        """Remember checksums of the file to verify them later - all of the
+           files listed in changed.txt are hashed at once in parallel (see
+           `_assert_files_checksums_valid()`)."""
 
-    def _assert_file_md5sum_valid(self, path, md5sum_str):
-        self._assert_file_checksum_valid(path, "MD5", md5sum_str,
-                                         self.MD5SUM_LEN,
-                                         self._compute_file_md5sum)
+        hash_strings = [md5sum_str, sha1sum_str]
+        self.expected_checksums[path] = [
+            self._get_hash_from_property_string(hash_str, path, hash_len)
+            for (_, _, hash_len), hash_str in zip(self.CHECKSUMS, hash_strings)]
 
-    def _assert_file_sha1sum_valid(self, path, sha1sum_str):
-        self._assert_file_checksum_valid(path, "SHA1", sha1sum_str,
-                                         self.SHA1SUM_LEN,
-                                         self._compute_file_sha1sum)
+    def _assert_files_checksums_valid(self):
+        paths = list(self.expected_checksums.keys())
 
-    def _assert_file_checksum_valid(self, path, hash_name, hash_str, hash_len,
-                                    checksum_fun):
-        expected_checksum = self._get_hash_from_property_string(hash_str, path,
-                                                                hash_len)
-        computed_checksum = checksum_fun(path)
+        logger.debug("Computing checksums of {} changed file{}.".format(
+                     len(paths), "s" if len(paths) != 1 else ""))
 
+        for path, digests, error in self.file_hasher.iterate_files_digests(
+                                                                        paths):
+            if error:
+                m = "Failed to compute hash of the '{}' file".format(path)
+                raise SysImgValidatorError(m, error)
+
+            expected_checksums = self.expected_checksums[path]
+
+            for (hash_name, hash_title, _), expected_checksum in zip(
+                    self.CHECKSUMS, expected_checksums):
+                self._assert_file_checksum_valid(path, hash_title,
+                                                 digests[hash_name],
+                                                 expected_checksum)
+
+    def _assert_file_checksum_valid(self, path, hash_name, computed_checksum,
+                                    expected_checksum):
         if computed_checksum != expected_checksum:
             m = "{} checksum of the '{}' file is '{}' instead of expected "\
                 "'{}' (read from mySCM system's image file)".format(
@@ -351,23 +379,6 @@ class SysImgValidator:
         # '=' for size check, '.' for others
         return new_val if old_val in {".", "="} else old_val
 
-    def _compute_file_md5sum(self, path):
-        return self._compute_file_hash(path, hashlib.md5())
-
-    def _compute_file_sha1sum(self, path):
-        return self._compute_file_hash(path, hashlib.sha1())
-
-    def _compute_file_hash(self, path, hash_type):
-        hash_sum = None
-
-        try:
-            hash_sum = self.__get_file_hash(path, hash_type)
-        except Exception as e:
-            m = "Failed to compute hash of the '{}' file".format(path)
-            raise SysImgValidatorError(m)
-
-        return hash_sum
-
     def _assert_changed_file_size_valid(self, path, file_size_str, file_stat):
         local_file_size = file_stat.st_size
         expected_file_size = self._get_expected_val_from_property_string(
@@ -449,18 +460,6 @@ class SysImgValidator:
             else:
                 raise SysImgValidatorError(m)
 
-    def __get_file_hash(self, path, hash_type):
-        BUF_SIZE = 65536  # read in 64kb chunks
-
-        with open(path, 'rb') as f:
-            while True:
-                data = f.read(BUF_SIZE)
-                if not data:
-                    break
-                hash_type.update(data)
-
-        return hash_type.hexdigest()
-
     ################################################
     # Assert line from removed.txt report is valid #
     ################################################
@@ -25,12 +25,19 @@ class TemplateFile:
         self.env_var_name_regex = re.compile(self.ENV_VAR_NAME_REGEX_STR)
 
     def replace_placeholders_with_values(self, output_path):
-        computed_vars_values = dict()
-
         with open(self.template_path) as template_f:
             with open(output_path, "w") as out_f:
-                for line in template_f:
-                    self._append_line_to_file(line, out_f, computed_vars_values)
+                self.write_with_values(template_f, out_f)
+
+    def write_with_values(self, template_f, out_f):
+        """Write lines read from already opened template file (e.g. read
+           directly from the system image) to the output file replacing
+           placeholders with their values."""
+
+        computed_vars_values = dict()
+
+        for line in template_f:
+            self._append_line_to_file(line, out_f, computed_vars_values)
 
     def _get_full_var_name(self, var_name):
         return self.VAR_NAME_PLACEHOLDER.format(var_name)
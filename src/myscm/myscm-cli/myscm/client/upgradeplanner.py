@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import collections
+import heapq
+import logging
+import re
+
+from myscm.client.error import ClientError
+from myscm.server.sysimggenerator import SystemImageGenerator
+
+logger = logging.getLogger(__name__)
+
+
+class UpgradePlannerError(ClientError):
+    pass
+
+
+class Hop(collections.namedtuple("Hop", [
+        "from_id", "to_id", "img_name", "size", "hosts_details"])):
+    """Single step of the upgrade - system image applied on the way to the
+       target version together with the peers holding it (empty if system
+       image is already downloaded)."""
+
+    def is_local(self):
+        return not self.hosts_details
+
+
+class UpgradePlanner:
+    """Planner of the upgrade chaining system images when there is no system
+       image leading directly from the current to the target version. Known
+       system images (downloaded ones and published by the peers) are edges
+       of the graph of the versions weighted by the number of bytes to
+       download (zero for the downloaded ones) and the cheapest path is found
+       by Dijkstra's algorithm. Paths of the same cost are broken by the
+       number of hops, so direct system image is preferred."""
+
+    def __init__(self):
+        self.edges = {}  # {from_id: {to_id: Hop}}
+
+    def add_img(self, img_name, size, host_details=None):
+        """Add system image published by the peer or already downloaded one
+           if no `host_details` are given. Names not matching system image
+           name and images not leading to the newer version are ignored."""
+
+        match = re.fullmatch(SystemImageGenerator.MYSCM_IMG_FILE_NAME_REGEX,
+                             img_name)
+
+        if not match:
+            return
+
+        from_id, to_id = int(match.group(1)), int(match.group(2))
+
+        if to_id <= from_id:
+            return
+
+        hop = self.edges.setdefault(from_id, {}).get(to_id)
+
+        if not hop:
+            hop = Hop(from_id, to_id, img_name, size, [])
+        elif hop.is_local():
+            return
+
+        if host_details:
+            hop.hosts_details.append(host_details)
+        else:
+            hop = hop._replace(size=0, hosts_details=[])
+
+        self.edges[from_id][to_id] = hop
+
+    def plan(self, from_id, target_id=None):
+        """Return list of the `Hop`s of the cheapest path leading from the
+           given version to the target version (newest reachable version by
+           default). Empty list is returned if there is no newer version."""
+
+        costs = {from_id: (0, 0)}
+        previous_hops = {}
+        queue = [(0, 0, from_id)]
+
+        while queue:
+            size, hops, ver = heapq.heappop(queue)
+
+            if (size, hops) > costs[ver]:
+                continue
+
+            for to_id, hop in self.edges.get(ver, {}).items():
+                cost = (size + hop.size, hops + 1)
+
+                if to_id not in costs or cost < costs[to_id]:
+                    costs[to_id] = cost
+                    previous_hops[to_id] = hop
+                    heapq.heappush(queue, (cost[0], cost[1], to_id))
+
+        if target_id is None:
+            target_id = max(costs)
+
+            if target_id == from_id:
+                return []
+        elif target_id not in costs:
+            m = "No chain of the known mySCM system images leads from "\
+                "version {} to version {}".format(from_id, target_id)
+            raise UpgradePlannerError(m)
+
+        path = []
+        ver = target_id
+
+        while ver != from_id:
+            path.append(previous_hops[ver])
+            ver = path[-1].from_id
+
+        path.reverse()
+
+        return path
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""Binary delta of the two versions of the file, which works the way rsync
+   does. Old file is split into blocks whose weak (rolling) and strong
+   checksums make up the signature. New file is scanned with the window
+   rolled byte by byte and every window whose checksums match a block of the
+   old file is encoded as a copy of that block, while everything else is
+   encoded as literal data.
+
+   Delta is a stream of the operations: copy of the old file's bytes (merged
+   if copied blocks are adjacent), literal data and end of the delta holding
+   size and SHA256 digest of the new file, so the result of applying delta to
+   the wrong version of the old file is detected. Memory used by both sides is
+   bounded regardless of the files' sizes (signature takes a few bytes per
+   block and block size grows with the size of the old file)."""
+
+import hashlib
+import itertools
+import logging
+import math
+import struct
+
+from myscm.common.error import MySCMError
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"MYSCMDLT"
+FORMAT_VERSION = 1
+HEADER_STRUCT = struct.Struct("<8sB")  # magic, format version
+COPY_OP = b"C"
+COPY_STRUCT = struct.Struct("<QQ")  # offset and length of the old file's bytes
+LITERAL_OP = b"L"
+LITERAL_STRUCT = struct.Struct("<I")  # length of the literal data
+END_OP = b"E"
+END_STRUCT = struct.Struct("<Q32s")  # size and SHA256 digest of the new file
+
+MIN_BLOCK_SIZE = 1024
+MAX_BLOCK_SIZE = 128 * 1024
+MAX_LITERAL_SIZE = 1024 * 1024
+READ_SIZE = 1024 * 1024
+
+
+class BlockDeltaError(MySCMError):
+    pass
+
+
+def get_block_size(file_size):
+    """Return block size of the file's signature. Similarly to rsync it's
+       square root of the file size (rounded to multiple of 8), so both
+       number of the blocks and bytes resent for every changed block grow
+       slowly with the file size."""
+
+    block_size = int(math.sqrt(file_size)) & ~7
+    return min(max(block_size, MIN_BLOCK_SIZE), MAX_BLOCK_SIZE)
+
+
+def write_delta(old_path, new_path, delta_f, max_size=None):
+    """Write to the binary file object delta transforming old file to the new
+       one. Return number of the written bytes or None if delta would be
+       bigger than `max_size` bytes (then encoding is stopped early and
+       partially written delta should be discarded)."""
+
+    try:
+        with open(old_path, "rb") as old_f:
+            old_f.seek(0, 2)
+            block_size = get_block_size(old_f.tell())
+            old_f.seek(0)
+            signature = _get_signature(old_f, block_size)
+
+        with open(new_path, "rb") as new_f:
+            writer = _DeltaWriter(delta_f)
+
+            if not _encode(new_f, signature, block_size, writer, max_size):
+                return None
+
+            return writer.close()
+    except OSError as e:
+        m = "Failed to create delta of '{}' --> '{}'".format(old_path,
+                                                              new_path)
+        raise BlockDeltaError(m, e) from e
+
+
+def apply_delta(old_path, delta_f, new_f):
+    """Write to the binary file object `new_f` content of the new file
+       reconstructed from the old file and its delta read from the binary
+       file object `delta_f`."""
+
+    try:
+        with open(old_path, "rb") as old_f:
+            _decode(old_f, delta_f, new_f)
+    except (OSError, struct.error) as e:
+        m = "Failed to apply delta to '{}'".format(old_path)
+        raise BlockDeltaError(m, e) from e
+
+
+def _get_signature(old_f, block_size):
+    """Return dictionary mapping weak checksums of the old file's full blocks
+       to the dictionaries mapping their strong checksums to the offsets (of
+       the first block with given content)."""
+
+    signature = {}
+    offset = 0
+
+    while True:
+        block = old_f.read(block_size)
+
+        if len(block) < block_size:
+            break
+
+        strong_checksums = signature.setdefault(_get_weak_checksum(block), {})
+        strong_checksums.setdefault(_get_strong_checksum(block), offset)
+        offset += block_size
+
+    return signature
+
+
+def _get_weak_checksum(block):
+    """Return rsync's rolling checksum of the block. Sum of the prefix sums
+       equals to the sum of the bytes weighted by their distances from the
+       end of the block."""
+
+    a = sum(block) & 0xffff
+    b = sum(itertools.accumulate(block)) & 0xffff
+    return a | b << 16
+
+
+def _get_strong_checksum(block):
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+
+def _encode(new_f, signature, block_size, writer, max_size):
+    """Write delta's operations. Return False if delta exceeds given size."""
+
+    buf = b""
+    start = 0           # start of the window within buffer
+    literal_start = 0   # start of the not yet written literal data
+    eof = False
+
+    while True:
+        if start - literal_start >= MAX_LITERAL_SIZE:
+            writer.write_literal(buf[literal_start:start])
+            literal_start = start
+
+            if max_size is not None and writer.size > max_size:
+                return False
+
+        if len(buf) - start < block_size:
+            if eof:
+                break
+
+            data = new_f.read(READ_SIZE)
+            eof = not data
+            writer.update_new_file_digest(data)
+            buf = buf[literal_start:] + data
+            start -= literal_start
+            literal_start = 0
+            continue
+
+        if not signature:
+            start = len(buf)  # there are no blocks to copy
+            continue
+
+        offset = None
+        last_start = min(len(buf) - block_size, start + MAX_LITERAL_SIZE)
+        checksum = _get_weak_checksum(buf[start:start + block_size])
+        a, b = checksum & 0xffff, checksum >> 16
+
+        # Rolling the window by one byte removes the first byte from both
+        # sums and adds the next one (rsync's algorithm)
+
+        while True:
+            strong_checksums = signature.get(a | b << 16)
+
+            if strong_checksums is not None:
+                offset = strong_checksums.get(_get_strong_checksum(
+                                              buf[start:start + block_size]))
+                if offset is not None:
+                    break
+
+            if start >= last_start:
+                break
+
+            out_byte = buf[start]
+            a = (a - out_byte + buf[start + block_size]) & 0xffff
+            b = (b - block_size * out_byte + a) & 0xffff
+            start += 1
+
+        if offset is None:
+            start += 1
+            continue
+
+        writer.write_literal(buf[literal_start:start])
+        writer.write_copy(offset, block_size)
+        start += block_size
+        literal_start = start
+
+    writer.write_literal(buf[literal_start:])
+
+    return max_size is None or writer.size <= max_size
+
+
+def _decode(old_f, delta_f, new_f):
+    magic, version = HEADER_STRUCT.unpack(_read(delta_f, HEADER_STRUCT.size))
+
+    if magic != MAGIC or version != FORMAT_VERSION:
+        m = "Unsupported delta format (version {})".format(version)
+        raise BlockDeltaError(m)
+
+    new_hash = hashlib.sha256()
+    new_size = 0
+
+    while True:
+        op = _read(delta_f, 1)
+
+        if op == COPY_OP:
+            offset, length = COPY_STRUCT.unpack(_read(delta_f,
+                                                      COPY_STRUCT.size))
+            old_f.seek(offset)
+
+            while length:
+                data = old_f.read(min(length, READ_SIZE))
+
+                if not data:
+                    m = "Delta was created for other version of the file "\
+                        "(copied bytes are out of the file's range)"
+                    raise BlockDeltaError(m)
+
+                new_hash.update(data)
+                new_f.write(data)
+                length -= len(data)
+                new_size += len(data)
+        elif op == LITERAL_OP:
+            length, = LITERAL_STRUCT.unpack(_read(delta_f,
+                                                  LITERAL_STRUCT.size))
+            data = _read(delta_f, length)
+            new_hash.update(data)
+            new_f.write(data)
+            new_size += length
+        elif op == END_OP:
+            size, digest = END_STRUCT.unpack(_read(delta_f, END_STRUCT.size))
+            break
+        else:
+            raise BlockDeltaError("Malformed delta (unknown operation)")
+
+    if size != new_size or digest != new_hash.digest():
+        m = "Delta was created for other version of the file (result "\
+            "doesn't match expected size or SHA256 digest)"
+        raise BlockDeltaError(m)
+
+
+def _read(f, n):
+    data = f.read(n)
+
+    if len(data) != n:
+        raise BlockDeltaError("Malformed delta (unexpected end of file)")
+
+    return data
+
+
+class _DeltaWriter:
+    """Writer of the delta's operations. Copies of the adjacent blocks are
+       merged into single operation."""
+
+    def __init__(self, delta_f):
+        self.delta_f = delta_f
+        self.new_hash = hashlib.sha256()
+        self.new_size = 0
+        self.copy_offset = None
+        self.copy_length = 0
+        self.size = HEADER_STRUCT.size
+
+        delta_f.write(HEADER_STRUCT.pack(MAGIC, FORMAT_VERSION))
+
+    def update_new_file_digest(self, data):
+        self.new_hash.update(data)
+        self.new_size += len(data)
+
+    def write_copy(self, offset, length):
+        if self.copy_offset is not None and\
+           self.copy_offset + self.copy_length == offset:
+            self.copy_length += length
+            return
+
+        self._flush_copy()
+        self.copy_offset, self.copy_length = offset, length
+
+    def write_literal(self, data):
+        if not data:
+            return
+
+        self._flush_copy()
+        self._write(LITERAL_OP + LITERAL_STRUCT.pack(len(data)))
+        self._write(data)
+
+    def close(self):
+        """Write end of the delta. Return size of the whole delta."""
+
+        self._flush_copy()
+        self._write(END_OP + END_STRUCT.pack(self.new_size,
+                                             self.new_hash.digest()))
+        return self.size
+
+    def _flush_copy(self):
+        if self.copy_offset is not None:
+            self._write(COPY_OP + COPY_STRUCT.pack(self.copy_offset,
+                                                   self.copy_length))
+            self.copy_offset, self.copy_length = None, 0
+
+    def _write(self, data):
+        self.delta_f.write(data)
+        self.size += len(data)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import hashlib
+import json
+import logging
+import os
+
+from tempfile import NamedTemporaryFile
+
+from myscm.common.error import MySCMError
+
+logger = logging.getLogger(__name__)
+
+
+class ChunkListError(MySCMError):
+    pass
+
+
+class ChunkList:
+    """List of the SHA-256 digests of the fixed size chunks of the system
+       image, published next to the system image (with `.chunks` extension),
+       so chunks of the same system image downloaded concurrently from many
+       peers are verified one by one (and chunk served corrupted by any of the
+       peers is downloaded again from the other ones). Chunk list identifies
+       the content of the system image regardless of which peer it's copied
+       from (see `get_id()`)."""
+
+    CHUNK_LIST_EXT = ".chunks"
+    FORMAT_VERSION = 1
+    CHUNK_SIZE = 8 * 1024 * 1024
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self, size, chunk_size, digests):
+        self.size = size
+        self.chunk_size = chunk_size
+        self.digests = digests  # hex digest of every chunk
+
+    @classmethod
+    def create(cls, path, chunk_size=CHUNK_SIZE):
+        """Return chunk list of the given file."""
+
+        digests = []
+        size = 0
+
+        try:
+            with open(path, "rb") as f:
+                while True:
+                    chunk_hash = hashlib.sha256()
+                    remaining = chunk_size
+
+                    while remaining:
+                        data = f.read(min(remaining, cls.READ_SIZE))
+
+                        if not data:
+                            break
+
+                        chunk_hash.update(data)
+                        remaining -= len(data)
+
+                    if remaining == chunk_size:
+                        break
+
+                    digests.append(chunk_hash.hexdigest())
+                    size += chunk_size - remaining
+        except OSError as e:
+            m = "Failed to compute chunk list of '{}'".format(path)
+            raise ChunkListError(m, e) from e
+
+        return cls(size, chunk_size, digests)
+
+    @classmethod
+    def loads(cls, data):
+        """Return chunk list read from the bytes written by `dumps()`."""
+
+        try:
+            chunk_list = json.loads(data.decode())
+            size = chunk_list["size"]
+            chunk_size = chunk_list["chunk_size"]
+            digests = chunk_list["digests"]
+
+            if chunk_list["format_version"] != cls.FORMAT_VERSION:
+                m = "Unsupported chunk list format version {}".format(
+                        chunk_list["format_version"])
+                raise ChunkListError(m)
+        except (ValueError, KeyError, TypeError) as e:
+            raise ChunkListError("Malformed chunk list", e) from e
+
+        if not isinstance(size, int) or not isinstance(chunk_size, int) or\
+           chunk_size <= 0 or len(digests) != -(-size // chunk_size):
+            raise ChunkListError("Malformed chunk list")
+
+        return cls(size, chunk_size, digests)
+
+    def dumps(self):
+        chunk_list = {
+            "format_version": self.FORMAT_VERSION,
+            "size": self.size,
+            "chunk_size": self.chunk_size,
+            "digests": self.digests
+        }
+
+        return json.dumps(chunk_list, sort_keys=True).encode()
+
+    def save(self, path):
+        """Atomically save chunk list in the given file."""
+
+        try:
+            with NamedTemporaryFile(mode="wb", prefix=".",
+                                    dir=os.path.dirname(path) or ".",
+                                    delete=False) as chunk_list_f:
+                try:
+                    chunk_list_f.write(self.dumps())
+                except BaseException:
+                    with contextlib.suppress(OSError):
+                        os.remove(chunk_list_f.name)
+                    raise
+
+            os.chmod(chunk_list_f.name, 0o644)
+            os.replace(chunk_list_f.name, path)
+        except OSError as e:
+            m = "Failed to save chunk list '{}'".format(path)
+            raise ChunkListError(m, e) from e
+
+    def get_id(self):
+        """Return SHA-256 hex digest of the chunk list."""
+
+        return hashlib.sha256(self.dumps()).hexdigest()
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import contextlib
 import logging
 import subprocess
 
@@ -18,6 +19,14 @@ def run_check_cmd(aide_config_path, check_exitcode=True,
     return long_run_cmd(cmd, check_exitcode, stdout_opt, stderr_opt, m)
 
 
+def stream_check_cmd(aide_config_path, max_exitcode=0):
+    """Run AIDE --check and stream its output (see `stream_cmd_output()`)."""
+
+    cmd = ["aide", "--check", "-c", aide_config_path]
+    m = "to check if aide.db is up-to-date. It may take some time to finish..."
+    return stream_cmd_output(cmd, max_exitcode, m)
+
+
 def long_run_cmd(cmd, check_exitcode=True, stdout_opt=subprocess.PIPE,
                  stderr_opt=subprocess.STDOUT, suffix_msg=None,
                  debug_log=False):
@@ -55,3 +64,56 @@ def run_cmd(cmd, check_exitcode=True, stdout_opt=subprocess.PIPE,
         logger.warning(m)
 
     return completed_proc
+
+
+@contextlib.contextmanager
+def stream_cmd_output(cmd, max_exitcode=0, suffix_msg=None):
+    """Run specified command and yield iterator over lines of its output
+       (stdout and stderr) that can be consumed while command is still running,
+       without saving the output anywhere. Output not read by the caller is
+       discarded when leaving the context, then command's exit code is checked
+       (exit codes up to `max_exitcode` are not errors). Command is killed if
+       the caller is interrupted."""
+
+    cmd_str = " ".join(cmd)
+    suffix_msg = " {}".format(suffix_msg) if suffix_msg else "."
+    logger.info("Running '{}' command{}".format(cmd_str, suffix_msg))
+
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                universal_newlines=True)
+    except Exception as e:
+        m = "Failed to run '{}' command - check if you have installed "\
+            "referred software".format(cmd_str)
+        raise CommandLineError(m, e) from e
+
+    try:
+        yield proc.stdout
+    except Exception:
+        # Command's error (if any) is more informative than the caller's one
+        _wait_for_streamed_cmd(proc, cmd_str, max_exitcode)
+        raise
+    except BaseException:  # e.g. KeyboardInterrupt
+        proc.kill()
+        proc.stdout.close()
+        proc.wait()
+        raise
+
+    _wait_for_streamed_cmd(proc, cmd_str, max_exitcode)
+
+
+def _wait_for_streamed_cmd(proc, cmd_str, max_exitcode):
+    """Discard output not read yet (so command isn't blocked on full pipe),
+       wait for the command to finish and check its exit code."""
+
+    with proc.stdout:
+        for _ in proc.stdout:
+            pass
+
+    returncode = proc.wait()
+
+    if returncode < 0 or returncode > max_exitcode:
+        m = "Failed to run '{}' command - erroneous exit code {}".format(
+                cmd_str, returncode)
+        raise CommandLineError(m)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from myscm.common.error import MySCMError
+
+logger = logging.getLogger(__name__)
+
+
+class FileHasherError(MySCMError):
+    pass
+
+
+class FileHasher:
+    """Computer of the files' digests (e.g. MD5 and SHA1 at once). Every file
+       is read only once - chunks of the file are read into reused buffer and
+       passed to all of the requested hash functions. Many files are hashed in
+       parallel by the pool of threads (hashlib releases GIL while hashing
+       large chunks of data)."""
+
+    BUF_SIZE = 1024 * 1024  # read in 1MB chunks
+
+    def __init__(self, hash_names, threads=1):
+        """Constructor initialized by the list of hashlib's hash names (e.g.
+           ["md5", "sha1"]) and number of the hashing threads."""
+
+        self.hash_names = list(hash_names)
+        self.threads = max(1, threads or 1)
+        self.thread_data = threading.local()
+
+        for hash_name in self.hash_names:
+            if hash_name not in hashlib.algorithms_available:
+                m = "Unsupported hash function '{}'".format(hash_name)
+                raise FileHasherError(m)
+
+    def get_file_digests(self, path):
+        """Return dictionary mapping hash names to the hex digests of the
+           given file."""
+
+        hashes = [hashlib.new(n) for n in self.hash_names]
+        buf = self._get_thread_buffer()
+        buf_view = memoryview(buf)
+
+        with open(path, "rb", buffering=0) as f:
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                chunk = buf_view[:n]
+                for h in hashes:
+                    h.update(chunk)
+
+        return {n: h.hexdigest() for n, h in zip(self.hash_names, hashes)}
+
+    def iterate_files_digests(self, paths):
+        """Generator yielding (path, digests, error) tuples in the order of the
+           given paths, where digests is dictionary returned by
+           `get_file_digests()` or None if hashing failed with OSError given as
+           error."""
+
+        if self.threads == 1 or len(paths) < 2:
+            for path in paths:
+                yield (path,) + self._get_file_digests_or_error(path)
+            return
+
+        logger.debug("Hashing {} files using {} threads.".format(
+                     len(paths), self.threads))
+
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            results = executor.map(self._get_file_digests_or_error, paths)
+
+            for path, (digests, error) in zip(paths, results):
+                yield path, digests, error
+
+    def _get_file_digests_or_error(self, path):
+        try:
+            return self.get_file_digests(path), None
+        except OSError as e:
+            return None, e
+
+    def _get_thread_buffer(self):
+        buf = getattr(self.thread_data, "buf", None)
+
+        if buf is None:
+            buf = bytearray(self.BUF_SIZE)
+            self.thread_data.buf = buf
+
+        return buf
@@ -231,6 +231,45 @@ class VerbosityConfigOption(GeneralConfigOption):
         return lvl
 
 
+class WorkerThreadsConfigOption(GeneralConfigOption):
+    """Configuration option read from configuration file and/or CLI specifying
+       number of the threads used for I/O heavy tasks (e.g. computing
+       checksums of many files)."""
+
+    DEFAULT_WORKER_THREADS = os.cpu_count() or 1
+    MIN_WORKER_THREADS = 1
+
+    def __init__(self, threads=None):
+        super().__init__(
+                "WorkerThreads",
+                threads or self.DEFAULT_WORKER_THREADS,
+                self._assert_threads_valid,
+                False,
+                "--threads", metavar="N",
+                type=self._assert_threads_valid,
+                help="number of the threads used for I/O heavy tasks like "
+                     "computing checksums of the files (default value: "
+                     "number of CPUs, i.e. {})".format(
+                        self.DEFAULT_WORKER_THREADS))
+
+    def _assert_threads_valid(self, threads_string):
+        threads = None
+
+        try:
+            threads = int(threads_string)
+        except ValueError:
+            m = "Given number of threads is not integer (given value: '{}')"\
+                .format(threads_string)
+            raise ParserError(m)
+
+        if threads < self.MIN_WORKER_THREADS:
+            m = "Number of threads must be an integer not lower than {} "\
+                "(given value: {})".format(self.MIN_WORKER_THREADS, threads)
+            raise ParserError(m)
+
+        return threads
+
+
 class ConfigCheckConfigOption(CommandLineFlagConfigOption):
     """Configuration option read from CLI specifying to check application
        configuration and exit."""
@@ -342,6 +381,7 @@ class ConfigParser:
             PIDFileConfigOption(),
             LogFileConfigOption(),
             VerbosityConfigOption(),
+            WorkerThreadsConfigOption(),
             ConfigCheckConfigOption(),
             SSLCertPublicKeyConfigOption(),
             VerifyFileConfigOption()
@@ -22,12 +22,24 @@ class SignatureManager:
     SSL_CERT_DIGEST_TYPE = "sha256"
     SIGNATURE_EXT = ".sig"
 
+    def __init__(self):
+        self.priv_keys = {}  # loaded (decrypted) private keys by their paths
+
     def ssl_sign(self, input_path, output_path, priv_key_path):
-        priv_key_obj = self._create_priv_key_openssl_obj(input_path,
-                                                         priv_key_path)
+        """Sign given file. Password protecting the private key is asked only
+           once per `SignatureManager` instance, so many files can be signed
+           without retyping it."""
+
+        priv_key_obj = self.priv_keys.get(priv_key_path)
+
+        if not priv_key_obj:
+            priv_key_obj = self._create_priv_key_openssl_obj(input_path,
+                                                             priv_key_path)
         if not priv_key_obj:
             return None
 
+        self.priv_keys[priv_key_path] = priv_key_obj
+
         signature = None
 
         with open(input_path, "rb") as img_f:
@@ -0,0 +1,898 @@
+# -*- coding: utf-8 -*-
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import hashlib
+import io
+import json
+import logging
+import lzma
+import os
+import struct
+import tarfile
+import zlib
+
+from myscm.common.error import MySCMError
+
+logger = logging.getLogger(__name__)
+
+
+class SysImgArchiveError(MySCMError):
+    pass
+
+
+class NotIndexedSysImgArchiveError(SysImgArchiveError):
+    pass
+
+
+class _GzipCodec:
+    """gzip compression - system image is a regular tar.gz archive (readable
+       also by the clients not aware of the compressed blocks)."""
+
+    NAME = "gzip"
+    DEFAULT_LEVEL = 9
+    GZIP_MAGIC = b"\x1f\x8b"
+    GZIP_DEFLATE_METHOD = 8
+    GZIP_FEXTRA_FLAG = 4
+    GZIP_MAX_COMPRESSION_XFL = 2
+    GZIP_UNKNOWN_OS = 255
+
+    def __init__(self, level=None):
+        self.level = self.DEFAULT_LEVEL if level is None else level
+        self.errors = (zlib.error,)  # raised while decompressing
+
+    def compress(self, data, extra=b""):
+        """Return data compressed as single gzip member (with optional FEXTRA
+           header field)."""
+
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                      -zlib.MAX_WBITS)
+
+        return b"".join([self.get_gzip_header(extra),
+                         compressor.compress(data), compressor.flush(),
+                         struct.pack("<II", zlib.crc32(data),
+                                     len(data) & 0xffffffff)])
+
+    def decompress(self, data):
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+    @classmethod
+    def get_gzip_header(cls, extra=b""):
+        flags = cls.GZIP_FEXTRA_FLAG if extra else 0
+        header = cls.GZIP_MAGIC + struct.pack(
+            "<BBIBB", cls.GZIP_DEFLATE_METHOD, flags, 0,
+            cls.GZIP_MAX_COMPRESSION_XFL, cls.GZIP_UNKNOWN_OS)
+
+        if extra:
+            header += struct.pack("<H", len(extra)) + extra
+
+        return header
+
+
+class _XzCodec:
+    """xz (LZMA2) compression - better ratio than gzip, but slower."""
+
+    NAME = "xz"
+    DEFAULT_LEVEL = 6  # higher presets only enlarge dictionary beyond blocks
+
+    def __init__(self, level=None):
+        self.level = self.DEFAULT_LEVEL if level is None else level
+        self.errors = (lzma.LZMAError,)
+
+    def compress(self, data):
+        return lzma.compress(data, preset=self.level)
+
+    def decompress(self, data):
+        return lzma.decompress(data, format=lzma.FORMAT_XZ)
+
+
+class _ZstdCodec:
+    """Zstandard compression - ratio close to xz and the fastest
+       decompression. Requires optional 'zstandard' Python module."""
+
+    NAME = "zstd"
+    DEFAULT_LEVEL = 19
+
+    def __init__(self, level=None):
+        try:
+            import zstandard
+        except ImportError as e:
+            m = "'{}' compression of the system image requires 'zstandard' "\
+                "Python module".format(self.NAME)
+            raise SysImgArchiveError(m, e) from e
+
+        self.zstandard = zstandard
+        self.level = self.DEFAULT_LEVEL if level is None else level
+        self.errors = (zstandard.ZstdError,)
+
+    def compress(self, data):
+        # Compressor is not thread-safe, so it's not shared between blocks
+        return self.zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress(self, data):
+        return self.zstandard.ZstdDecompressor().decompress(data)
+
+
+SYS_IMG_CODECS = [_GzipCodec.NAME, _XzCodec.NAME, _ZstdCodec.NAME]
+DEFAULT_SYS_IMG_CODEC = _GzipCodec.NAME
+
+
+def get_codec(name, level=None):
+    """Return compression codec of the system image with given name."""
+
+    codecs = {c.NAME: c for c in [_GzipCodec, _XzCodec, _ZstdCodec]}
+
+    if name not in codecs:
+        m = "Unsupported compression '{}' of the system image (supported: "\
+            "'{}')".format(name, "', '".join(SYS_IMG_CODECS))
+        raise SysImgArchiveError(m)
+
+    return codecs[name](level)
+
+
+class _CompressedMember:
+    """Location of the archived file compressed as series of blocks within
+       the archive file. It's known once all of its blocks are written."""
+
+    def __init__(self, codec, extra=b""):
+        self.codec = codec
+        self.extra = extra  # FEXTRA field of the 1st block (gzip only)
+        self.submitted_blocks = 0
+        self.offset = None
+        self.length = 0
+        self.hash = hashlib.sha256()
+        self.blocks = []  # [compressed, uncompressed] sizes of the blocks
+
+
+class _BlockCompressingWriter:
+    """File-like object (used as TarFile's fileobj) that compresses every
+       archived file separately, as series of independently compressed blocks
+       (gzip members, xz streams or zstd frames). Concatenated blocks are
+       still a valid compressed stream, so the image compressed with gzip can
+       be read by any gzip aware tool, but each of the files (or even blocks)
+       can be decompressed on its own as well. Blocks are compressed by the
+       pool of threads (if there are more than one) and written in order."""
+
+    BLOCK_SIZE = 4 * 1024 * 1024  # of the uncompressed data
+
+    def __init__(self, fileobj, codec, threads=1):
+        self.fileobj = fileobj
+        self.codec = codec
+        self.position = 0  # position in the uncompressed tar stream
+        self.member = None
+        self.buffer = bytearray()
+        self.pending = collections.deque()  # (member, size, future, blob)
+        self.executor = None
+        self.max_pending = 0
+        self.blob = None  # captures compressed blocks (see `begin_blob()`)
+        self.blobs = []  # blobs not committed yet
+
+        if threads > 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+            self.max_pending = 2 * threads
+
+    def begin_member(self, codec=None, extra=b""):
+        if self.member:
+            self.end_member()
+
+        self.member = _CompressedMember(codec or self.codec, extra)
+
+    def end_member(self):
+        """Finish current member and return its `_CompressedMember`, which is
+           complete after `flush()`."""
+
+        member = self.member
+
+        if not member:
+            return None
+
+        if self.buffer:
+            self._submit_block()
+
+        self.member = None
+
+        return member
+
+    def begin_blob(self, blob):
+        """Start capturing compressed blocks of the data written until
+           `end_blob()` into the blob writer of the `BlobStore`. Data is
+           compressed starting with new block, so captured blocks can be
+           copied into other archives."""
+
+        if self.buffer:
+            self._submit_block()
+
+        self.blob = blob
+        self.blobs.append(blob)
+
+    def end_blob(self):
+        """Stop capturing compressed blocks. Blob is committed once all of
+           its blocks are written."""
+
+        if self.buffer:
+            self._submit_block()
+
+        self.pending.append((None, 0, None, self.blob))
+        self.blob = None
+        self._write_exceeding_blocks()
+
+    def write_compressed_blocks(self, blocks):
+        """Write already compressed (e.g. cached in the `BlobStore`) blocks
+           given as (compressed data, uncompressed size) tuples."""
+
+        if self.buffer:
+            self._submit_block()
+
+        for data, size in blocks:
+            future = concurrent.futures.Future()
+            future.set_result(data)
+            self.member.submitted_blocks += 1
+            self.position += size
+            self.pending.append((self.member, size, future, None))
+            self._write_exceeding_blocks()
+
+    def write(self, data):
+        if not self.member:
+            self.begin_member()
+
+        if self.blob:
+            self.blob.update(data)
+
+        self.buffer += data
+        self.position += len(data)
+
+        if len(self.buffer) >= self.BLOCK_SIZE:
+            self._submit_block()
+
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        """Write all of the pending blocks."""
+
+        while self.pending:
+            self._write_next_block()
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+
+        for blob in self.blobs:  # not committed, e.g. after error
+            blob.abort()
+
+        self.blobs.clear()
+
+    def _submit_block(self):
+        member = self.member
+        data = bytes(self.buffer)
+        args = (data, member.extra) if member.extra and\
+            not member.submitted_blocks else (data,)
+        self.buffer.clear()
+        member.submitted_blocks += 1
+
+        if self.executor:
+            future = self.executor.submit(member.codec.compress, *args)
+        else:
+            future = concurrent.futures.Future()
+            future.set_result(member.codec.compress(*args))
+
+        self.pending.append((member, len(data), future, self.blob))
+        self._write_exceeding_blocks()
+
+    def _write_exceeding_blocks(self):
+        while len(self.pending) > self.max_pending:
+            self._write_next_block()
+
+    def _write_next_block(self):
+        member, size, future, blob = self.pending.popleft()
+
+        if member is None:  # all of the blob's blocks were written
+            blob.commit()
+            self.blobs.remove(blob)
+            return
+
+        data = future.result()
+
+        if member.offset is None:
+            member.offset = self.fileobj.tell()
+
+        member.hash.update(data)
+        member.length += len(data)
+        member.blocks.append([len(data), size])
+        self.fileobj.write(data)
+
+        if blob:
+            blob.write_block(data, size)
+
+
+class IndexedSysImgWriter(tarfile.TarFile):
+    """Writer of the indexed system image. Image is a tar archive, but every
+       archived file is compressed separately (as series of independently
+       compressed blocks, see `_BlockCompressingWriter`) and the archive ends
+       with the index member (mapping in-archive paths to the offsets,
+       lengths, blocks and SHA-256 hashes of the compressed members) followed
+       by the gzip member holding tar's end-of-archive blocks, whose gzip
+       header points to the index (see `IndexedSysImg.TRAILER_SUBFIELD_ID`).
+
+       Index and trailer are always compressed with gzip. If other members
+       are compressed with gzip as well, then image is a regular tar.gz
+       archive (version 2), otherwise it can be read with `IndexedSysImg`
+       only (version 3).
+
+       Optional blob store (see `myscm.server.blobstore.BlobStore`) caches
+       compressed content of the big regular files, so file already archived
+       in other image is copied from the store instead of being compressed
+       again. Image stays self-contained and its format is not changed."""
+
+    def __init__(self, name, compresslevel=None,
+                 codec=DEFAULT_SYS_IMG_CODEC, threads=1, blob_store=None,
+                 **kwargs):
+        self.codec = get_codec(codec, compresslevel)
+        self.blob_store = blob_store
+        self.index_codec = _GzipCodec()
+        self.archive_file = open(name, "wb")
+        self.members_writer = _BlockCompressingWriter(self.archive_file,
+                                                      self.codec, threads)
+        self.index = []  # (TarInfo, _CompressedMember) tuples
+
+        try:
+            super().__init__(name, "w", fileobj=self.members_writer, **kwargs)
+        except:
+            self._close_archive_file()
+            raise
+
+    def addfile(self, tarinfo, fileobj=None):
+        self.members_writer.begin_member()
+
+        if self._check_if_blob_file(tarinfo, fileobj):
+            self._add_blob_file(tarinfo, fileobj)
+        else:
+            super().addfile(tarinfo, fileobj)
+
+        member = self.members_writer.end_member()
+        self.index.append((copy.copy(tarinfo), member))
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            self.members_writer.flush()
+            index_offset, index_length = self._add_index()
+            trailer = IndexedSysImg.get_trailer(
+                    index_offset, index_length,
+                    IndexedSysImg.get_format_version(self.codec.NAME))
+            self.members_writer.begin_member(self.index_codec, trailer)
+            super().close()  # writes end-of-archive blocks
+            self.members_writer.end_member()
+            self.members_writer.flush()
+        finally:
+            self._close_archive_file()
+
+    def __exit__(self, type, value, traceback):
+        super().__exit__(type, value, traceback)
+        self._close_archive_file()
+
+    def _check_if_blob_file(self, tarinfo, fileobj):
+        return self.blob_store is not None and fileobj is not None and\
+            tarinfo.isreg() and\
+            tarinfo.size >= self.blob_store.MIN_FILE_SIZE and\
+            fileobj.seekable()
+
+    def _add_blob_file(self, tarinfo, fileobj):
+        """Add file the way `TarFile.addfile()` does, but file's content
+           (padded to the tar's block size) is compressed separately from the
+           header, so its compressed blocks can be cached in the blob store or
+           copied from it."""
+
+        self._check("awx")
+        tarinfo = copy.copy(tarinfo)
+        key = self.blob_store.get_key(fileobj, tarinfo.size)
+        blob = self.blob_store.get(self.codec, key)
+        blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+
+        buf = tarinfo.tobuf(self.format, self.encoding, self.errors)
+        self.members_writer.write(buf)
+        self.offset += len(buf)
+
+        if blob:
+            self.members_writer.write_compressed_blocks(blob.iterate_blocks())
+        else:
+            self.members_writer.begin_blob(self.blob_store.create(self.codec,
+                                                                  key))
+            tarfile.copyfileobj(fileobj, self.members_writer, tarinfo.size,
+                                bufsize=self.copybufsize)
+
+            if remainder > 0:
+                self.members_writer.write(
+                        tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+
+            self.members_writer.end_blob()
+
+        if remainder > 0:
+            blocks += 1
+
+        self.offset += blocks * tarfile.BLOCKSIZE
+        self.members.append(tarinfo)
+
+    def _close_archive_file(self):
+        self.members_writer.shutdown()
+
+        if not self.archive_file.closed:
+            self.archive_file.close()
+
+    def _add_index(self):
+        index = {
+            "format_version": IndexedSysImg.get_format_version(
+                                                        self.codec.NAME),
+            "codec": self.codec.NAME,
+            "members": [IndexedSysImg.get_index_entry(
+                            tarinfo, m.offset, m.length, m.hash.hexdigest(),
+                            m.blocks) for tarinfo, m in self.index]
+        }
+        index_data = json.dumps(index, separators=(",", ":")).encode("utf-8")
+        tarinfo = tarfile.TarInfo(IndexedSysImg.INDEX_MEMBER_NAME)
+        tarinfo.size = len(index_data)
+
+        # Index member is not indexed, so call base class addfile() directly.
+
+        self.members_writer.begin_member(self.index_codec)
+        super().addfile(tarinfo, io.BytesIO(index_data))
+        member = self.members_writer.end_member()
+        self.members_writer.flush()
+
+        return member.offset, member.length
+
+
+class _DecompressedBlocksReader(io.RawIOBase):
+    """Read-only, seekable raw stream of the decompressed content of the
+       members (given as index entries) of the archive file compressed as
+       series of blocks. Blocks following currently read one are read and
+       decompressed ahead by the pool of threads (if there are more than one).
+       Optionally hashes of the compressed members are verified once all of
+       their blocks are read in order."""
+
+    def __init__(self, img_path, fd, codec, index_entries, threads=1,
+                 verify_hashes=False):
+        self.img_path = img_path
+        self.fd = fd
+        self.codec = codec
+        self.verify_hashes = verify_hashes
+        self.blocks = []  # (offset, compressed size, uncompressed size)
+        self.blocks_starts = []  # positions in the decompressed stream
+        self.members_starts = set()  # indexes of the 1st blocks of members
+        self.members_ends = {}  # index of the last block: index entry
+        self.size = 0
+
+        for index_entry in index_entries:
+            offset = index_entry["offset"]
+            self.members_starts.add(len(self.blocks))
+
+            for length, size in index_entry["blocks"]:
+                self.blocks.append((offset, length, size))
+                self.blocks_starts.append(self.size)
+                offset += length
+                self.size += size
+
+            self.members_ends[len(self.blocks) - 1] = index_entry
+
+        self.position = 0
+        self.block_idx = None
+        self.block_data = b""
+        self.readahead = collections.deque()  # (block index, future) tuples
+        self.next_fetched_idx = 0
+        self.member_hash = None
+        self.executor = None
+        self.readahead_len = 1
+
+        if threads > 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+            self.readahead_len = 2 * threads
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position,
+                io.SEEK_END: self.size}[whence]
+        self.position = max(0, base + offset)
+
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buf):
+        if self.position >= self.size:
+            return 0
+
+        i = bisect.bisect_right(self.blocks_starts, self.position) - 1
+
+        if i != self.block_idx:
+            self.block_data = memoryview(self._get_block(i))
+            self.block_idx = i
+
+        start = self.position - self.blocks_starts[i]
+        data = self.block_data[start:start + len(buf)]
+        buf[:len(data)] = data
+        self.position += len(data)
+
+        return len(data)
+
+    def close(self):
+        if self.executor:
+            for _, future in self.readahead:
+                future.cancel()
+
+            self.executor.shutdown()
+            self.executor = None
+
+        self.readahead.clear()
+        super().close()
+
+    def _get_block(self, i):
+        if not self.readahead or self.readahead[0][0] != i:
+            self._reset_readahead(i)
+
+        _, future = self.readahead.popleft()
+        self._fill_readahead()
+        m = "Block of the system image '{}' at offset {} is corrupted".format(
+                self.img_path, self.blocks[i][0])
+
+        try:
+            data = future.result()
+        except self.codec.errors as e:
+            raise SysImgArchiveError(m, e) from e
+
+        if len(data) != self.blocks[i][2]:
+            m += " (unexpected size after decompression)"
+            raise SysImgArchiveError(m)
+
+        return data
+
+    def _reset_readahead(self, i):
+        """Start reading ahead from the i-th block (e.g. after seeking)."""
+
+        for _, future in self.readahead:
+            future.cancel()
+
+        self.readahead.clear()
+        self.next_fetched_idx = i
+        self.member_hash = None  # can't verify member's hash read partially
+        self._fill_readahead()
+
+    def _fill_readahead(self):
+        while len(self.readahead) < self.readahead_len and\
+              self.next_fetched_idx < len(self.blocks):
+            i = self.next_fetched_idx
+            data = self._read_compressed_block(i)
+
+            if self.executor:
+                future = self.executor.submit(self.codec.decompress, data)
+            else:
+                future = concurrent.futures.Future()
+
+                try:
+                    future.set_result(self.codec.decompress(data))
+                except self.codec.errors as e:  # raised by `_get_block()`
+                    future.set_exception(e)
+
+            self.readahead.append((i, future))
+            self.next_fetched_idx += 1
+
+    def _read_compressed_block(self, i):
+        offset, length, _ = self.blocks[i]
+        data = os.pread(self.fd, length, offset)
+
+        if len(data) != length:
+            m = "Unexpected end of the system image '{}'".format(
+                    self.img_path)
+            raise SysImgArchiveError(m)
+
+        if not self.verify_hashes:
+            return data
+
+        if i in self.members_starts:
+            self.member_hash = hashlib.sha256()
+
+        if self.member_hash is not None:
+            self.member_hash.update(data)
+
+        index_entry = self.members_ends.get(i)
+
+        if index_entry and self.member_hash is not None:
+            if self.member_hash.hexdigest() != index_entry["sha256"]:
+                m = "Member '{}' of the system image '{}' is corrupted "\
+                    "(SHA-256 checksum mismatch)".format(index_entry["name"],
+                                                         self.img_path)
+                raise SysImgArchiveError(m)
+
+            self.member_hash = None
+
+        return data
+
+
+class IndexedSysImg:
+    """Reader of the indexed (version 2 or 3) system image created with
+       `IndexedSysImgWriter`. Provides subset of the read-only TarFile API
+       (`getmember()`, `getmembers()`, `getnames()`, `extractfile()`,
+       `extractall()`), but any member is accessed in O(1) - only its own
+       compressed blocks are read and decompressed. Compression codec is read
+       from the index. Whole image is read with `open_tar()`, which
+       decompresses blocks with the pool of threads."""
+
+    FORMAT_VERSION = 2  # images compressed with gzip
+    CODEC_FORMAT_VERSION = 3  # images compressed with other codecs
+    SUPPORTED_FORMAT_VERSIONS = {FORMAT_VERSION, CODEC_FORMAT_VERSION}
+    INDEX_MEMBER_NAME = ".myscm-img-index.json"
+    TRAILER_SUBFIELD_ID = b"MI"
+    TRAILER_STRUCT = struct.Struct("<BQQ")  # version, index offset, length
+    TRAILER_MAX_SEARCH_LEN = 4096
+    READ_CHUNK_SIZE = 1024 * 1024
+    TARINFO_ATTRS = ["name", "size", "mode", "uid", "gid", "mtime", "type",
+                     "linkname", "uname", "gname", "devmajor", "devminor"]
+
+    def __init__(self, path, threads=1):
+        self.name = os.path.abspath(path)
+        self.threads = threads
+        self.fd = None
+        self.codec = None
+        self.members = {}
+        self.index = {}
+
+        try:
+            self.fd = os.open(path, os.O_RDONLY)
+            self._load_index()
+        except OSError as e:
+            self.close()
+            m = "Failed to read system image '{}'".format(path)
+            raise SysImgArchiveError(m, e) from e
+        except:
+            self.close()
+            raise
+
+    def getmember(self, name):
+        member = self.members.get(name.rstrip("/"))
+
+        if member is None:
+            raise KeyError("filename '{}' not found".format(name))
+
+        return member
+
+    def getmembers(self):
+        return list(self.members.values())
+
+    def getnames(self):
+        return list(self.members.keys())
+
+    def extractfile(self, member):
+        """Return binary file object with the content of the given member
+           (name or TarInfo) or None if it's not a regular file nor a hard
+           link."""
+
+        if not isinstance(member, tarfile.TarInfo):
+            member = self.getmember(member)
+
+        if member.islnk():
+            return self.extractfile(member.linkname)
+
+        if not member.isreg():
+            return None
+
+        index_entry = self.index[member.name]
+        self._assert_member_hash_valid(member.name, index_entry)
+
+        member_stream = io.BufferedReader(_DecompressedBlocksReader(
+                            self.name, self.fd, self.codec, [index_entry]),
+                            self.READ_CHUNK_SIZE)
+        member_tar = tarfile.open(fileobj=member_stream, mode="r:")
+
+        return member_tar.extractfile(member_tar.next())
+
+    def extractall(self, path=".", members=None):
+        """Extract all members (but the index) with single sequential pass
+           over the archive."""
+
+        if members is None:
+            members = self.getmembers()
+
+        names = {m.name for m in members}
+
+        with self.open_tar() as tar_f:
+            tar_f.extractall(path, members=(m for m in tar_f
+                                            if m.name in names))
+
+    @contextlib.contextmanager
+    def open_tar(self):
+        """Yield TarFile reading the image in a single sequential pass. Blocks
+           are decompressed ahead by the pool of threads and hashes of the
+           members are verified. Index member is skipped."""
+
+        index_entries = list(self.index.values())
+
+        with _DecompressedBlocksReader(self.name, self.fd, self.codec,
+                                       index_entries, self.threads,
+                                       True) as tar_stream:
+            buffered_stream = io.BufferedReader(tar_stream,
+                                                self.READ_CHUNK_SIZE)
+
+            with tarfile.open(fileobj=buffered_stream, mode="r:") as tar_f:
+                yield tar_f
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _load_index(self):
+        index_offset, index_length = self._read_trailer()
+        index_data = os.pread(self.fd, index_length, index_offset)
+
+        try:
+            with tarfile.open(fileobj=io.BytesIO(index_data), mode="r:gz")\
+                    as index_tar_f:
+                with index_tar_f.extractfile(self.INDEX_MEMBER_NAME) as f:
+                    index = json.loads(f.read().decode("utf-8"))
+        except (tarfile.TarError, KeyError, ValueError, EOFError, OSError) as e:
+            m = "Malformed index of the system image '{}'".format(self.name)
+            raise SysImgArchiveError(m, e) from e
+
+        if index.get("format_version") not in self.SUPPORTED_FORMAT_VERSIONS:
+            m = "Unsupported format version of the system image '{}'".format(
+                    self.name)
+            raise SysImgArchiveError(m)
+
+        if not all("blocks" in e for e in index.get("members", [])):
+            m = "Malformed index of the system image '{}' (members not "\
+                "split to blocks)".format(self.name)
+            raise SysImgArchiveError(m)
+
+        self.codec = get_codec(index.get("codec", DEFAULT_SYS_IMG_CODEC))
+
+        for index_entry in index["members"]:
+            member = self._get_tarinfo(index_entry)
+            self.members[member.name] = member
+            self.index[member.name] = index_entry
+
+        logger.debug("Loaded index of {} members of the system image '{}'."
+                     .format(len(self.members), self.name))
+
+    def _read_trailer(self):
+        """Find the last gzip member of the image and read index's offset and
+           length from its FEXTRA header field."""
+
+        file_size = os.fstat(self.fd).st_size
+        search_len = min(file_size, self.TRAILER_MAX_SEARCH_LEN)
+        tail = os.pread(self.fd, search_len, file_size - search_len)
+        header = _GzipCodec.get_gzip_header(self.get_trailer(0, 0))
+        header_prefix = header[:4]  # magic, compression method and flags
+        pos = tail.rfind(header_prefix)
+
+        while pos >= 0:
+            trailer = self._parse_trailer(tail[pos:])
+
+            if trailer:
+                return trailer
+
+            pos = tail.rfind(header_prefix, 0, pos)
+
+        m = "'{}' is not an indexed system image".format(self.name)
+        raise NotIndexedSysImgArchiveError(m)
+
+    def _parse_trailer(self, data):
+        header_len = len(_GzipCodec.get_gzip_header())
+        extra_len = 4 + self.TRAILER_STRUCT.size
+        extra = data[header_len + 2:header_len + 2 + extra_len]
+
+        if len(extra) != extra_len or\
+           extra[:2] != self.TRAILER_SUBFIELD_ID or\
+           struct.unpack("<H", extra[2:4])[0] != self.TRAILER_STRUCT.size:
+            return None
+
+        version, index_offset, index_length = self.TRAILER_STRUCT.unpack(
+                                                                extra[4:])
+
+        # Make sure it's really the last gzip member, not random bytes of
+        # some compressed file.
+
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+
+        try:
+            decompressor.decompress(data[header_len + 2 + extra_len:])
+        except zlib.error:
+            return None
+
+        if not decompressor.eof or len(decompressor.unused_data) != 8:
+            return None
+
+        if version not in self.SUPPORTED_FORMAT_VERSIONS:
+            m = "Unsupported format version ({}) of the system image '{}'"\
+                .format(version, self.name)
+            raise SysImgArchiveError(m)
+
+        return index_offset, index_length
+
+    def _assert_member_hash_valid(self, name, index_entry):
+        member_hash = hashlib.sha256()
+        offset = index_entry["offset"]
+        end = offset + index_entry["length"]
+
+        while offset < end:
+            data = os.pread(self.fd, min(self.READ_CHUNK_SIZE, end - offset),
+                            offset)
+            if not data:
+                break
+            member_hash.update(data)
+            offset += len(data)
+
+        if member_hash.hexdigest() != index_entry["sha256"]:
+            m = "Member '{}' of the system image '{}' is corrupted (SHA-256 "\
+                "checksum mismatch)".format(name, self.name)
+            raise SysImgArchiveError(m)
+
+    def _get_tarinfo(self, index_entry):
+        tarinfo = tarfile.TarInfo(index_entry["name"])
+
+        for attr in self.TARINFO_ATTRS:
+            setattr(tarinfo, attr, index_entry[attr])
+
+        tarinfo.type = tarinfo.type.encode("ascii")
+
+        return tarinfo
+
+    @classmethod
+    def get_index_entry(cls, tarinfo, offset, length, sha256, blocks):
+        index_entry = {a: getattr(tarinfo, a) for a in cls.TARINFO_ATTRS}
+        index_entry["type"] = tarinfo.type.decode("ascii")
+        index_entry["offset"] = offset
+        index_entry["length"] = length
+        index_entry["sha256"] = sha256
+        index_entry["blocks"] = blocks
+
+        return index_entry
+
+    @classmethod
+    def get_format_version(cls, codec_name):
+        return cls.FORMAT_VERSION if codec_name == _GzipCodec.NAME\
+            else cls.CODEC_FORMAT_VERSION
+
+    @classmethod
+    def get_trailer(cls, index_offset, index_length, version=FORMAT_VERSION):
+        """Return FEXTRA subfield of the last gzip member of the image."""
+
+        data = cls.TRAILER_STRUCT.pack(version, index_offset, index_length)
+
+        return cls.TRAILER_SUBFIELD_ID + struct.pack("<H", len(data)) + data
+
+
+def open_sys_img(path, threads=1):
+    """Open system image for reading. Indexed (version 2 or 3) images are
+       opened with `IndexedSysImg` allowing random access to the members and
+       decompressing them with given number of threads. Older images (plain
+       tar.gz archives) are opened with `tarfile.open()`."""
+
+    try:
+        return IndexedSysImg(path, threads)
+    except NotIndexedSysImgArchiveError:
+        logger.debug("'{}' is not an indexed system image - opening it as "
+                     "plain tar archive.".format(path))
+
+    try:
+        return tarfile.open(path)
+    except (tarfile.TarError, OSError) as e:
+        m = "Failed to open system image '{}'".format(path)
+        raise SysImgArchiveError(m, e) from e
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import re
+
+from tempfile import NamedTemporaryFile
+
+from myscm.common.chunklist import ChunkList
+from myscm.common.error import MySCMError
+from myscm.common.signaturemanager import SignatureManager
+
+logger = logging.getLogger(__name__)
+
+
+class SysImgCatalogError(MySCMError):
+    pass
+
+
+class SysImgCatalog:
+    """Catalog of the system images available in the directory, published
+       next to them (as `myscm-catalog.json` file), so clients find
+       applicable system image on the peer by fetching single small file
+       (which is not fetched again until it changes) instead of listing the
+       whole directory and checking which signatures exist.
+
+       Every entry holds name, source and target versions, size, modification
+       time and SHA-256 digest of the system image and information whether
+       its signature and chunk list (see `ChunkList`) are published as well.
+       Entries of the system images that didn't change (have the same size
+       and modification time) are reused when catalog is updated, so every
+       system image is hashed once.
+
+       Catalog is trusted (`signed` is True) only if its signature created
+       by myscm-srv was verified by the reader - downloaded system images are
+       then checked against their SHA-256 digests listed in the catalog. Not
+       signed catalog (e.g. published by the other client) is only a hint
+       where system images are."""
+
+    CATALOG_FILE_NAME = "myscm-catalog.json"
+    FORMAT_VERSION = 1
+    READ_SIZE = 1024 * 1024
+    ENTRY_KEYS = {"name", "from", "to", "size", "mtime_ns", "sha256",
+                  "signature", "chunk_list"}
+
+    def __init__(self, images=None):
+        self.images = images or []  # entries ordered by the image's name
+        self.signed = False  # set by the reader verifying catalog's signature
+
+    @classmethod
+    def update(cls, dir_path):
+        """Update catalog of the system images in the given directory. Return
+           updated catalog."""
+
+        from myscm.server.sysimggenerator import SystemImageGenerator
+
+        catalog_path = os.path.join(dir_path, cls.CATALOG_FILE_NAME)
+        regex = re.compile(SystemImageGenerator.MYSCM_IMG_FILE_NAME_REGEX)
+        old_images = {}
+
+        try:
+            with open(catalog_path, "rb") as catalog_f:
+                old_images = {e["name"]: e for e in
+                              cls.loads(catalog_f.read()).images}
+        except FileNotFoundError:
+            pass
+        except (OSError, SysImgCatalogError) as e:
+            logger.warning("Ignoring malformed catalog '{}' ({}).".format(
+                           catalog_path, e))
+
+        images = []
+
+        try:
+            fnames = set(os.listdir(dir_path))
+
+            for fname in sorted(fnames):
+                match = regex.fullmatch(fname)
+
+                if not match:
+                    continue
+
+                img_path = os.path.join(dir_path, fname)
+
+                try:
+                    img_stat = os.stat(img_path)
+                    entry = old_images.get(fname)
+
+                    if not entry or entry["size"] != img_stat.st_size or\
+                       entry["mtime_ns"] != img_stat.st_mtime_ns:
+                        entry = {
+                            "name": fname,
+                            "from": int(match.group(1)),
+                            "to": int(match.group(2)),
+                            "size": img_stat.st_size,
+                            "mtime_ns": img_stat.st_mtime_ns,
+                            "sha256": cls.get_sha256(img_path)
+                        }
+                except FileNotFoundError:  # e.g. removed in the meantime
+                    continue
+
+                entry["signature"] =\
+                    fname + SignatureManager.SIGNATURE_EXT in fnames
+                entry["chunk_list"] = fname + ChunkList.CHUNK_LIST_EXT in fnames
+                images.append(entry)
+        except OSError as e:
+            m = "Failed to update catalog of the system images in '{}'"\
+                .format(dir_path)
+            raise SysImgCatalogError(m, e) from e
+
+        catalog = cls(images)
+        catalog.save(catalog_path)
+
+        n = len(images)
+        logger.debug("Catalog '{}' of {} system image{} updated.".format(
+                     catalog_path, n, "s" if n > 1 else ""))
+
+        return catalog
+
+    @classmethod
+    def loads(cls, data):
+        """Return catalog read from the bytes written by `dumps()`."""
+
+        try:
+            catalog = json.loads(data.decode())
+
+            if catalog["format_version"] != cls.FORMAT_VERSION:
+                m = "Unsupported catalog format version {}".format(
+                        catalog["format_version"])
+                raise SysImgCatalogError(m)
+
+            images = catalog["images"]
+
+            if any(not cls.ENTRY_KEYS <= e.keys() for e in images):
+                raise SysImgCatalogError("Malformed catalog entry")
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            raise SysImgCatalogError("Malformed catalog", e) from e
+
+        return cls(images)
+
+    def dumps(self):
+        catalog = {
+            "format_version": self.FORMAT_VERSION,
+            "images": self.images
+        }
+
+        return json.dumps(catalog, sort_keys=True, indent=1).encode()
+
+    def save(self, path):
+        """Atomically save catalog in the given file."""
+
+        try:
+            with NamedTemporaryFile(mode="wb", prefix=".",
+                                    dir=os.path.dirname(path) or ".",
+                                    delete=False) as catalog_f:
+                try:
+                    catalog_f.write(self.dumps())
+                except BaseException:
+                    with contextlib.suppress(OSError):
+                        os.remove(catalog_f.name)
+                    raise
+
+            os.chmod(catalog_f.name, 0o644)
+            os.replace(catalog_f.name, path)
+        except OSError as e:
+            m = "Failed to save catalog of the system images '{}'".format(
+                    path)
+            raise SysImgCatalogError(m, e) from e
+
+    def get_img(self, name):
+        """Return entry of the system image or None if it's not listed."""
+
+        for entry in self.images:
+            if entry["name"] == name:
+                return entry
+
+        return None
+
+    def get_newest_img(self, from_id):
+        """Return entry of the system image with the newest target version
+           applicable to the given version or None if there is none."""
+
+        entries = [e for e in self.images if e["from"] == from_id]
+        return max(entries, key=lambda e: e["to"], default=None)
+
+    @classmethod
+    def get_sha256(cls, path):
+        """Return hex SHA-256 digest of the given file."""
+
+        img_hash = hashlib.sha256()
+
+        with open(path, "rb") as img_f:
+            for data in iter(lambda: img_f.read(cls.READ_SIZE), b""):
+                img_hash.update(data)
+
+        return img_hash.hexdigest()
@@ -4,6 +4,7 @@ import re
 
 from myscm.server.aidedbparser import AIDEDatabaseFileParser
 from myscm.server.aideentry import AIDEEntries, AIDESimpleEntry, EntryType, AIDEProperties
+from myscm.server.aideentry import AIDEPropertiesStore
 from myscm.server.error import ServerError
 
 logger = logging.getLogger(__name__)
@@ -29,7 +30,9 @@ class AIDECheckParser:
         self.aide_cli_db_parser = AIDEDatabaseFileParser(client_aide_db_path)
 
     def read_all_entries(self, aidediff_f):
-        """Read added, removed and changed entries from AIDE --check output."""
+        """Read added, removed and changed entries from AIDE --check output.
+           Output is read line by line, so it can be streamed from the running
+           AIDE process (see `myscm.common.cmd.stream_check_cmd()`)."""
 
         entries = None
 
@@ -43,8 +46,12 @@ class AIDECheckParser:
 
     def _read_all_entries(self, aidediff_f):
         entries = self._set_added_removed_changed_entries(aidediff_f)
-        self._set_entries_info_from_aide_db_file(entries)
-        self._set_changed_properties_prev_values(entries.changed_entries)
+
+        logger.info("{} files added, {} removed, {} changes since client's "
+                    "declared last update.".format(
+                                len(entries.added_entries),
+                                len(entries.removed_entries),
+                                len(entries.changed_entries)))
 
         return entries
 
@@ -84,41 +91,41 @@ class AIDECheckParser:
         return entries
 
     def _set_added_entries(self, aidediff_f, entries):
-        entries.added_entries = self._create_simple_entries_from_lines_up_to_new_line(aidediff_f)
+        entries.added_entries = self._get_entries_from_lines_up_to_new_line(
+                aidediff_f, EntryType.ADDED, self.aide_srv_db_parser)
 
     def _set_removed_entries(self, aidediff_f, entries):
-        entries.removed_entries = self._create_simple_entries_from_lines_up_to_new_line(aidediff_f)
+        entries.removed_entries = self._get_entries_from_lines_up_to_new_line(
+                aidediff_f, EntryType.REMOVED, self.aide_cli_db_parser)
 
     def _set_changed_entries(self, aidediff_f, entries):
-        entries.changed_entries = self._create_simple_entries_from_lines_up_to_new_line(aidediff_f)
+        entries.changed_entries = self._get_entries_from_lines_up_to_new_line(
+                aidediff_f, EntryType.CHANGED, self.aide_srv_db_parser)
+        self._set_changed_properties_prev_values(entries.changed_entries)
 
-    def _set_entries_info_from_aide_db_file(self, entries):
-        """Replace AIDESimpleEntry entries with AIDEEntry entries by fetching
-           more information about AIDESimpleEntry entries from AIDE aide.db[.X]
-           database file.
+    def _get_entries_from_lines_up_to_new_line(self, aidediff_f, entry_type,
+                                               aide_db_parser):
+        """Replace AIDESimpleEntry entries of the single section of AIDE
+           --check output with AIDEEntry entries by fetching more information
+           about them from AIDE aide.db[.X] database file. Section is resolved
+           as soon as it's read, so database lookups overlap with producing
+           the rest of the streamed output.
 
            Reading intermediate AIDESimpleEntry entries first and later
            replacing them by AIDEEntry entries is needed to avoid rereading
            aide.db[.X] database N times where N is number of all entries."""
 
-        entries.added_entries = self.aide_srv_db_parser.get_files_entries(
-                                EntryType.ADDED, entries.added_entries)
-        entries.removed_entries = self.aide_cli_db_parser.get_files_entries(
-                                EntryType.REMOVED, entries.removed_entries)
-        entries.changed_entries = self.aide_srv_db_parser.get_files_entries(
-                                EntryType.CHANGED, entries.changed_entries)
+        simple_entries = self._create_simple_entries_from_lines_up_to_new_line(
+                                                                    aidediff_f)
 
-        logger.info("{} files added, {} removed, {} changes since client's "
-                    "declared last update.".format(
-                                len(entries.added_entries),
-                                len(entries.removed_entries),
-                                len(entries.changed_entries)))
+        return aide_db_parser.get_files_entries(entry_type, simple_entries)
 
     def _set_changed_properties_prev_values(self, changed_entries):
         # This method doesn't fit here
 
         s = set(changed_entries.keys())
         old_properties = self.aide_cli_db_parser.get_files_properties(s)
+        store = AIDEPropertiesStore()
 
         for k, v in old_properties.items():
             e = changed_entries.get(k)
@@ -128,7 +135,7 @@ class AIDECheckParser:
                     .format(k)
                 raise AIDECheckParserError(m)
 
-            changed_entries[k].aide_prev_properties = AIDEProperties(v)
+            changed_entries[k].aide_prev_properties = AIDEProperties(v, store)
 
     def _create_simple_entries_from_lines_up_to_new_line(self, aidediff_f):
         d = {}
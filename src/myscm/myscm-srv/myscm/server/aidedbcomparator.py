@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+import logging
+import stat
+import urllib.parse
+
+from myscm.server.aidedbparser import AIDEDatabaseFileParser
+from myscm.server.aideentry import AIDEEntries, AIDEEntry, AIDEProperties
+from myscm.server.aideentry import AIDEPropertiesStore
+from myscm.server.aideentry import EntryType, FileType
+from myscm.server.error import ServerError
+
+logger = logging.getLogger(__name__)
+
+
+class AIDEDatabasesComparatorError(ServerError):
+    pass
+
+
+class AIDEDatabasesComparator:
+    """Native replacement of the AIDE --check ran against client's aide.db.X
+       database. Instead of rescanning (and rehashing) whole server's
+       filesystem, client's database is compared with the reference aide.db
+       database that already describes current state of the server. Result is
+       the same as the one returned by `AIDECheckParser`, ie. added, removed
+       and changed AIDE entries with AIDE's 'summarize_changes' info strings.
+
+       Reference database is loaded to the memory (raw lines only) and
+       client's database is streamed line by line, so the comparison costs
+       O(db size) and doesn't depend on the order of the files in both
+       databases."""
+
+    CHECKSUM_COLUMNS = ["md5", "sha1", "rmd160", "tiger", "crc32", "crc32b",
+                        "haval", "gost", "sha256", "sha512", "whirlpool",
+                        "stribog256", "stribog512"]
+
+    # Columns of the aide.db[.X] that correspond to the characters of the
+    # YlZbpugamcinCAXSE AIDE info string pattern (see aide.conf(5) manual).
+    # File type (Y) is computed from 'perm' column.
+
+    INFO_STR_COLUMNS = [
+        None,               # Y - file type
+        ["lname"],          # l - link name
+        ["size"],           # Z - size
+        ["bcount"],         # b - block count
+        ["perm"],           # p - permissions
+        ["uid"],            # u - user ID
+        ["gid"],            # g - group ID
+        ["atime"],          # a - access time
+        ["mtime"],          # m - modification time
+        ["ctime"],          # c - change time
+        ["inode"],          # i - i-node
+        ["lcount"],         # n - number of hard links
+        CHECKSUM_COLUMNS,   # C - checksums
+        ["acl"],            # A - access control list
+        ["xattrs"],         # X - extended attributes
+        ["selinux"],        # S - SELinux attributes
+        ["e2fsattrs"]       # E - ext2 attributes
+    ]
+    LNAME_INFO_STR_IDX = 1
+    SIZE_INFO_STR_IDX = 2
+    CHECKSUMS_INFO_STR_IDX = 12
+    SIZE_GROWN_CHAR = ">"
+    SIZE_SHRUNK_CHAR = "<"
+    FTYPE_FROM_MODE_MAPPING = {
+        stat.S_IFREG: FileType.REGULAR_FILE,
+        stat.S_IFDIR: FileType.DIRECTORY,
+        stat.S_IFLNK: FileType.SYMBOLIC_LINK,
+        stat.S_IFCHR: FileType.CHARACTER_DEVICE,
+        stat.S_IFBLK: FileType.BLOCK_DEVICE,
+        stat.S_IFIFO: FileType.FIFO,
+        stat.S_IFSOCK: FileType.UNIX_SOCKET
+    }
+
+    def __init__(self, client_aide_db_path, server_aide_db_path,
+                 reference_rows=None):
+        """Constructor initialized by full paths of the client's aide.db.X
+           database and server's reference aide.db database. Already loaded
+           rows of the reference database (see `load_reference_rows()`) can
+           be passed to avoid reloading it for every compared client's
+           database."""
+
+        self.aide_srv_db_parser = AIDEDatabaseFileParser(server_aide_db_path)
+        self.aide_cli_db_parser = AIDEDatabaseFileParser(client_aide_db_path)
+        self.reference_rows = reference_rows
+        self.reference_columns = None
+        self.properties_store = None  # properties of the compared files
+
+    def load_reference_rows(self):
+        """Load raw lines of the reference aide.db database to the dictionary
+           where key is URL-encoded file path."""
+
+        if self.reference_rows is None:
+            parser = self.aide_srv_db_parser
+            self.reference_rows = {p: l for p, l in parser.iterate_rows()}
+            self.reference_columns = parser.columns
+            logger.debug("Loaded {} entries of the reference AIDE database "
+                         "'{}'.".format(len(self.reference_rows),
+                                        parser.aide_db_path))
+
+        return self.reference_rows
+
+    def compare(self):
+        """Compare client's database with reference database and return
+           AIDEEntries with added, removed and changed entries."""
+
+        try:
+            entries = self._compare()
+        except (KeyError, ValueError) as e:
+            m = "Malformed AIDE database - failed to compare '{}' and '{}' "\
+                "databases".format(self.aide_cli_db_parser.aide_db_path,
+                                   self.aide_srv_db_parser.aide_db_path)
+            raise AIDEDatabasesComparatorError(m, e) from e
+
+        logger.info("{} files added, {} removed, {} changes since client's "
+                    "declared last update.".format(
+                                len(entries.added_entries),
+                                len(entries.removed_entries),
+                                len(entries.changed_entries)))
+
+        return entries
+
+    def _compare(self):
+        entries = AIDEEntries()
+        self.properties_store = AIDEPropertiesStore()
+        reference_rows = self.load_reference_rows()
+        srv_columns = self._get_reference_columns()
+        cli_parser = self.aide_cli_db_parser
+        cli_paths = set()
+        cli_columns = None
+
+        for encoded_path, cli_line in cli_parser.iterate_rows():
+            cli_paths.add(encoded_path)
+            srv_line = reference_rows.get(encoded_path)
+
+            if srv_line == cli_line:
+                continue  # the most common case - nothing changed
+
+            if cli_columns is None:
+                cli_columns = cli_parser.columns
+
+            cli_values = self._get_row_values(cli_line, cli_columns)
+
+            if srv_line is None:
+                e = self._create_entry(cli_values, EntryType.REMOVED)
+            else:
+                srv_values = self._get_row_values(srv_line, srv_columns)
+                e = self._create_changed_entry(cli_values, srv_values)
+
+            if e:
+                entries_dict = entries.removed_entries\
+                    if e.entry_type == EntryType.REMOVED\
+                    else entries.changed_entries
+                entries_dict[e.get_full_path()] = e
+
+        for encoded_path, srv_line in reference_rows.items():
+            if encoded_path not in cli_paths:
+                srv_values = self._get_row_values(srv_line, srv_columns)
+                e = self._create_entry(srv_values, EntryType.ADDED)
+                entries.added_entries[e.get_full_path()] = e
+
+        return entries
+
+    def _get_reference_columns(self):
+        if self.reference_columns is None:
+            # Reference rows were given in constructor, so read header only
+            for _ in self.aide_srv_db_parser.iterate_rows():
+                break
+            self.reference_columns = self.aide_srv_db_parser.columns
+
+        return self.reference_columns
+
+    def _get_row_values(self, line, columns):
+        values = line.split()
+
+        if len(values) != len(columns):
+            m = "Malformed AIDE database line - unexpected number of "\
+                "properties ({} instead of {})".format(len(values),
+                                                       len(columns))
+            raise AIDEDatabasesComparatorError(m)
+
+        return dict(zip(columns, values))
+
+    def _create_entry(self, values, entry_type):
+        ftype = self._get_ftype(values)
+        attr_char = AIDEEntry.ATTR_ADDED_CHAR\
+            if entry_type == EntryType.ADDED\
+            else AIDEEntry.ATTR_REMOVED_CHAR
+        info_str_len = AIDEEntry.AIDE_INFO_STR_FULL_LEN
+        info_str = ftype.value + (info_str_len - 1) * attr_char
+        properties = self._get_aide_properties(values)
+
+        return AIDEEntry(properties, info_str, entry_type)
+
+    def _create_changed_entry(self, old_values, new_values):
+        info_str = self._get_changed_info_str(old_values, new_values)
+
+        if not self._is_any_attr_changed(info_str):
+            return None
+
+        properties = self._get_aide_properties(new_values)
+        entry = AIDEEntry(properties, info_str, EntryType.CHANGED)
+        entry.aide_prev_properties = self._get_aide_properties(old_values)
+
+        return entry
+
+    def _get_changed_info_str(self, old_values, new_values):
+        old_ftype = self._get_ftype(old_values)
+        new_ftype = self._get_ftype(new_values)
+        ftype = new_ftype if old_ftype == new_ftype else FileType.FTYPE_CHANGED
+        info_str = [ftype.value]
+        pattern = AIDEEntry.AIDE_INFO_STR_PATTERN
+
+        for i in range(1, len(self.INFO_STR_COLUMNS)):
+            if not self._is_attr_checked(i, old_ftype, new_ftype):
+                info_str.append(AIDEEntry.ATTR_NOT_CHECKED_CHAR)
+                continue
+
+            columns = [c for c in self.INFO_STR_COLUMNS[i]
+                       if c in old_values and c in new_values]
+
+            if not columns:
+                info_str.append(AIDEEntry.ATTR_NOT_CHECKED_CHAR)
+            elif all(old_values[c] == new_values[c] for c in columns):
+                info_str.append(AIDEEntry.NO_CHANGE_CHAR)
+            elif i == self.SIZE_INFO_STR_IDX:
+                grown = int(new_values["size"]) > int(old_values["size"])
+                info_str.append(self.SIZE_GROWN_CHAR if grown
+                                else self.SIZE_SHRUNK_CHAR)
+            else:
+                info_str.append(pattern[i])
+
+        return "".join(info_str)
+
+    def _is_attr_checked(self, info_str_idx, old_ftype, new_ftype):
+        """AIDE checks link name of the symbolic links only and checksums of
+           the regular files only."""
+
+        ftypes = {old_ftype, new_ftype}
+
+        if info_str_idx == self.LNAME_INFO_STR_IDX:
+            return FileType.SYMBOLIC_LINK in ftypes
+        elif info_str_idx == self.CHECKSUMS_INFO_STR_IDX:
+            return FileType.REGULAR_FILE in ftypes
+
+        return True
+
+    def _is_any_attr_changed(self, info_str):
+        if info_str[0] == FileType.FTYPE_CHANGED.value:
+            return True
+
+        return any(c not in AIDEEntry.AIDE_ALLOWED_INFO_STR_CHARS
+                   for c in info_str[1:])
+
+    def _get_ftype(self, values):
+        mode = int(values["perm"], 8)
+        return self.FTYPE_FROM_MODE_MAPPING.get(stat.S_IFMT(mode),
+                                                FileType.UNKNOWN)
+
+    def _get_aide_properties(self, values):
+        properties = {p: values[p] for p in AIDEProperties.REQUIRED_PROPERTIES}
+        properties["name"] = urllib.parse.unquote(properties["name"])
+        return AIDEProperties(properties, self.properties_store)
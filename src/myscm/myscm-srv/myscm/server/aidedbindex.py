@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+import array
+import bisect
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import urllib.parse
+
+from tempfile import NamedTemporaryFile
+
+from myscm.server.error import ServerError
+
+logger = logging.getLogger(__name__)
+
+
+class AIDEDatabaseIndexError(ServerError):
+    pass
+
+
+class AIDEDatabaseIndex:
+    """Persistent sidecar index (aide.db[.X].myscm-idx) of the aide.db[.X] AIDE
+       database mapping hashes of the (decoded) full file paths to the byte
+       offsets of the database rows describing those files. Index is created
+       right after AIDE --init (see `Scanner`) and lets `AIDEDatabaseFileParser`
+       read only the requested rows of the memory-mapped database instead of
+       scanning (and URL-decoding) all of them.
+
+       Index file consists of the header followed by the sorted array of the
+       64-bit path hashes and the array of the corresponding row offsets (in
+       native byte order, since index is never copied to another machine).
+       Header holds size and modification time of the indexed database, so
+       index is ignored if database was modified after creating the index."""
+
+    INDEX_EXT = ".myscm-idx"
+    MAGIC = b"MYSCMIDX"
+    FORMAT_VERSION = 1
+    HEADER_STRUCT = struct.Struct("=8sIQQQ")  # magic, version, db size,
+                                              # db mtime [ns], rows count
+    ARRAY_TYPECODE = "Q"
+
+    def __init__(self, aide_db_path):
+        self.aide_db_path = aide_db_path
+        self.index_path = self.get_index_path(aide_db_path)
+        self.index_map = None
+        self.hashes = None
+        self.offsets = None
+
+    @classmethod
+    def get_index_path(cls, aide_db_path):
+        return aide_db_path + cls.INDEX_EXT
+
+    def build(self):
+        """Create (or recreate) index of the AIDE database."""
+
+        try:
+            n = self._build()
+        except OSError as e:
+            m = "Failed to create index of the AIDE database '{}'".format(
+                    self.aide_db_path)
+            raise AIDEDatabaseIndexError(m, e) from e
+
+        logger.debug("Index '{}' of {} rows of the AIDE database created."
+                     .format(self.index_path, n))
+
+    def _build(self):
+        records = []
+
+        with open(self.aide_db_path, "rb") as db_f:
+            db_stat = os.fstat(db_f.fileno())
+
+            with map_file(db_f) as db_map:
+                start, end = get_mapped_rows_span(db_map, self.aide_db_path)
+
+                for offset, encoded_path, _ in iterate_mapped_rows(db_map,
+                                                                   start, end):
+                    path = decode_path(encoded_path)
+                    records.append((hash_path(path), offset))
+
+        records.sort()
+        hashes = array.array(self.ARRAY_TYPECODE, (r[0] for r in records))
+        offsets = array.array(self.ARRAY_TYPECODE, (r[1] for r in records))
+        header = self.HEADER_STRUCT.pack(self.MAGIC, self.FORMAT_VERSION,
+                                         db_stat.st_size, db_stat.st_mtime_ns,
+                                         len(records))
+        index_dir = os.path.dirname(os.path.abspath(self.index_path))
+
+        with NamedTemporaryFile(mode="wb", dir=index_dir,
+                                delete=False) as index_f:
+            index_f.write(header)
+            hashes.tofile(index_f)
+            offsets.tofile(index_f)
+
+        os.replace(index_f.name, self.index_path)
+
+        return len(records)
+
+    def load(self):
+        """Map the index to the memory. Return False if index doesn't exist or
+           is outdated."""
+
+        try:
+            return self._load()
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning("Failed to load index '{}' of the AIDE database "
+                           "({}).".format(self.index_path, e))
+            self.close()
+
+        return False
+
+    def _load(self):
+        if not os.path.isfile(self.index_path):
+            return False
+
+        db_stat = os.stat(self.aide_db_path)
+
+        with open(self.index_path, "rb") as index_f:
+            self.index_map = map_file(index_f)
+
+        header_size = self.HEADER_STRUCT.size
+        magic, version, db_size, db_mtime_ns, n = \
+            self.HEADER_STRUCT.unpack_from(self.index_map)
+        item_size = array.array(self.ARRAY_TYPECODE).itemsize
+        expected_index_size = header_size + 2 * n * item_size
+
+        if magic != self.MAGIC or version != self.FORMAT_VERSION or\
+           len(self.index_map) != expected_index_size or\
+           db_size != db_stat.st_size or db_mtime_ns != db_stat.st_mtime_ns:
+            logger.debug("Index '{}' of the AIDE database is outdated."
+                         .format(self.index_path))
+            self.close()
+            return False
+
+        index_view = memoryview(self.index_map)[header_size:]
+        self.hashes = index_view[:n * item_size].cast(self.ARRAY_TYPECODE)
+        self.offsets = index_view[n * item_size:].cast(self.ARRAY_TYPECODE)
+        index_view.release()
+
+        return True
+
+    def find_rows(self, db_map, paths):
+        """Return dictionary mapping given (decoded) paths to the raw rows
+           (bytes without trailing new line) of the memory-mapped AIDE
+           database. Paths not found in the database are skipped."""
+
+        rows = {}
+        hashes = self.hashes
+        n = len(hashes)
+
+        for path in paths:
+            path_hash = hash_path(path)
+            i = bisect.bisect_left(hashes, path_hash)
+
+            # Compare full paths since different paths may have the same hash
+
+            while i < n and hashes[i] == path_hash:
+                offset = self.offsets[i]
+                line_end = db_map.find(b"\n", offset)
+                row = db_map[offset:line_end]
+
+                if decode_path(row.split(b" ", 1)[0]) == path:
+                    rows[path] = row
+                    break
+
+                i += 1
+
+        return rows
+
+    def close(self):
+        for view in [self.hashes, self.offsets]:
+            if view is not None:
+                view.release()
+
+        self.hashes, self.offsets = None, None
+
+        if self.index_map is not None:
+            self.index_map.close()
+            self.index_map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def map_file(f):
+    """Return read-only memory map of the whole opened file."""
+
+    if not os.fstat(f.fileno()).st_size:
+        raise ValueError("cannot map empty file '{}'".format(f.name))
+
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def hash_path(path):
+    """Return 64-bit integer hash of the (decoded) file path."""
+
+    digest = hashlib.blake2b(path.encode("utf-8", "surrogateescape"),
+                             digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def decode_path(encoded_path):
+    """Decode URL-encoded path read from AIDE database as bytes. Unquoting
+       (which is relatively slow) is skipped if path has nothing to unquote."""
+
+    path = encoded_path.decode("utf-8", "surrogateescape")
+    return urllib.parse.unquote(path) if "%" in path else path
+
+
+def get_mapped_rows_span(db_map, aide_db_path):
+    """Return (start, end) offsets of the memory-mapped AIDE database's part
+       holding rows with files' properties (between '@@db_spec' line and
+       '@@end_db' line)."""
+
+    spec_pos = db_map.find(b"\n@@db_spec ")
+
+    if spec_pos < 0:
+        m = "Malformed AIDE database '{}', '@@db_spec' not found".format(
+                aide_db_path)
+        raise AIDEDatabaseIndexError(m)
+
+    start = db_map.find(b"\n", spec_pos + 1) + 1
+    end = db_map.find(b"\n@@end_db\n", start - 1)
+
+    if not start or end < 0:
+        m = "AIDE database file '{}' is probably malformed since it doesn't "\
+            "have '@@end_db' valid closing".format(aide_db_path)
+        raise AIDEDatabaseIndexError(m)
+
+    return start, end + 1
+
+
+def iterate_mapped_rows(db_map, start, end):
+    """Generator yielding (row offset, URL-encoded path, raw row) tuples of the
+       rows of the memory-mapped AIDE database. Raw row is bytes object with
+       trailing new line character. Nothing is decoded."""
+
+    db_map.seek(start)
+    pos = start
+
+    for line in iter(db_map.readline, b""):
+        if pos >= end:
+            break
+
+        encoded_path, sep, _ = line.partition(b" ")
+
+        if not sep or not encoded_path:
+            m = "Malformed AIDE database - unexpected line '{}' instead of "\
+                "line with file's properties values (offset {})".format(
+                    line.decode("utf-8", "replace").rstrip("\n"), pos)
+            raise AIDEDatabaseIndexError(m)
+
+        yield pos, encoded_path, line
+        pos += len(line)
@@ -3,7 +3,9 @@ import logging
 import os
 import re
 
+from myscm.server.aidedbindex import AIDEDatabaseIndex
 from myscm.server.error import ServerError
+from myscm.server.statsnapshot import StatSnapshot
 
 logger = logging.getLogger(__name__)
 
@@ -25,12 +27,17 @@ class AIDEDatabasesManager:
 
     def replace_old_aide_db_with_new_one(self):
         """Replace old aide.db.current directory with new aide.db.new and
-           rename old aide.db.current to aide.db.X directory (X is integer)."""
+           rename old aide.db.current to aide.db.X directory (X is integer).
+           Return path of the aide.db.X directory or None if there was no
+           old aide.db.current directory."""
+
+        old_db_dir_path = None
 
         if os.path.isdir(self.server_config.aide_reference_db_dir):
             num = self.get_recent_aide_db_version()
             self._rename_aide_reference_db_file_to_old(num)
             self._rename_aide_reference_db_dir_to_old(num)
+            old_db_dir_path = self._get_new_path_for_old_db_dir(num)
         else:
             logger.debug("AIDE reference database file doesn't exist yet - "
                          "skipping renaming procedure for old database. "
@@ -41,6 +48,8 @@ class AIDEDatabasesManager:
         self._rename_aide_new_db_dir_to_reference_dir()
         self.server_config.db_ver_file.increment()
 
+        return old_db_dir_path
+
     def _rename_aide_reference_db_file_to_old(self, num):
         """Rename recently created aide.db file to aide.db.X, where X is
            next unassigned integer."""
@@ -48,7 +57,7 @@ class AIDEDatabasesManager:
         a = self.server_config.aide_reference_db_path
         b = self._get_new_path_for_old_db_file(num)
 
-        self._rename(a, b)
+        self._rename_db_file(a, b)
 
     def _get_new_path_for_old_db_file(self, num):
         """Return temporary new path for old AIDE database file."""
@@ -80,7 +89,7 @@ class AIDEDatabasesManager:
         b = os.path.join(self.server_config.aide_out_db_dir,
                          self.server_config.aide_reference_db_fname)
 
-        self._rename(a, b)
+        self._rename_db_file(a, b)
 
     def _rename_aide_new_db_dir_to_reference_dir(self):
         """Rename temporary directory aide.db.new with currently newest AIDE
@@ -92,6 +101,19 @@ class AIDEDatabasesManager:
 
         self._rename(a, b)
 
+    def _rename_db_file(self, from_path, to_path):
+        """Rename AIDE database file along with its index and snapshot of the
+           scanned files (if exist)."""
+
+        self._rename(from_path, to_path)
+
+        for get_sidecar_path in [AIDEDatabaseIndex.get_index_path,
+                                 StatSnapshot.get_snapshot_path]:
+            from_sidecar_path = get_sidecar_path(from_path)
+
+            if os.path.isfile(from_sidecar_path):
+                self._rename(from_sidecar_path, get_sidecar_path(to_path))
+
     def _rename(self, from_path, to_path):
         m = "Renaming '{}' to '{}'.".format(from_path, to_path)
         logger.debug(m)
@@ -134,6 +156,12 @@ class AIDEDatabasesManager:
 
         return db_ver_from_file
 
+    def get_aide_db_versions(self):
+        """Return sorted list of integers X of all existing aide.db.X
+           databases."""
+
+        return sorted(self._get_aide_db_ver_list())
+
     def _get_aide_db_ver_list(self):
         versions = []
         regex_str = self.server_config.aide_old_db_fname_pattern.format(r"(\d+)")
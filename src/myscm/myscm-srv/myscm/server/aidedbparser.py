@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 import logging
-import urllib.parse
 
+from myscm.server.aidedbindex import AIDEDatabaseIndex, AIDEDatabaseIndexError
+from myscm.server.aidedbindex import decode_path, get_mapped_rows_span
+from myscm.server.aidedbindex import iterate_mapped_rows, map_file
 from myscm.server.aideentry import AIDEEntry, AIDEProperties
+from myscm.server.aideentry import AIDEPropertiesStore
 from myscm.server.error import ServerError
 
 logger = logging.getLogger(__name__)
@@ -32,9 +35,10 @@ class AIDEDatabaseFileParser:
         requested_paths = set(aide_simple_entries.keys())
         files_properties = self.get_files_properties(requested_paths)
         file_entries = {}
+        store = AIDEPropertiesStore()
 
         for e in aide_simple_entries.values():
-            properties = AIDEProperties(files_properties[e.file_path])
+            properties = AIDEProperties(files_properties[e.file_path], store)
             file_entry = AIDEEntry(properties, e.aide_info_str, entry_type)
             file_entries[e.file_path] = file_entry
 
@@ -68,10 +72,14 @@ class AIDEDatabaseFileParser:
         try:
             files_properties = self._get_files_properties(requested_paths,
                                                           requested_properties)
-        except OSError as e:
+        except (OSError, ValueError) as e:
             m = "Failed to get files' AIDE properties. Unable to open AIDE "\
                 "database file '{}'".format(self.aide_db_path)
             raise AIDEDatabaseFileParserError(m, e) from e
+        except AIDEDatabaseIndexError as e:
+            m = "Failed to get files' AIDE properties from AIDE database "\
+                "file '{}'".format(self.aide_db_path)
+            raise AIDEDatabaseFileParserError(m, e) from e
 
         return files_properties
 
@@ -87,15 +95,89 @@ class AIDEDatabaseFileParser:
 
         with open(self.aide_db_path) as db_file:
             infile_prop_names = self._get_all_infile_properties_names(db_file)
-            self._assert_required_properties_present(infile_prop_names)
-            self._assert_requested_properties_present(requested_properties,
-                                                      infile_prop_names)
-            prop_col_mapping = self._enumerate_columns(infile_prop_names)
-            files_properties = self._get_files_properties_values(
-                                    requested_paths, requested_properties,
-                                    prop_col_mapping, db_file)
 
-        return files_properties
+        self._assert_required_properties_present(infile_prop_names)
+        self._assert_requested_properties_present(requested_properties,
+                                                  infile_prop_names)
+        prop_col_mapping = self._enumerate_columns(infile_prop_names)
+        rows = self._find_rows(requested_paths)
+
+        return self._get_files_properties_values(rows, requested_properties,
+                                                 prop_col_mapping)
+
+    def _find_rows(self, requested_paths):
+        """Return dictionary mapping requested paths to the raw rows (bytes)
+           of the memory-mapped AIDE database. Rows are looked up in the
+           database's index (see `AIDEDatabaseIndex`) if it's available and
+           up-to-date. Otherwise whole database is scanned."""
+
+        with open(self.aide_db_path, "rb") as db_f,\
+                map_file(db_f) as db_map,\
+                AIDEDatabaseIndex(self.aide_db_path) as index:
+            if index.load():
+                logger.debug("Looking up {} paths in the index '{}' of the "
+                             "AIDE database.".format(len(requested_paths),
+                                                     index.index_path))
+                return index.find_rows(db_map, requested_paths)
+
+            logger.debug("AIDE database '{}' is not indexed - scanning whole "
+                         "database.".format(self.aide_db_path))
+
+            return self._scan_rows(db_map, requested_paths)
+
+    def _scan_rows(self, db_map, requested_paths):
+        rows = {}
+        start, end = get_mapped_rows_span(db_map, self.aide_db_path)
+
+        # Paths without '%' character are stored in AIDE database as they are,
+        # so compare bytes without decoding (and unquoting) them.
+
+        requested_raw_paths = {p.encode("utf-8", "surrogateescape")
+                               for p in requested_paths}
+
+        for _, encoded_path, row in iterate_mapped_rows(db_map, start, end):
+            if b"%" in encoded_path:
+                path = decode_path(encoded_path)
+                if path not in requested_paths:
+                    continue
+            elif encoded_path in requested_raw_paths:
+                path = encoded_path.decode("utf-8", "surrogateescape")
+            else:
+                continue
+
+            rows[path] = row.rstrip(b"\n")
+
+        return rows
+
+    def iterate_rows(self):
+        """Generator yielding (URL-encoded file path, raw line) tuples for
+           every file listed in the aide.db[.X] database. Neither paths nor
+           properties are decoded. Names of the columns of the yielded lines
+           are available in `columns` attribute right after the first tuple
+           is yielded (or the generator is exhausted)."""
+
+        self.columns = None
+        line = None
+
+        try:
+            with open(self.aide_db_path) as db_file:
+                self.columns = self._get_all_infile_properties_names(db_file)
+                self._assert_required_properties_present(self.columns)
+
+                for line in db_file:
+                    if line == self.AIDE_DB_FILE_CLOSING:
+                        break
+
+                    encoded_path, _, _ = line.partition(" ")
+                    self._assert_not_empty_properties_values_list(
+                                                            encoded_path.strip())
+                    yield encoded_path, line.rstrip("\n")
+        except OSError as e:
+            m = "Failed to read AIDE database file '{}'".format(
+                    self.aide_db_path)
+            raise AIDEDatabaseFileParserError(m, e) from e
+
+        self._assert_expected_closing(line)
 
     def _enumerate_columns(self, infile_prop_names):
         prop_cols_dict = {}
@@ -125,26 +207,16 @@ class AIDEDatabaseFileParser:
 
         return words
 
-    def _get_files_properties_values(self, requested_paths,
-                                     requested_properties,
-                                     prop_col_mapping,
-                                     db_file):
+    def _get_files_properties_values(self, rows, requested_properties,
+                                     prop_col_mapping):
         files_properties = {}
         N = len(prop_col_mapping)
-        line = None
 
-        for line in db_file:
-            words = line.split(maxsplit=1)
-            self._assert_not_empty_properties_values_list(words)
-            path = urllib.parse.unquote(words[0])  # unquote full path
-
-            if path not in requested_paths:
-                continue
-
-            words = line.split()
+        for path, row in rows.items():
+            words = row.decode("utf-8", "surrogateescape").split()
             n = len(words)
             self._assert_expected_number_of_properties_values(n, N)
-            words[0] = urllib.parse.unquote(words[0])  # unquote full path
+            words[0] = path  # already unquoted full path
             current_file_properties = {}
 
             for prop_name in requested_properties:
@@ -153,8 +225,6 @@ class AIDEDatabaseFileParser:
 
             files_properties[path] = current_file_properties
 
-        self._assert_expected_closing(line)
-
         return files_properties
 
     def _assert_expected_opening(self, line):
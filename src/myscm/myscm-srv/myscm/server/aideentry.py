@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
+import array
 import base64
 import logging
+import sys
 
 from enum import Enum
 
@@ -67,58 +69,146 @@ class AIDEPropertiesError(ServerError):
     pass
 
 
+class AIDEPropertiesStore:
+    """Compact, columnar (struct of arrays) store of the properties of many
+       files tracked by AIDE. Integer properties are packed to the arrays
+       when appended. Checksums are kept packed as fixed-width base64 strings
+       and decoded on every access, since most of them are never read. Link
+       names and not required properties are stored for the files that have
+       them only. Files' properties are accessed with `AIDEProperties` views.
+
+       Storing properties of a single file costs ~150 bytes (plus file path)
+       instead of two dictionaries with decoded values."""
+
+    INT_PROPERTIES = [PropertyType.ATTR, PropertyType.PERM, PropertyType.INODE,
+                      PropertyType.BCOUNT, PropertyType.UID, PropertyType.GID,
+                      PropertyType.SIZE, PropertyType.LCOUNT]
+    TIME_PROPERTIES = [PropertyType.MTIME, PropertyType.CTIME]
+    HASH_PROPERTIES = {  # base64 encoded checksum's length
+        PropertyType.MD5: 24,
+        PropertyType.SHA1: 28
+    }
+    INT_TYPECODE = "q"  # signed 64-bit integer
+    NO_VALUE = "0"  # AIDE's value of e.g. link name of the regular file
+    ENCODED_HASH_KEY = "{}encoded"
+
+    def __init__(self):
+        self.names = []
+        self.lnames = {}  # index: link name (symbolic links only)
+        self.extra_properties = {}  # index: dictionary (if there are any)
+        self.columns = {p: array.array(self.INT_TYPECODE)
+                        for p in self.INT_PROPERTIES + self.TIME_PROPERTIES}
+        self.hashes = {p: bytearray() for p in self.HASH_PROPERTIES}
+        self.encoded_hash_keys = {
+            self.ENCODED_HASH_KEY.format(p.value): p
+            for p in self.HASH_PROPERTIES}
+
+    def __len__(self):
+        return len(self.names)
+
+    def append(self, properties):
+        """Append properties of the file (dictionary mapping names of the
+           properties to the values read from AIDE database) and return their
+           index. ValueError is raised if any value is malformed."""
+
+        AIDEProperties.assert_required_properties_present_in_dict(properties)
+
+        # Convert all of the values before appending any of them to keep
+        # columns of the same length if conversion fails.
+
+        ints = [(p, int(properties[p.value])) for p in self.INT_PROPERTIES]
+        ints.extend((p, int(base64.b64decode(properties[p.value])))
+                    for p in self.TIME_PROPERTIES)
+        hashes = [(p, self._get_packed_hash(properties[p.value], length))
+                  for p, length in self.HASH_PROPERTIES.items()]
+        extra_properties = {k: v for k, v in properties.items()
+                            if k not in AIDEProperties.REQUIRED_PROPERTIES}
+
+        i = len(self.names)
+
+        try:
+            for p, val in ints:
+                self.columns[p].append(val)
+        except OverflowError as e:
+            for p, _ in ints:
+                del self.columns[p][i:]
+            raise ValueError("Too big value of the file's property") from e
+
+        for p, packed_hash in hashes:
+            self.hashes[p] += packed_hash
+
+        self.names.append(str(properties[PropertyType.NAME.value]))
+        lname = properties[PropertyType.LNAME.value]
+
+        if lname != self.NO_VALUE:
+            self.lnames[i] = lname
+
+        if extra_properties:
+            self.extra_properties[i] = extra_properties
+
+        return i
+
+    def _get_packed_hash(self, val, length):
+        if val == self.NO_VALUE:
+            return bytes(length)
+
+        packed_hash = val.encode("ascii")
+
+        if len(packed_hash) != length:
+            m = "Unexpected length of the base64 encoded checksum '{}'".format(
+                    val)
+            raise ValueError(m)
+
+        return packed_hash
+
+    def get(self, i, key):
+        """Return decoded value of the property (PropertyType or name of the
+           not required property) of the i-th file."""
+
+        if key == PropertyType.NAME:
+            return self.names[i]
+        elif key == PropertyType.LNAME:
+            return self.lnames.get(i)
+        elif key in self.columns:
+            return self.columns[key][i]
+        elif key in self.hashes:
+            # Reverse of below is: base64.b64encode(bytes.fromhex(md5))
+            encoded_hash = self._get_encoded_hash(i, key)
+            return base64.b64decode(encoded_hash).hex()\
+                if encoded_hash != self.NO_VALUE else None
+        elif key in self.encoded_hash_keys:
+            return self._get_encoded_hash(i, self.encoded_hash_keys[key])
+
+        return self.extra_properties.get(i, {})[key]
+
+    def _get_encoded_hash(self, i, prop):
+        length = self.HASH_PROPERTIES[prop]
+        packed_hash = self.hashes[prop][i * length:(i + 1) * length]
+
+        if not packed_hash[0]:
+            return self.NO_VALUE
+
+        return packed_hash.decode("ascii")
+
+
 class AIDEProperties:
-    """Properties of files tracked by AIDE."""
+    """Properties of files tracked by AIDE - thin view of the single file's
+       properties kept by `AIDEPropertiesStore`. Properties are accessed by
+       `PropertyType` (or name of the not required property, e.g. 'md5encoded'
+       for the base64 encoded MD5 checksum)."""
+
+    __slots__ = ["store", "index"]
 
     REQUIRED_PROPERTIES = {p.value for p in PropertyType}
 
-    def __init__(self, properties):
-        AIDEProperties.assert_required_properties_present_in_dict(properties)
+    def __init__(self, properties, store=None):
+        """Constructor initialized by the dictionary mapping names of the
+           properties to the values read from AIDE database. Properties of
+           many files should be appended to the same store to keep them
+           compact."""
 
-        self.properties = {}        # required properties only
-        self.extra_properties = {}  # not required properties only
-        properties_converter = {    # not listed properties are integers
-            PropertyType.NAME: str,
-            PropertyType.LNAME: self._convert_to_none_if_zero,
-            PropertyType.MTIME: self._convert_to_int_from_base64,
-            PropertyType.CTIME: self._convert_to_int_from_base64,
-            PropertyType.MD5: self._convert_to_hex_from_base64,
-            PropertyType.SHA1: self._convert_to_hex_from_base64,
-        }
-
-        for prop_name, prop_val in properties.items():
-            prop_enum = None
-
-            try:
-                prop_enum = PropertyType(prop_name)
-            except ValueError:
-                self.extra_properties[prop_name] = prop_val
-            else:
-                prop_conv = properties_converter.get(prop_enum, int)
-                self.properties[prop_enum] = prop_conv(prop_val)
-                self._save_encoded_in_extras_if_hash(prop_enum, prop_val)
-
-    def _save_encoded_in_extras_if_hash(self, prop_enum, prop_val):
-        """AIDE encodes hashes (eg. MD5). Save encoded hash for debugging."""
-
-        hashes_set = {PropertyType.MD5, PropertyType.SHA1}
-
-        if prop_enum in hashes_set:
-            key = "{}encoded".format(prop_enum.value)
-            self.extra_properties[key] = prop_val
-
-    def _convert_to_hex_from_base64(self, val):
-        # Reverse of below is: base64.b64encode(bytes.fromhex(md5))
-        # There are 2 versions of CRC-32 (AIDE uses 1st one)
-        #   (1) http://hash.online-convert.com/crc32-generator
-        #   (2) http://hash.online-convert.com/crc32b-generator
-        return base64.b64decode(val).hex() if val != "0" else None
-
-    def _convert_to_none_if_zero(self, val):
-        return val if val != "0" else None
-
-    def _convert_to_int_from_base64(self, val):
-        return int(base64.b64decode(val))
+        self.store = store if store is not None else AIDEPropertiesStore()
+        self.index = self.store.append(properties)
 
     @staticmethod
     def assert_required_properties_present_in_dict(properties_dict):
@@ -139,14 +229,7 @@ class AIDEProperties:
             raise AIDEPropertiesError(m)
 
     def __getitem__(self, key):
-        val = None
-
-        try:
-            val = self.properties[key]
-        except KeyError:
-            val = self.extra_properties[key]
-
-        return val
+        return self.store.get(self.index, key)
 
 
 class AIDESimpleEntry:
@@ -178,6 +261,9 @@ class AIDEEntry:
     """Representation of added, removed and changed AIDE entry. This is
        structured, extended version of `AIDESimpleEntry`."""
 
+    __slots__ = ["aide_properties", "aide_info_str", "ftype", "entry_type",
+                 "aide_prev_properties"]
+
     AIDE_INFO_STR_PATTERN = "YlZbpugamcinCAXSE"
     AIDE_INFO_STR_FULL_LEN = len(AIDE_INFO_STR_PATTERN)
     AIDE_INFO_SUBSTR_LEN = AIDE_INFO_STR_FULL_LEN - 4  # ignore last 4 chars
@@ -231,7 +317,7 @@ class AIDEEntry:
     def __init__(self, aide_properties, aide_info_str, entry_type):
         self.aide_properties = aide_properties
         self._assert_valid_aide_info_str(aide_info_str)
-        self.aide_info_str = aide_info_str
+        self.aide_info_str = sys.intern(aide_info_str)  # few distinct ones
         self.ftype = FileType(self.aide_info_str[0])
         self.entry_type = entry_type
         # properties before change (loaded elsewhere)
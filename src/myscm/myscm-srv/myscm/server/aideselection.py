@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import re
+import stat
+
+logger = logging.getLogger(__name__)
+
+
+class AIDESelection:
+    """Emulation of the AIDE's selection of the tracked files based on the
+       selection lines of the AIDE configuration (see aide.conf(5) manual).
+       AIDE matches regular expressions of the selection lines with the
+       beginning of the files' paths. Only literal paths (where '.' may be
+       regular expression's wildcard) are supported in the regular and equals
+       selection lines, so walking starts from the directory of the selection
+       line's path. Regular expressions of the negative selection lines are
+       matched as they are.
+
+       Selection is exact (`is_exact`) unless configuration has equals
+       selection lines or negative selection lines with '$' anchor, which are
+       emulated by selecting more files than AIDE does."""
+
+    SELECTION_LINE_REGEX = re.compile(r"\s*([=!]?)(/\S*)\s*(\S*).*")
+    REGEX_SPECIAL_CHARS = set(".^$*+?{}[]\\|()")
+
+    def __init__(self, aide_config_path):
+        self.aide_config_path = aide_config_path
+        self.config_bytes = None
+        self.selections = []  # (regex, if selects children too, path, rule)
+        self.negative_regexes = []  # (regex, if excludes children too)
+        self.roots = []
+        self.is_exact = True
+
+    def read(self):
+        """Read selection lines of the AIDE configuration. Return False if
+           configuration uses features that can't be emulated (macros or
+           regular expressions in the regular selection lines)."""
+
+        with open(self.aide_config_path, "rb") as f:
+            self.config_bytes = f.read()
+
+        config_str = self.config_bytes.decode("utf-8", "surrogateescape")
+
+        for line in config_str.splitlines():
+            if line.lstrip().startswith("@@"):
+                logger.debug("Macro line '{}' of the AIDE configuration can't "
+                             "be emulated.".format(line))
+                return False
+
+            match = self.SELECTION_LINE_REGEX.fullmatch(line)
+
+            if match and not self._add_selection(*match.groups()):
+                logger.debug("Selection line '{}' of the AIDE configuration "
+                             "can't be emulated.".format(line))
+                return False
+
+        self.roots = self._get_roots()
+
+        return True
+
+    def _add_selection(self, kind, pattern, rule_name):
+        regex = re.compile("^" + pattern)
+
+        if kind == "!":
+            excludes_tree = "$" not in pattern
+            self.negative_regexes.append((regex, excludes_tree))
+            self.is_exact = self.is_exact and excludes_tree
+            return True
+
+        path = pattern.rstrip("$")
+
+        if any(c in self.REGEX_SPECIAL_CHARS for c in path.replace(".", "")):
+            return False
+
+        if kind == "=":
+            self.is_exact = False
+
+        self.selections.append((regex, "$" not in pattern, path, rule_name))
+        self.roots.append(os.path.dirname(path) or os.path.sep)
+
+        return True
+
+    def _get_roots(self):
+        """Return sorted roots of the walked trees without nested ones."""
+
+        roots = []
+
+        for root in sorted(set(self.roots)):
+            if not roots or os.path.commonpath([roots[-1], root]) != roots[-1]:
+                roots.append(root)
+
+        return roots
+
+    def get_rule_name(self, path):
+        """Return name of the rule of the most specific selection line (with
+           the longest path) selecting given path or None."""
+
+        rule_name, rule_path_len = None, -1
+
+        for regex, _, sel_path, sel_rule_name in self.selections:
+            if len(sel_path) >= rule_path_len and regex.match(path):
+                rule_name, rule_path_len = sel_rule_name, len(sel_path)
+
+        return rule_name
+
+    def iterate_selected_files(self):
+        """Generator yielding (path, stat result, error) tuples of the selected
+           files in deterministic order (sorted by name within directories).
+           Error is OSError raised while listing directory (stat result is
+           None then) or while getting status of the file."""
+
+        for root in self.roots:
+            yield from self._iterate_tree(root)
+
+    def _iterate_tree(self, root):
+        try:
+            entries = sorted(os.scandir(root), key=lambda e: e.name)
+        except OSError as e:
+            yield root, None, e
+            return
+
+        for entry in entries:
+            path = entry.path
+            selected, walk_tree = self._get_selection(path)
+
+            if not selected and not walk_tree:
+                continue
+
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError as e:
+                yield path, None, e
+                continue
+
+            if selected:
+                yield path, st, None
+
+            if walk_tree and stat.S_ISDIR(st.st_mode):
+                yield from self._iterate_tree(path)
+
+    def _get_selection(self, path):
+        """Return (if path is selected, if its subtree has to be walked)
+           tuple. Subtree is walked if it may contain selected files."""
+
+        excluded, selected, walk_tree = False, False, False
+
+        for regex, excludes_tree in self.negative_regexes:
+            if regex.match(path):
+                if excludes_tree:
+                    return False, False
+                excluded = True
+
+        for regex, selects_tree, _, _ in self.selections:
+            if regex.match(path):
+                selected = True
+                walk_tree = walk_tree or selects_tree
+
+        return selected and not excluded, walk_tree or self._is_ancestor(path)
+
+    def _is_ancestor(self, path):
+        """Return True if path contains path of any selection line."""
+
+        dir_prefix = path.rstrip(os.path.sep) + os.path.sep
+        return any(s[2].startswith(dir_prefix) for s in self.selections)
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+import functools
+import logging
+import multiprocessing
+import time
+
+from myscm.common.signaturemanager import SignatureManager, SignatureManagerError
+from myscm.server.aidedbcomparator import AIDEDatabasesComparator
+from myscm.server.aidedbcomparator import AIDEDatabasesComparatorError
+from myscm.server.aidedbmanager import AIDEDatabasesManager
+from myscm.server.error import ServerError
+from myscm.server.parser import DiffEngineConfigOption
+from myscm.server.sysimggenerator import SystemImageGenerator
+from myscm.server.sysimggenerator import update_signed_catalog
+import myscm.server.pkgmanager as pkgmgr
+import myscm.server.scanner
+
+logger = logging.getLogger(__name__)
+
+# State shared by the parent process with the forked workers (see
+# `BatchSystemImageGenerator._generate_imgs_in_pool()`). Since workers are
+# forked, it's inherited without pickling and copied only if modified.
+
+_shared_server_config = None
+_shared_reference_rows = None
+
+
+class BatchSystemImageGeneratorError(ServerError):
+    pass
+
+
+class BatchSystemImageGenerator:
+    """Generator of the system images for many client's versions in one run.
+       Reference AIDE database is checked to be up-to-date and loaded only once
+       and the same is true for the package ownership index. Both are shared
+       with the pool of the worker processes, where every worker generates
+       system images (see `SystemImageGenerator`) for the subsequent client's
+       versions. Current versions of the changed files are cached by every
+       worker (see `patchmaker.read_text_file()`). System images are
+       signed at the end by the main process (together with the updated
+       catalog of the system images), so password protecting the private key
+       of the SSL certificate is asked only once."""
+
+    def __init__(self, server_config):
+        self.server_config = server_config
+        self.aide_db_manager = AIDEDatabasesManager(server_config)
+        self.processes = max(1, server_config.options.worker_threads or 1)
+        self.signature_manager = SignatureManager()
+
+    def generate_imgs(self):
+        """Generate system images for all of the existing client's AIDE
+           databases or for those in `server_config.options.gen_img_range`
+           range. Return list of the full paths to the created system
+           images."""
+
+        versions = self._get_requested_versions()
+
+        if not versions:
+            logger.info("No AIDE databases to generate system images for were "
+                        "found. Run --list-db option to list all available "
+                        "AIDE databases created so far.")
+            return []
+
+        if myscm.server.scanner.is_reference_aide_db_outdated(self.server_config):
+            m = "Current reference AIDE database '{}' is NOT up-to-date. Run "\
+                "myscm-srv with --scan option to create up-to-date aide.db "\
+                "and than rerun with --gen-img-all or --gen-img-range.".format(
+                    self.server_config.aide_reference_db_path)
+            logger.info(m)
+            return []
+
+        n = len(versions)
+        logger.info("Generating {} system image{} for client's version{} {} "
+                    "using {} process{}...".format(
+                        n, "s" if n > 1 else "", "s" if n > 1 else "",
+                        ", ".join(str(v) for v in versions), self.processes,
+                        "es" if self.processes > 1 else ""))
+
+        start = time.monotonic()
+        self._load_shared_state()
+        results = self._generate_imgs_in_pool(versions)
+        elapsed = time.monotonic() - start
+        img_paths = [r[1] for r in results if r[1]]
+        signed = self._sign_imgs(img_paths)
+        update_signed_catalog(self.server_config, self.signature_manager,
+                              signed)
+        self._report_timings(results, elapsed)
+
+        failed = [str(r[0]) for r in results if r[3]]
+
+        if failed:
+            m = "Failed to generate system image{} for client's version{} {}"\
+                .format("s" if len(failed) > 1 else "",
+                        "s" if len(failed) > 1 else "", ", ".join(failed))
+            raise BatchSystemImageGeneratorError(m)
+
+        return img_paths
+
+    def _get_requested_versions(self):
+        versions = self.aide_db_manager.get_aide_db_versions()
+        ver_range = self.server_config.options.gen_img_range
+
+        if ver_range is None:
+            return versions
+
+        first, last = ver_range
+        requested_versions = [v for v in versions if first <= v <= last]
+        missing = len(range(first, last + 1)) - len(requested_versions)
+
+        if missing:
+            logger.warning("{} AIDE database{} of the {}-{} range {} missing "
+                           "(see --list-db option).".format(
+                               missing, "s" if missing > 1 else "", first,
+                               last, "are" if missing > 1 else "is"))
+
+        return requested_versions
+
+    def _load_shared_state(self):
+        """Load state that will be shared by all of the workers."""
+
+        global _shared_server_config, _shared_reference_rows
+
+        _shared_server_config = self.server_config
+        _shared_reference_rows = None
+        diff_engine = self.server_config.options.diff_engine
+
+        if diff_engine == DiffEngineConfigOption.DB_DIFF_ENGINE:
+            ref_db_path = self.server_config.aide_reference_db_path
+            comparator = AIDEDatabasesComparator(ref_db_path, ref_db_path)
+
+            try:
+                _shared_reference_rows = comparator.load_reference_rows()
+            except AIDEDatabasesComparatorError as e:
+                m = "Failed to load reference AIDE database '{}'".format(
+                        ref_db_path)
+                raise BatchSystemImageGeneratorError(m, e) from e
+
+        try:
+            pkgmgr.get_package_index(self.server_config)
+        except pkgmgr.PackageManagerError as e:
+            m = "Failed to load package ownership index"
+            raise BatchSystemImageGeneratorError(m, e) from e
+
+    def _generate_imgs_in_pool(self, versions):
+        """Return list of (version, image path, seconds, error message) tuples
+           ordered by the version."""
+
+        if self.processes == 1 or len(versions) == 1:
+            return [_generate_img(v) for v in versions]
+
+        # Workers must be forked to inherit already loaded shared state
+
+        ctx = multiprocessing.get_context("fork")
+        processes = min(self.processes, len(versions))
+
+        # Threads compressing system images are shared among the workers
+
+        generate_img = functools.partial(
+                _generate_img,
+                compression_threads=max(1, self.processes // processes))
+
+        with ctx.Pool(processes) as pool:
+            results = pool.map(generate_img, versions, chunksize=1)
+
+        return results
+
+    def _sign_imgs(self, img_paths):
+        """Sign system images. Return False if signing was skipped by the
+           user."""
+
+        sig_manager = self.signature_manager
+        priv_key = self.server_config.options.SSL_cert_priv_key_path
+
+        for img_path in img_paths:
+            img_sig_path = img_path + SignatureManager.SIGNATURE_EXT
+
+            try:
+                signed = sig_manager.ssl_sign(img_path, img_sig_path, priv_key)
+            except SignatureManagerError as e:
+                m = "Failed to create digital signature for '{}'".format(
+                        img_path)
+                raise BatchSystemImageGeneratorError(m, e) from e
+
+            if not signed:
+                logger.info("Generating SSL signatures of the remaining "
+                            "system images skipped.")
+                return False
+
+            logger.info("Signature of the system image '{}' created "
+                        "successfully!".format(img_sig_path))
+
+        return True
+
+    def _report_timings(self, results, elapsed):
+        lines = ["System images generation summary:", ""]
+        lines.append("    {:<12}{:>12}  {}".format("version", "time [s]",
+                                                   "system image"))
+
+        for version, img_path, seconds, error in results:
+            lines.append("    {:<12}{:>12.2f}  {}".format(
+                version, seconds, img_path or "FAILED"))
+
+        total = sum(r[2] for r in results)
+        lines.append("")
+        lines.append("    {:<12}{:>12.2f}  (sum of all jobs)".format("total",
+                                                                   total))
+        lines.append("    {:<12}{:>12.2f}  (wall clock)".format("elapsed",
+                                                              elapsed))
+        logger.info("\n".join(lines))
+
+
+def _generate_img(version, compression_threads=None):
+    """Generate not signed system image for given client's version in the
+       worker process."""
+
+    start = time.monotonic()
+    img_path, error = None, None
+
+    try:
+        generator = SystemImageGenerator(_shared_server_config, version,
+                                         _shared_reference_rows)
+        generator.sign_img = False
+        generator.update_catalog = False
+
+        if compression_threads:
+            generator.compression_threads = compression_threads
+
+        # Daemonic pool workers are not allowed to have child processes
+
+        if multiprocessing.current_process().daemon:
+            generator.patch_processes = 1
+
+        img_path = generator.generate_img(check_outdated=False)
+    except Exception as e:
+        logger.error("Failed to generate system image for client's version "
+                     "{}: {}".format(version, e))
+        error = str(e) or type(e).__name__
+
+    return version, img_path, time.monotonic() - start, error
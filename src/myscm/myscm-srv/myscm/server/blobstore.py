@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import logging
+import os
+import struct
+import tarfile
+
+from tempfile import NamedTemporaryFile
+
+from myscm.server.error import ServerError
+
+logger = logging.getLogger(__name__)
+
+_MIB = 1024 * 1024
+
+
+class BlobStoreError(ServerError):
+    pass
+
+
+class BlobStore:
+    """Content-addressed store of the compressed content of the files added
+       to the system images, shared by all of the system images generated by
+       the server. Blobs are keyed by the SHA-256 digest of the file's content
+       (padded to the tar's block size), so file added to the images of many
+       client's versions is compressed once (see `IndexedSysImgWriter`).
+
+       Every blob holds the compressed blocks of the content (ready to be
+       copied into the image), followed by the table of their compressed and
+       uncompressed sizes and the trailer. Blob is used only if SHA-256 digest
+       of its compressed blocks saved in the trailer matches. Least recently
+       used blobs are removed once store exceeds its size limit."""
+
+    BLOBS_DIR_NAME = "blobs"
+    MIN_FILE_SIZE = 64 * 1024  # smaller files are compressed every time
+    BLOCK_STRUCT = struct.Struct("<QQ")  # compressed, uncompressed size
+    TRAILER_STRUCT = struct.Struct("<Q32s")  # blocks count, SHA256 digest
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self, cache_dir, max_size=None):
+        """Constructor initialized by the server's cache directory and size
+           limit of the store in MiB (zero or None means no limit)."""
+
+        self.blobs_dir = os.path.join(cache_dir, self.BLOBS_DIR_NAME)
+        self.max_size = max_size * _MIB if max_size else None
+
+    def get_key(self, fileobj, size):
+        """Return key of the blob holding content of the file object (which
+           is read and rewound to its current position)."""
+
+        position = fileobj.tell()
+        content_hash = hashlib.sha256()
+        remaining = size
+
+        while remaining:
+            data = fileobj.read(min(remaining, self.READ_SIZE))
+
+            if not data:
+                break
+
+            content_hash.update(data)
+            remaining -= len(data)
+
+        fileobj.seek(position)
+        content_hash.update(tarfile.NUL * self._get_padding_size(size))
+
+        return content_hash.hexdigest()
+
+    def get(self, codec, key):
+        """Return `_Blob` with content compressed by the given codec or None
+           if it's missing or corrupted."""
+
+        path = self._get_blob_path(codec, key)
+
+        try:
+            blob = _Blob(path)
+            blob.verify()
+            os.utime(path)  # marks blob as recently used
+        except FileNotFoundError:
+            return None
+        except (OSError, BlobStoreError) as e:
+            logger.warning("Ignoring corrupted blob '{}' ({}).".format(path, e))
+            self._remove(path)
+            return None
+
+        logger.debug("Reusing compressed content of '{}' blob.".format(key))
+
+        return blob
+
+    def create(self, codec, key):
+        """Return `_BlobWriter` of the blob with content compressed by the
+           given codec."""
+
+        return _BlobWriter(self._get_blob_path(codec, key), key)
+
+    def prune(self):
+        """Remove least recently used blobs until store doesn't exceed its
+           size limit."""
+
+        if self.max_size:
+            remove_least_recently_used(self.blobs_dir, self.max_size)
+
+    def _get_blob_path(self, codec, key):
+        codec_dir = "{}-{}".format(codec.NAME, codec.level)
+        return os.path.join(self.blobs_dir, codec_dir, key[:2], key)
+
+    @staticmethod
+    def _get_padding_size(size):
+        remainder = size % tarfile.BLOCKSIZE
+        return tarfile.BLOCKSIZE - remainder if remainder else 0
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("Failed to remove blob '{}' ({}).".format(path, e))
+
+
+def remove_least_recently_used(dir_path, max_size):
+    """Remove least recently used (i.e. modified or touched) files of the
+       cache directory (recursively) until their total size doesn't exceed
+       given number of bytes. Hidden files (which are being written) are
+       skipped."""
+
+    files = []
+
+    for subdir_path, _, fnames in os.walk(dir_path):
+        for fname in fnames:
+            if fname.startswith("."):
+                continue
+
+            path = os.path.join(subdir_path, fname)
+
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+
+            files.append((st.st_mtime, st.st_size, path))
+
+    size = sum(f[1] for f in files)
+    n = 0
+
+    for _, file_size, path in sorted(files):
+        if size <= max_size:
+            break
+
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("Failed to remove '{}' from the cache ({})."
+                           .format(path, e))
+            continue
+
+        size -= file_size
+        n += 1
+
+    if n:
+        logger.debug("Removed {} least recently used file{} from '{}'."
+                     .format(n, "s" if n > 1 else "", dir_path))
+
+
+class _Blob:
+    """Reader of the compressed blocks of the blob."""
+
+    def __init__(self, path):
+        self.path = path
+        self.blocks = []  # [compressed, uncompressed] sizes of the blocks
+        self.digest = None
+
+        trailer_size = BlobStore.TRAILER_STRUCT.size
+
+        with open(path, "rb") as blob_f:
+            blob_f.seek(0, os.SEEK_END)
+            blob_size = blob_f.tell()
+
+            if blob_size < trailer_size:
+                raise BlobStoreError("Blob is truncated")
+
+            blob_f.seek(blob_size - trailer_size)
+            n, self.digest = BlobStore.TRAILER_STRUCT.unpack(
+                    blob_f.read(trailer_size))
+            table_size = n * BlobStore.BLOCK_STRUCT.size
+            self.data_size = blob_size - trailer_size - table_size
+
+            if self.data_size < 0:
+                raise BlobStoreError("Blob is truncated")
+
+            blob_f.seek(self.data_size)
+            table = blob_f.read(table_size)
+            self.blocks = [list(b) for b in
+                           BlobStore.BLOCK_STRUCT.iter_unpack(table)]
+
+        if sum(b[0] for b in self.blocks) != self.data_size:
+            raise BlobStoreError("Blocks table doesn't match blob's size")
+
+    def verify(self):
+        data_hash = hashlib.sha256()
+
+        with open(self.path, "rb") as blob_f:
+            remaining = self.data_size
+
+            while remaining:
+                data = blob_f.read(min(remaining, BlobStore.READ_SIZE))
+
+                if not data:
+                    raise BlobStoreError("Blob is truncated")
+
+                data_hash.update(data)
+                remaining -= len(data)
+
+        if data_hash.digest() != self.digest:
+            raise BlobStoreError("SHA-256 checksum mismatch")
+
+    def iterate_blocks(self):
+        """Generator yielding (compressed data, uncompressed size) tuples."""
+
+        try:
+            with open(self.path, "rb") as blob_f:
+                for length, size in self.blocks:
+                    data = blob_f.read(length)
+
+                    if len(data) != length:
+                        raise BlobStoreError("Blob '{}' is truncated".format(
+                                             self.path))
+
+                    yield data, size
+        except OSError as e:
+            m = "Failed to read blob '{}'".format(self.path)
+            raise BlobStoreError(m, e) from e
+
+
+class _BlobWriter:
+    """Writer of the blob, which is saved atomically on `commit()` if written
+       uncompressed content matches blob's key (e.g. file wasn't modified
+       since its key was computed). Failing to save blob is not an error -
+       blob is just not cached."""
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.content_hash = hashlib.sha256()
+        self.data_hash = hashlib.sha256()
+        self.blocks = []
+        self.blob_f = None
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.blob_f = NamedTemporaryFile(mode="wb", prefix=".",
+                                             dir=os.path.dirname(path),
+                                             delete=False)
+        except OSError as e:
+            logger.warning("Failed to create blob '{}' ({}).".format(path, e))
+
+    def update(self, data):
+        """Update hash of the uncompressed content."""
+
+        self.content_hash.update(data)
+
+    def write_block(self, data, size):
+        if not self.blob_f:
+            return
+
+        try:
+            self.blob_f.write(data)
+        except OSError as e:
+            logger.warning("Failed to write blob '{}' ({}).".format(
+                           self.path, e))
+            self.abort()
+            return
+
+        self.data_hash.update(data)
+        self.blocks.append((len(data), size))
+
+    def commit(self):
+        if not self.blob_f:
+            return
+
+        if self.content_hash.hexdigest() != self.key:
+            logger.debug("Content of '{}' blob changed while it was written - "
+                         "discarding it.".format(self.key))
+            self.abort()
+            return
+
+        try:
+            for block in self.blocks:
+                self.blob_f.write(BlobStore.BLOCK_STRUCT.pack(*block))
+
+            self.blob_f.write(BlobStore.TRAILER_STRUCT.pack(
+                len(self.blocks), self.data_hash.digest()))
+            self.blob_f.close()
+            os.replace(self.blob_f.name, self.path)
+        except OSError as e:
+            logger.warning("Failed to save blob '{}' ({}).".format(
+                           self.path, e))
+            self.abort()
+            return
+
+        self.blob_f = None
+
+    def abort(self):
+        if not self.blob_f:
+            return
+
+        self.blob_f.close()
+        BlobStore._remove(self.blob_f.name)
+        self.blob_f = None
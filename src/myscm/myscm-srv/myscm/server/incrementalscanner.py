@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+import base64
+import hashlib
+import logging
+import os
+import re
+import time
+import urllib.parse
+
+from tempfile import NamedTemporaryFile
+
+from myscm.common.cmd import long_run_cmd, CommandLineError
+from myscm.server.aidedbparser import AIDEDatabaseFileParser
+from myscm.server.aidedbparser import AIDEDatabaseFileParserError
+from myscm.server.aideselection import AIDESelection
+from myscm.server.error import ServerError
+from myscm.server.statsnapshot import StatSnapshot
+
+logger = logging.getLogger(__name__)
+
+
+class IncrementalScannerError(ServerError):
+    pass
+
+
+class IncrementalScanner:
+    """Creator of the new AIDE database (AIDE's `database_out`) that reuses
+       rows of the reference AIDE database describing files whose i-node,
+       size, modification time and change time are unchanged. AIDE --init is
+       ran only for new and modified files (using temporary AIDE configuration
+       selecting only those files) and its result is merged with the reused
+       rows, so the new database has exactly the same format as the one
+       created by AIDE itself.
+
+       Any change of the file's permissions, owner, number of hard links,
+       ACLs or extended attributes updates its change time. Files changed in
+       the same second as the reference database was created (or later) are
+       rehashed anyway, since AIDE stores times with one second resolution.
+
+       Incremental scanning is not possible (and `scan()` returns False) if
+       there is no reference database, if AIDE configuration was changed since
+       creating reference database (see `StatSnapshot`), if selection of the
+       tracked files can't be emulated exactly (see `AIDESelection`) or if
+       access times are tracked."""
+
+    REQUIRED_COLUMNS = ["inode", "size", "mtime", "ctime"]
+    UNSUPPORTED_COLUMNS = ["atime"]
+    GENERATION_TIME_REGEX = re.compile(
+        r"# Time of generation was (\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)\s*")
+    GENERATION_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+    GENERATION_TIME_MARGIN = 3600  # [s] since it's local time (DST changes)
+    OVERRIDDEN_VARIABLES_REGEX = re.compile(
+        r"\s*(database_out|gzip_dbout)\s*=.*")
+    AIDE_REGEX_SPECIAL_CHARS = set(".^$*+?{}[]\\|()")
+
+    def __init__(self, server_config):
+        self.server_config = server_config
+        self.aide_config_path = server_config.options.AIDE_config_path
+        self.ref_db_path = server_config.aide_reference_db_path
+        self.selection = AIDESelection(self.aide_config_path)
+
+    def scan(self):
+        """Create new AIDE database reusing rows of the unchanged files. Return
+           False if incremental scanning is not possible."""
+
+        try:
+            return self._scan()
+        except (OSError, ValueError, CommandLineError,
+                AIDEDatabaseFileParserError) as e:
+            m = "Incremental scanning based on the reference AIDE database "\
+                "'{}' failed".format(self.ref_db_path)
+            raise IncrementalScannerError(m, e) from e
+
+    def _scan(self):
+        if not self._is_incremental_scan_possible():
+            return False
+
+        header, columns = self._read_header(self.ref_db_path)
+        racy_time = self._get_generation_time(header)
+
+        if racy_time is None or not self._are_columns_supported(columns):
+            return False
+
+        reused_rows, changed_paths, removed_count = self._classify_files(
+                                                    columns, racy_time)
+
+        if reused_rows is None:
+            return False
+
+        logger.info("Reusing AIDE database rows of {} unchanged files ({} "
+                    "new or modified, {} removed).".format(
+                        len(reused_rows), len(changed_paths), removed_count))
+
+        new_rows = {}
+
+        if changed_paths:
+            header, new_rows = self._scan_changed_files(changed_paths, columns)
+
+            if header is None:
+                return False
+
+        reused_rows.update(new_rows)
+        self._write_aide_db(header, reused_rows)
+
+        return True
+
+    def _is_incremental_scan_possible(self):
+        if not os.path.isfile(self.ref_db_path):
+            logger.debug("Reference AIDE database doesn't exist yet - "
+                         "incremental scanning is not possible.")
+            return False
+
+        if not self.selection.read() or not self.selection.is_exact:
+            logger.info("Selection lines of the AIDE configuration '{}' can't "
+                        "be emulated - incremental scanning is not possible."
+                        .format(self.aide_config_path))
+            return False
+
+        saved_snapshot = StatSnapshot.load_saved(self.ref_db_path)
+        config_digest = hashlib.blake2b(self.selection.config_bytes).hexdigest()
+
+        if not saved_snapshot or\
+           saved_snapshot.get("aide_config_digest") != config_digest:
+            logger.info("AIDE configuration '{}' might be changed since "
+                        "reference AIDE database was created - incremental "
+                        "scanning is not possible.".format(
+                            self.aide_config_path))
+            return False
+
+        return True
+
+    def _read_header(self, aide_db_path):
+        """Return lines of the AIDE database's header (till '@@db_spec' line
+           inclusive) and names of the columns."""
+
+        header = []
+        db_spec_opening = AIDEDatabaseFileParser.AIDE_DB_PROPERTIES_OPENING
+
+        with open(aide_db_path) as db_f:
+            for line in db_f:
+                header.append(line)
+                words = line.split()
+
+                if words and words[0] == db_spec_opening:
+                    return header, words[1:]
+
+        m = "Malformed AIDE database '{}', '{}' not found".format(
+                aide_db_path, db_spec_opening)
+        raise AIDEDatabaseFileParserError(m)
+
+    def _get_generation_time(self, header):
+        """Return time (seconds since epoch) since which files' changes might
+           be not detected by comparing their properties (minus margin)."""
+
+        for line in header:
+            match = self.GENERATION_TIME_REGEX.fullmatch(line)
+
+            if match:
+                t = time.strptime(match.group(1), self.GENERATION_TIME_FORMAT)
+                return time.mktime(t) - self.GENERATION_TIME_MARGIN
+
+        logger.info("Time of generation of the reference AIDE database not "
+                    "found - incremental scanning is not possible.")
+
+        return None
+
+    def _are_columns_supported(self, columns):
+        if any(c in columns for c in self.UNSUPPORTED_COLUMNS) or\
+           not all(c in columns for c in self.REQUIRED_COLUMNS):
+            logger.info("Reference AIDE database properties are not supported "
+                        "- incremental scanning is not possible.")
+            return False
+
+        return True
+
+    def _classify_files(self, columns, racy_time):
+        """Return (reused rows, changed paths, removed files count) tuple,
+           where reused rows is dictionary mapping paths of the unchanged
+           files to their rows of the reference database. Return (None, None,
+           None) tuple if selected files can't be listed."""
+
+        old_rows = self._load_rows(self.ref_db_path)
+        cols = [columns.index(c) for c in self.REQUIRED_COLUMNS]
+        reused_rows, changed_paths = {}, []
+
+        for path, st, error in self.selection.iterate_selected_files():
+            if error:
+                logger.info("Unable to list or read '{}' ({}) - incremental "
+                            "scanning is not possible.".format(path, error))
+                return None, None, None
+
+            row = old_rows.pop(path, None)
+
+            if row is not None and self._is_row_unchanged(row, cols, st,
+                                                          racy_time):
+                reused_rows[path] = row
+            else:
+                changed_paths.append(path)
+
+        return reused_rows, changed_paths, len(old_rows)
+
+    def _load_rows(self, aide_db_path):
+        """Return dictionary mapping (decoded) paths to the raw rows."""
+
+        parser = AIDEDatabaseFileParser(aide_db_path)
+        rows = {}
+
+        for encoded_path, row in parser.iterate_rows():
+            path = urllib.parse.unquote(encoded_path) if "%" in encoded_path\
+                else encoded_path
+            rows[path] = row
+
+        return rows
+
+    def _is_row_unchanged(self, row, cols, st, racy_time):
+        if st.st_ctime >= racy_time:
+            return False
+
+        values = row.split()
+        inode_col, size_col, mtime_col, ctime_col = cols
+
+        try:
+            return int(values[inode_col]) == st.st_ino and\
+                int(values[size_col]) == st.st_size and\
+                int(base64.b64decode(values[mtime_col])) == int(st.st_mtime) and\
+                int(base64.b64decode(values[ctime_col])) == int(st.st_ctime)
+        except (IndexError, ValueError):
+            return False
+
+    def _scan_changed_files(self, changed_paths, columns):
+        """Run AIDE --init for the given files only. Return header and
+           dictionary mapping paths to the rows of the created database or
+           (None, None) tuple if result can't be merged with the reference
+           database."""
+
+        out_dir = self.server_config.aide_out_db_dir
+
+        with NamedTemporaryFile(mode="w", suffix=".aide.conf") as conf_f,\
+                NamedTemporaryFile(suffix=".aide.db", dir=out_dir) as db_f:
+            self._write_aide_config(conf_f, db_f.name, changed_paths)
+            conf_f.flush()
+
+            n = len(changed_paths)
+            cmd = ["aide", "--init", "-c", conf_f.name]
+            long_run_cmd(cmd, True, suffix_msg="to scan {} new or modified "
+                         "file{}".format(n, "s" if n > 1 else ""))
+
+            header, new_columns = self._read_header(db_f.name)
+            new_rows = self._load_rows(db_f.name)
+
+        if new_columns != columns:
+            logger.info("Properties of the AIDE database created for new and "
+                        "modified files differ from the reference database - "
+                        "incremental scanning is not possible.")
+            return None, None
+
+        missing = [p for p in changed_paths
+                   if p not in new_rows and os.path.lexists(p)]
+
+        if missing:
+            logger.info("{} new or modified file{} (e.g. '{}') not scanned by "
+                        "AIDE - incremental scanning is not possible.".format(
+                            len(missing), "s" if len(missing) > 1 else "",
+                            missing[0]))
+            return None, None
+
+        return header, new_rows
+
+    def _write_aide_config(self, conf_f, out_db_path, paths):
+        """Write AIDE configuration with the same rules as the original one,
+           but with selection lines selecting only given paths."""
+
+        with open(self.aide_config_path) as orig_conf_f:
+            for line in orig_conf_f:
+                if AIDESelection.SELECTION_LINE_REGEX.fullmatch(line.rstrip()):
+                    continue
+                if self.OVERRIDDEN_VARIABLES_REGEX.fullmatch(line.rstrip()):
+                    continue
+                conf_f.write(line if line.endswith("\n") else line + "\n")
+
+        conf_f.write("database_out = file:{}\n".format(out_db_path))
+        conf_f.write("gzip_dbout = no\n")
+
+        for path in paths:
+            rule_name = self.selection.get_rule_name(path)
+            conf_f.write("{}$ {}\n".format(self._get_aide_regex(path),
+                                           rule_name))
+
+    def _get_aide_regex(self, path):
+        """Return regular expression matching exactly given path. Whitespaces
+           and '%' characters are URL-encoded (see aide.conf(5) manual)."""
+
+        chars = []
+
+        for c in path:
+            if c in self.AIDE_REGEX_SPECIAL_CHARS:
+                chars.append("\\" + c)
+            elif c.isspace() or c == "%" or not c.isprintable():
+                encoded = c.encode("utf-8", "surrogateescape")
+                chars.append(urllib.parse.quote_from_bytes(encoded, safe=""))
+            else:
+                chars.append(c)
+
+        return "".join(chars)
+
+    def _write_aide_db(self, header, rows):
+        out_db_path = self.server_config.aide_out_db_path
+        out_dir = os.path.dirname(out_db_path)
+
+        with NamedTemporaryFile(mode="w", dir=out_dir, delete=False) as db_f:
+            db_f.writelines(header)
+
+            for path in sorted(rows):
+                db_f.write(rows[path] + "\n")
+
+            db_f.write(AIDEDatabaseFileParser.AIDE_DB_FILE_CLOSING)
+
+        os.replace(db_f.name, out_db_path)
+
+        logger.debug("AIDE database '{}' of {} files created incrementally."
+                     .format(out_db_path, len(rows)))
@@ -7,10 +7,12 @@ import myscm.server.config
 
 from myscm.common.parser import CommandLineFlagConfigOption
 from myscm.common.parser import ConfigParser
+from myscm.common.parser import GeneralChoiceConfigOption
 from myscm.common.parser import GeneralConfigOption
 from myscm.common.parser import ParserError
 from myscm.common.parser import ValidatedCommandLineConfigOption
 from myscm.common.parser import ValidatedFileConfigOption
+from myscm.common.sysimgarchive import SYS_IMG_CODECS, DEFAULT_SYS_IMG_CODEC
 from myscm.server.aidedbverfile import MySCMDatabaseVersionFile
 
 _APP_VERSION = myscm.common.constants.get_app_version("myscm-srv")
@@ -192,6 +194,294 @@ class GenerateSystemImageConfigOption(ValidatedCommandLineConfigOption):
         return myscm.common.parser.assert_sys_img_ver_valid(sys_img_ver)
 
 
+class GenerateAllSystemImagesConfigOption(CommandLineFlagConfigOption):
+    """Configuration option read from CLI specifying to generate system images
+       for all of the existing client's AIDE databases in one run."""
+
+    def __init__(self):
+        super().__init__(
+            "GenImgAll", "--gen-img-all",
+            help="generate system images for all of the existing AIDE "
+                 "databases aide.db.X created with --scan option (see "
+                 "--gen-img option)")
+
+
+class GenerateSystemImagesRangeConfigOption(ValidatedCommandLineConfigOption):
+    """Configuration option read from CLI specifying to generate system images
+       for the range of the client's versions in one run."""
+
+    def __init__(self):
+        super().__init__(
+            "GenImgRange", None, self._assert_sys_img_ver_range_valid,
+            "--gen-img-range", metavar="FIRST-LAST",
+            type=self._assert_sys_img_ver_range_valid,
+            help="generate system images for every existing AIDE database "
+                 "aide.db.X, where X is between FIRST and LAST non-negative "
+                 "integers (inclusive, see --gen-img option)")
+
+    def _assert_sys_img_ver_range_valid(self, ver_range):
+        first, sep, last = str(ver_range).partition("-")
+
+        if not sep:
+            m = "Specified range of the system image versions '{}' is not in "\
+                "FIRST-LAST format".format(ver_range)
+            raise ServerParserError(m)
+
+        first = myscm.common.parser.assert_sys_img_ver_valid(first)
+        last = myscm.common.parser.assert_sys_img_ver_valid(last)
+
+        if first > last:
+            m = "First system image version of the range '{}' is greater "\
+                "than the last one".format(ver_range)
+            raise ServerParserError(m)
+
+        return first, last
+
+
+class DiffEngineConfigOption(GeneralChoiceConfigOption):
+    """Configuration option read from file and/or CLI specifying how changes
+       between client's system state and current server's state are detected
+       while generating system image with --gen-img option."""
+
+    DB_DIFF_ENGINE = "db"
+    AIDE_DIFF_ENGINE = "aide"
+    DIFF_ENGINES = [DB_DIFF_ENGINE, AIDE_DIFF_ENGINE]
+    DEFAULT_DIFF_ENGINE = DB_DIFF_ENGINE
+
+    def __init__(self, diff_engine=None):
+        super().__init__(
+            "DiffEngine", diff_engine or self.DEFAULT_DIFF_ENGINE,
+            self.DIFF_ENGINES, False, "--diff-engine", metavar="ENGINE",
+            help="method of detecting changes while generating system image "
+                 "with --gen-img option; '{}' compares client's AIDE "
+                 "database with up-to-date reference AIDE database, '{}' "
+                 "runs AIDE --check against client's AIDE database which "
+                 "rescans whole filesystem (default value: '{}')".format(
+                    self.DB_DIFF_ENGINE, self.AIDE_DIFF_ENGINE,
+                    self.DEFAULT_DIFF_ENGINE))
+
+
+class ScanModeConfigOption(GeneralChoiceConfigOption):
+    """Configuration option read from file and/or CLI specifying whether
+       --scan option rehashes all of the tracked files or only those whose
+       metadata was changed since creating reference AIDE database."""
+
+    FULL_SCAN_MODE = "full"
+    INCREMENTAL_SCAN_MODE = "incremental"
+    SCAN_MODES = [FULL_SCAN_MODE, INCREMENTAL_SCAN_MODE]
+    DEFAULT_SCAN_MODE = FULL_SCAN_MODE
+
+    def __init__(self, scan_mode=None):
+        super().__init__(
+            "ScanMode", scan_mode or self.DEFAULT_SCAN_MODE, self.SCAN_MODES,
+            False, "--scan-mode", metavar="MODE",
+            help="mode of the --scan option; '{}' runs AIDE --init which "
+                 "rehashes all of the tracked files, '{}' reuses properties "
+                 "of the files from the reference AIDE database if their "
+                 "i-node, size, modification and change times are unchanged "
+                 "and runs AIDE --init only for new and modified files "
+                 "(default value: '{}')".format(
+                    self.FULL_SCAN_MODE, self.INCREMENTAL_SCAN_MODE,
+                    self.DEFAULT_SCAN_MODE))
+
+
+class FreshnessCheckConfigOption(GeneralChoiceConfigOption):
+    """Configuration option read from file and/or CLI specifying how it's
+       checked if reference AIDE database is up-to-date (both before --scan
+       and --gen-img options)."""
+
+    SNAPSHOT_FRESHNESS_CHECK = "snapshot"
+    AIDE_FRESHNESS_CHECK = "aide"
+    FRESHNESS_CHECKS = [SNAPSHOT_FRESHNESS_CHECK, AIDE_FRESHNESS_CHECK]
+    DEFAULT_FRESHNESS_CHECK = SNAPSHOT_FRESHNESS_CHECK
+
+    def __init__(self, freshness_check=None):
+        super().__init__(
+            "FreshnessCheck", freshness_check or self.DEFAULT_FRESHNESS_CHECK,
+            self.FRESHNESS_CHECKS, False, "--freshness-check",
+            metavar="METHOD",
+            help="method of checking if reference AIDE database is "
+                 "up-to-date; '{}' compares metadata of the tracked files "
+                 "with their snapshot saved by --scan option and runs AIDE "
+                 "--check only if metadata was changed, '{}' always runs AIDE "
+                 "--check (default value: '{}')".format(
+                    self.SNAPSHOT_FRESHNESS_CHECK, self.AIDE_FRESHNESS_CHECK,
+                    self.DEFAULT_FRESHNESS_CHECK))
+
+
+class SystemImgCompressionConfigOption(GeneralChoiceConfigOption):
+    """Configuration option read from file and/or CLI specifying compression
+       of the generated system images."""
+
+    def __init__(self, compression=None):
+        super().__init__(
+            "SystemImgCompression", compression or DEFAULT_SYS_IMG_CODEC,
+            SYS_IMG_CODECS, False, "--img-compression", metavar="CODEC",
+            help="compression of the system images generated with --gen-img "
+                 "option; files are compressed in blocks by the pool of "
+                 "--threads threads; images compressed with other codec than "
+                 "'{}' can be applied only by clients supporting it and, "
+                 "despite their '.tar.gz' suffix, can't be read by gzip "
+                 "tools, 'zstd' requires 'zstandard' Python module (default "
+                 "value: '{}')".format(DEFAULT_SYS_IMG_CODEC,
+                                       DEFAULT_SYS_IMG_CODEC))
+
+
+class PatchTimeoutConfigOption(GeneralConfigOption):
+    """Configuration option read from file and/or CLI specifying time limit
+       of creating patch of the single changed file while generating system
+       image."""
+
+    DEFAULT_PATCH_TIMEOUT = 60
+
+    def __init__(self, timeout=None):
+        super().__init__(
+                "PatchTimeout",
+                timeout or self.DEFAULT_PATCH_TIMEOUT,
+                self._assert_patch_timeout_valid,
+                False,
+                "--patch-timeout", metavar="SECONDS",
+                type=self._assert_patch_timeout_valid,
+                help="time limit of creating patch of the single changed file "
+                     "while generating system image with --gen-img option; "
+                     "whole file is added to the system image if it's "
+                     "exceeded, 0 means no limit (default value: {})".format(
+                        self.DEFAULT_PATCH_TIMEOUT))
+
+    def _assert_patch_timeout_valid(self, timeout_string):
+        timeout = None
+
+        try:
+            timeout = float(timeout_string)
+        except ValueError:
+            m = "Given patch timeout is not a number (given value: '{}')"\
+                .format(timeout_string)
+            raise ServerParserError(m)
+
+        if timeout < 0:
+            m = "Patch timeout must be a non-negative number (given value: "\
+                "{})".format(timeout)
+            raise ServerParserError(m)
+
+        return timeout
+
+
+class PatchSizeLimitConfigOption(GeneralConfigOption):
+    """Configuration option read from file and/or CLI specifying size limit
+       of the changed files whose patches are created while generating system
+       image."""
+
+    DEFAULT_PATCH_SIZE_LIMIT = 256
+
+    def __init__(self, size_limit=None):
+        super().__init__(
+                "PatchSizeLimit",
+                size_limit or self.DEFAULT_PATCH_SIZE_LIMIT,
+                self._assert_patch_size_limit_valid,
+                False,
+                "--patch-size-limit", metavar="MIB",
+                type=self._assert_patch_size_limit_valid,
+                help="size limit (in MiB) of the changed files whose patches "
+                     "are created while generating system image with "
+                     "--gen-img option; bigger files are added whole to the "
+                     "system image, 0 means no limit (default value: {})"
+                     .format(self.DEFAULT_PATCH_SIZE_LIMIT))
+
+    def _assert_patch_size_limit_valid(self, size_limit_string):
+        size_limit = None
+
+        try:
+            size_limit = int(size_limit_string)
+        except ValueError:
+            m = "Given patch size limit is not integer (given value: '{}')"\
+                .format(size_limit_string)
+            raise ServerParserError(m)
+
+        if size_limit < 0:
+            m = "Patch size limit must be a non-negative integer (given "\
+                "value: {})".format(size_limit)
+            raise ServerParserError(m)
+
+        return size_limit
+
+
+class PatchCacheSizeConfigOption(GeneralConfigOption):
+    """Configuration option read from file and/or CLI specifying size limit
+       of the cache of the patches of the changed files."""
+
+    DEFAULT_PATCH_CACHE_SIZE = 256
+
+    def __init__(self, cache_size=None):
+        super().__init__(
+                "PatchCacheSize",
+                cache_size or self.DEFAULT_PATCH_CACHE_SIZE,
+                self._assert_patch_cache_size_valid,
+                False,
+                "--patch-cache-size", metavar="MIB",
+                type=self._assert_patch_cache_size_valid,
+                help="size limit (in MiB) of the cache of the patches of the "
+                     "changed files, so patches shared by the system images "
+                     "of many clients are created once; 0 disables cache "
+                     "(default value: {})"
+                     .format(self.DEFAULT_PATCH_CACHE_SIZE))
+
+    def _assert_patch_cache_size_valid(self, cache_size_string):
+        cache_size = None
+
+        try:
+            cache_size = int(cache_size_string)
+        except ValueError:
+            m = "Given patch cache size is not integer (given value: '{}')"\
+                .format(cache_size_string)
+            raise ServerParserError(m)
+
+        if cache_size < 0:
+            m = "Patch cache size must be a non-negative integer (given "\
+                "value: {})".format(cache_size)
+            raise ServerParserError(m)
+
+        return cache_size
+
+
+class BlobCacheSizeConfigOption(GeneralConfigOption):
+    """Configuration option read from file and/or CLI specifying size limit
+       of the cache of the compressed content of the files added to the
+       system images."""
+
+    DEFAULT_BLOB_CACHE_SIZE = 1024
+
+    def __init__(self, cache_size=None):
+        super().__init__(
+                "BlobCacheSize",
+                cache_size or self.DEFAULT_BLOB_CACHE_SIZE,
+                self._assert_blob_cache_size_valid,
+                False,
+                "--blob-cache-size", metavar="MIB",
+                type=self._assert_blob_cache_size_valid,
+                help="size limit (in MiB) of the cache of the compressed "
+                     "content of the files added to the system images, so "
+                     "files added to the images of many clients are "
+                     "compressed once; 0 disables cache (default value: {})"
+                     .format(self.DEFAULT_BLOB_CACHE_SIZE))
+
+    def _assert_blob_cache_size_valid(self, cache_size_string):
+        cache_size = None
+
+        try:
+            cache_size = int(cache_size_string)
+        except ValueError:
+            m = "Given blob cache size is not integer (given value: '{}')"\
+                .format(cache_size_string)
+            raise ServerParserError(m)
+
+        if cache_size < 0:
+            m = "Blob cache size must be a non-negative integer (given "\
+                "value: {})".format(cache_size)
+            raise ServerParserError(m)
+
+        return cache_size
+
+
 class SystemImgOutDirConfigOption(ValidatedFileConfigOption):
     """Configuration option read from file specifying directory where
        all generated reference system images are saved."""
@@ -216,6 +506,30 @@ class SystemImgOutDirConfigOption(ValidatedFileConfigOption):
         return img_dir_path
 
 
+class CacheDirConfigOption(ValidatedFileConfigOption):
+    """Configuration option read from file specifying directory where
+       myscm-srv keeps its persistent caches (eg. package ownership index)."""
+
+    DEFAULT_CACHE_DIR = "/var/cache/myscm-srv"
+
+    def __init__(self, cache_dir=None):
+        super().__init__(
+                "CacheDir",
+                cache_dir or self.DEFAULT_CACHE_DIR,
+                self._assert_cache_dir_valid,
+                False)
+
+    def _assert_cache_dir_valid(self, cache_dir_path):
+        """Cache directory validator. Directory is created if it's missing."""
+
+        if os.path.exists(cache_dir_path) and not os.path.isdir(cache_dir_path):
+            m = "Value '{}' assigned to variable '{}' doesn't refer to "\
+                "directory".format(cache_dir_path, self.name)
+            raise ServerParserError(m)
+
+        return cache_dir_path
+
+
 class UpgradeConfigOption(ValidatedCommandLineConfigOption):
     """Run --scan and --gen-img option with specified system image version."""
 
@@ -285,7 +599,18 @@ class ServerConfigParser(ConfigParser):
             ListAvailableAIDEDatabasesConfigOption(),
             ListGeneratedMyscmSysImgConfigOption(),
             GenerateSystemImageConfigOption(),
+            GenerateAllSystemImagesConfigOption(),
+            GenerateSystemImagesRangeConfigOption(),
+            DiffEngineConfigOption(),
+            FreshnessCheckConfigOption(),
+            ScanModeConfigOption(),
+            SystemImgCompressionConfigOption(),
+            PatchTimeoutConfigOption(),
+            PatchSizeLimitConfigOption(),
+            PatchCacheSizeConfigOption(),
+            BlobCacheSizeConfigOption(),
             SystemImgOutDirConfigOption(),
+            CacheDirConfigOption(),
             UpgradeConfigOption(),
             RecentlyGeneratedDbVerPathConfigOption()
         ]
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import functools
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import threading
+import time
+
+import binaryornot.check
+import diff_match_patch as patcher
+from tempfile import mkstemp, NamedTemporaryFile
+
+from myscm.common.blockdelta import write_delta, BlockDeltaError
+from myscm.server.blobstore import remove_least_recently_used
+from myscm.server.error import ServerError
+
+logger = logging.getLogger(__name__)
+
+_CACHED_FILE_MAX_SIZE = 1024 * 1024  # see `read_text_file()`
+_MIB = 1024 * 1024
+
+
+class PatchMakerError(ServerError):
+    pass
+
+
+class _PatchTimeoutError(Exception):
+    pass
+
+
+class PatchMaker:
+    """Maker of the patches of the changed files, whose previous versions
+       were copied by `Scanner`. Text files are patched using
+       diff-match-patch, binary and big text files using block delta (see
+       `myscm.common.blockdelta`). Patches are created concurrently by the
+       pool of the worker processes (diff-match-patch is pure Python) and
+       are yielded in order of the given files, so system image can be
+       written while remaining patches are still being made.
+
+       Every file has a time budget and files bigger than the size limit are
+       not patched at all. If patch can't be made within the time budget or
+       it's not smaller than the file itself, then whole file should be added
+       to the system image instead. Patches found in the optional
+       `PatchCache` are not made again."""
+
+    TEXT_PATCH_MAX_SIZE = 4 * _MIB  # bigger files get block delta
+
+    def __init__(self, tmp_dir, processes=1, timeout=None, size_limit=None,
+                 cache=None):
+        """Constructor initialized by the directory where patches are saved,
+           number of the worker processes, time budget of every file in
+           seconds, size limit of the patched files in MiB (zero or None
+           means no limit) and optional cache of the patches."""
+
+        self.tmp_dir = tmp_dir
+        self.processes = max(1, processes or 1)
+        self.timeout = timeout or None
+        self.size_limit = size_limit * _MIB if size_limit else None
+        self.cache = cache
+
+    def iterate_patches(self, paths):
+        """Generator yielding (changed path, patch path, is block delta)
+           tuples in order of the given (changed path, old version path,
+           cache key) tuples (see `PatchCache.get_key()`, key may be None).
+           Patch path is None if whole file should be added to the system
+           image. Caller is responsible for removing patch files."""
+
+        paths = list(paths)
+        cached_patches = {}  # index of the path: (patch path, is delta)
+
+        if self.cache:
+            for i, (changed_path, _, key) in enumerate(paths):
+                cached_patch = self.cache.get(key, self.tmp_dir)
+
+                if cached_patch:
+                    cached_patches[i] = cached_patch
+
+        made_patches = self._iterate_made_patches(
+            [p[:2] for i, p in enumerate(paths) if i not in cached_patches])
+
+        try:
+            for i, (changed_path, _, key) in enumerate(paths):
+                if i in cached_patches:
+                    logger.debug("Patch of '{}' found in the cache.".format(
+                                 changed_path))
+                    yield (changed_path,) + cached_patches[i]
+                    continue
+
+                changed_path, patch_path, is_delta = next(made_patches)
+
+                if self.cache and patch_path is not None:
+                    self.cache.put(key, patch_path, is_delta)
+
+                yield changed_path, patch_path, is_delta
+        finally:
+            made_patches.close()
+
+    def _iterate_made_patches(self, paths):
+        if not paths:
+            return
+
+        make_patch = functools.partial(
+            _make_patch, tmp_dir=self.tmp_dir, timeout=self.timeout,
+            size_limit=self.size_limit,
+            text_patch_max_size=self.TEXT_PATCH_MAX_SIZE)
+
+        if self.processes == 1 or len(paths) < 2:
+            results = map(make_patch, paths)
+            yield from self._iterate_results(results)
+            return
+
+        # Workers are forked, so they inherit cache of the text files
+
+        ctx = multiprocessing.get_context("fork")
+        processes = min(self.processes, len(paths))
+
+        with ctx.Pool(processes) as pool:
+            results = pool.imap(make_patch, paths, chunksize=1)
+            yield from self._iterate_results(results)
+
+    def _iterate_results(self, results):
+        for changed_path, patch_path, is_delta, seconds, error in results:
+            if error is not None:
+                m = "Failed to create patch of the changed file '{}'".format(
+                        changed_path)
+                raise PatchMakerError(m, error)
+
+            if patch_path is None:
+                logger.debug("Patch of '{}' not created ({:.2f}s) - whole "
+                             "file will be added to the system image.".format(
+                                 changed_path, seconds))
+            else:
+                logger.debug("Patch of '{}' created in {:.2f}s.".format(
+                             changed_path, seconds))
+
+            yield changed_path, patch_path, is_delta
+
+
+class PatchCache:
+    """Persistent cache of the patches (or block deltas) of the changed files
+       keyed by SHA1 checksums of their old and new versions recorded by AIDE,
+       so patch shared by the system images of many client's versions (or
+       made by interrupted --gen-img run) is made once. Least recently used
+       patches are removed once cache exceeds its size limit."""
+
+    PATCHES_DIR_NAME = "patches"
+    PATCH_EXT = ".patch"
+    BLOCK_DELTA_EXT = ".delta"
+
+    def __init__(self, cache_dir, max_size=None):
+        """Constructor initialized by the server's cache directory and size
+           limit of the cache in MiB (zero or None means no limit)."""
+
+        self.patches_dir = os.path.join(cache_dir, self.PATCHES_DIR_NAME)
+        self.max_size = max_size * _MIB if max_size else None
+
+    @staticmethod
+    def get_key(old_sha1, new_sha1):
+        """Return key of the patch transforming file with given (hex encoded)
+           SHA1 checksum to the other one or None if any of them is unknown
+           (e.g. SHA1 is not selected in the AIDE configuration)."""
+
+        if not old_sha1 or not new_sha1:
+            return None
+
+        return "{}-{}".format(old_sha1, new_sha1)
+
+    def get(self, key, tmp_dir):
+        """Return (patch path, is block delta) tuple of the copy of the cached
+           patch saved in the given directory or None if it's not cached."""
+
+        if key is None:
+            return None
+
+        for is_delta in [False, True]:
+            path = self._get_patch_path(key, is_delta)
+
+            try:
+                cached_f = open(path, "rb")
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                logger.warning("Failed to read cached patch '{}' ({})."
+                               .format(path, e))
+                continue
+
+            with cached_f:
+                fd, patch_path = mkstemp(dir=tmp_dir)
+
+                with open(fd, "wb") as patch_f:
+                    shutil.copyfileobj(cached_f, patch_f)
+
+            with contextlib.suppress(OSError):
+                os.utime(path)  # marks patch as recently used
+
+            return patch_path, is_delta
+
+        return None
+
+    def put(self, key, patch_path, is_delta):
+        if key is None:
+            return
+
+        path = self._get_patch_path(key, is_delta)
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            with NamedTemporaryFile(mode="wb", prefix=".",
+                                    dir=os.path.dirname(path),
+                                    delete=False) as cached_f:
+                with open(patch_path, "rb") as patch_f:
+                    shutil.copyfileobj(patch_f, cached_f)
+
+            os.replace(cached_f.name, path)
+        except OSError as e:
+            logger.warning("Failed to save patch in the cache '{}' ({})."
+                           .format(path, e))
+
+    def prune(self):
+        """Remove least recently used patches until cache doesn't exceed its
+           size limit."""
+
+        if self.max_size:
+            remove_least_recently_used(self.patches_dir, self.max_size)
+
+    def _get_patch_path(self, key, is_delta):
+        ext = self.BLOCK_DELTA_EXT if is_delta else self.PATCH_EXT
+        return os.path.join(self.patches_dir, key[:2], key + ext)
+
+
+def _make_patch(paths, tmp_dir, timeout, size_limit, text_patch_max_size):
+    """Make patch in the worker process. Return (changed path, patch path, is
+       block delta, seconds, error message) tuple."""
+
+    changed_path, old_path = paths
+    start = time.monotonic()
+    patch_path, is_delta, error = None, False, None
+
+    try:
+        sizes = [os.path.getsize(p) for p in [changed_path, old_path]]
+
+        if size_limit and max(sizes) > size_limit:
+            logger.info("'{}' is bigger than patch size limit - skipping "
+                        "creating patch.".format(changed_path))
+        else:
+            is_delta = max(sizes) > text_patch_max_size or\
+                binaryornot.check.is_binary(changed_path) or\
+                binaryornot.check.is_binary(old_path)
+
+            with _time_limit(timeout):
+                try:
+                    patch_path = _write_patch(changed_path, old_path,
+                                              tmp_dir, is_delta)
+                except UnicodeDecodeError:
+                    is_delta = True  # e.g. text file not encoded in UTF-8
+                    patch_path = _write_patch(changed_path, old_path,
+                                              tmp_dir, is_delta)
+    except _PatchTimeoutError:
+        logger.info("Creating patch of '{}' exceeded time limit of {}s - "
+                    "skipping creating patch.".format(changed_path, timeout))
+    except (OSError, ValueError, BlockDeltaError) as e:
+        error = str(e)
+
+    return changed_path, patch_path, is_delta, time.monotonic() - start, error
+
+
+def _write_patch(changed_path, old_path, tmp_dir, is_delta):
+    """Write patch to the temporary file. Return its path or None if block
+       delta is not smaller than the file itself."""
+
+    fd, patch_path = mkstemp(dir=tmp_dir)
+
+    try:
+        with open(fd, "wb") as patch_f:
+            if is_delta:
+                max_size = os.path.getsize(changed_path) - 1
+                if write_delta(old_path, changed_path, patch_f,
+                               max_size) is None:
+                    os.remove(patch_path)
+                    return None
+            else:
+                patch_f.write(_make_text_patch(changed_path,
+                                               old_path).encode())
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(patch_path)
+        raise
+
+    return patch_path
+
+
+def _make_text_patch(changed_path, old_path):
+    with open(old_path) as old_f:
+        old_txt = old_f.read()
+
+    new_txt = read_text_file(changed_path)
+
+    p = patcher.diff_match_patch()
+    patch = p.patch_make(old_txt, new_txt)
+    return p.patch_toText(patch)
+
+
+@contextlib.contextmanager
+def _time_limit(seconds):
+    """Context manager raising `_PatchTimeoutError` if its body lasts longer
+       than given number of seconds. Timer signal (which interrupts even pure
+       Python code like diff-match-patch) is handled only by the main thread,
+       so there is no time limit in the other threads."""
+
+    if not seconds or threading.current_thread() is not\
+       threading.main_thread():
+        yield
+        return
+
+    def timeout_handler(signum, frame):
+        raise _PatchTimeoutError()
+
+    old_handler = signal.signal(signal.SIGALRM, timeout_handler)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, old_handler)
+
+
+def read_text_file(path):
+    """Return content of the text file. Content of the small files is cached,
+       so the same current version of the changed file is read once by the
+       process generating many system images (see
+       `BatchSystemImageGenerator`)."""
+
+    file_stat = os.stat(path)
+
+    if file_stat.st_size > _CACHED_FILE_MAX_SIZE:
+        with open(path) as f:
+            return f.read()
+
+    return _read_cached_text_file(path, file_stat.st_mtime_ns,
+                                  file_stat.st_size)
+
+
+@functools.lru_cache(maxsize=256)
+def _read_cached_text_file(path, mtime_ns, size):
+    # Modification time and size are part of the cache key only
+    with open(path) as f:
+        return f.read()
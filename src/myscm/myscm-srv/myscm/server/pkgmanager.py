@@ -1,117 +1,342 @@
 # -*- coding: utf-8 -*-
 import logging
-import re
+import os
+import pickle
+import shutil
+
+from tempfile import NamedTemporaryFile
 
 from myscm.common.cmd import long_run_cmd, CommandLineError
 from myscm.server.error import ServerError
 
 logger = logging.getLogger(__name__)
 
+_package_index = None  # loaded once per run (see `get_package_index()`)
+
 
 class PackageManagerError(ServerError):
     pass
 
 
-def get_file_debian_package_name_fallback(file_path):
-    """Get package name of the given file path.
+class PackageOwnershipIndex:
+    """Index mapping full file paths to the names of the packages that own
+       those files. Index is built from the package manager's database (dpkg
+       *.list files on Debian, pacman local database on Arch Linux) instead of
+       running `dpkg-query -S` or `pacman -Qo` for every file. Index is
+       persisted to the cache directory and rebuilt only if package manager's
+       database was modified since the index was saved."""
+
+    DEBIAN_DISTRO_NAME = "debian"
+    ARCH_DISTRO_NAME = "arch"
+    SUPPORTED_DISTROS = [DEBIAN_DISTRO_NAME, ARCH_DISTRO_NAME]
+    DPKG_STATUS_PATH = "/var/lib/dpkg/status"
+    DPKG_INFO_DIR = "/var/lib/dpkg/info"
+    DPKG_LIST_EXT = ".list"
+    PACMAN_LOCAL_DB_DIR = "/var/lib/pacman/local"
+    PACMAN_FILES_FNAME = "files"
+    PACMAN_DESC_FNAME = "desc"
+    PACMAN_FILES_SECTION = "%FILES%"
+    PACMAN_NAME_SECTION = "%NAME%"
+    INDEX_FNAME = "pkg-index.{}.pickle"
+    INDEX_FORMAT_VERSION = 1
+    UNKNOWN_PACKAGE_NAME = "?"
+    PACKAGES_SEPARATOR = ","
+
+    def __init__(self, distro_name, cache_dir):
+        self.distro_name = distro_name.lower()
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(
+                cache_dir, self.INDEX_FNAME.format(self.distro_name))
+        self.index = {}
+        self.fallback_index = {}  # not persisted (see `preload_fallback()`)
+
+        if self.distro_name not in self.SUPPORTED_DISTROS:
+            m = "Package manager of your '{}' distribution is not "\
+                "supported".format(distro_name)
+            raise PackageManagerError(m)
 
-      dpkg-query is not able to find package name of uninstalled packages in
-      opposite to apt-file (which is not installed by default). apt-file is
-      much slower than dpkg-query -S."""
+    def load(self):
+        """Load persisted index unless it's outdated. Otherwise build new index
+           from the package manager's database and persist it."""
 
-    cmd = ["apt-file", "search", "-l", file_path]
-    msg = "to get package name of the file (`dpkg-query -S` fallback)"
+        source_mtime = self._get_source_mtime()
 
-    try:
-        completed_proc = long_run_cmd(cmd, check_exitcode=False,
-                                      suffix_msg=msg, debug_log=True)
-    except CommandLineError as e:
-        m = "Check if apt-file is installed and updated (run `apt update` if "\
-            "needed)"
-        raise PackageManagerError(m, e) from e
+        if self._load_persisted_index(source_mtime):
+            logger.debug("Loaded package ownership index '{}' ({} paths)."
+                         .format(self.index_path, len(self.index)))
+            return
 
-    if completed_proc.returncode:
-        return "?"
+        logger.info("Building package ownership index from package manager's "
+                    "database...")
 
-    cmd_stdout = completed_proc.stdout.decode("utf-8").strip()
-    pkg_names = cmd_stdout.split("\n")
-    pkg_names_str = ",".join(pkg_names)
+        if self.distro_name == self.DEBIAN_DISTRO_NAME:
+            self.index = self._build_debian_index()
+        else:
+            self.index = self._build_arch_index()
+
+        logger.info("Package ownership index of {} paths built.".format(
+                    len(self.index)))
 
-    return pkg_names_str
+        self._save_index(source_mtime)
+
+    def get_package_name(self, file_path):
+        """Return comma separated names of the packages owning given file or
+           '?' if no package owns it."""
+
+        pkg_names = self.index.get(file_path)
 
+        if pkg_names is None:
+            pkg_names = self.fallback_index.get(file_path,
+                                                self.UNKNOWN_PACKAGE_NAME)
 
-def get_file_debian_package_name(file_path):
-    """Get Debian package name of the given file path."""
+        return pkg_names
 
-    cmd = ["dpkg-query", "-S", file_path]
-    msg = "to get package Debian name of the file"
-    completed_proc = long_run_cmd(cmd, check_exitcode=False, suffix_msg=msg,
-                                  debug_log=True)
+    def preload_fallback(self, file_paths):
+        """Find owners of the files not found in the index using single
+           `apt-file search` run. apt-file (which is not installed by default)
+           is able to find package names of the files that belong to the
+           packages that are not installed. This is optional - nothing happens
+           if apt-file is not installed."""
+
+        if self.distro_name != self.DEBIAN_DISTRO_NAME:
+            return
 
-    if completed_proc.returncode:
-        return get_file_debian_package_name_fallback(file_path)
+        missing_paths = [p for p in file_paths if p not in self.index and
+                         p not in self.fallback_index]
 
-    cmd_stdout = completed_proc.stdout.decode("utf-8").strip()
-    detailed_pkg_names = cmd_stdout.split("\n")
-    regex_str = r"(.*): .*"
-    regex = re.compile(regex_str)
-    pkg_names = []
+        if not missing_paths:
+            return
+
+        if not shutil.which("apt-file"):
+            logger.debug("apt-file is not installed - {} path{} not found in "
+                         "package ownership index will be marked with '{}'."
+                         .format(len(missing_paths),
+                                 "s" if len(missing_paths) > 1 else "",
+                                 self.UNKNOWN_PACKAGE_NAME))
+            return
+
+        try:
+            self._preload_debian_fallback(missing_paths)
+        except (CommandLineError, OSError) as e:
+            m = "Check if apt-file is installed and updated (run `apt update` "\
+                "if needed)"
+            raise PackageManagerError(m, e) from e
+
+    def _preload_debian_fallback(self, missing_paths):
+        with NamedTemporaryFile(mode="w+", suffix=".paths") as paths_f:
+            paths_f.write("\n".join(missing_paths) + "\n")
+            paths_f.flush()
+
+            cmd = ["apt-file", "search", "-F", "-f", paths_f.name]
+            msg = "to get package names of {} files not owned by installed "\
+                  "packages".format(len(missing_paths))
+            completed_proc = long_run_cmd(cmd, check_exitcode=False,
+                                          stderr_opt=None, suffix_msg=msg)
+
+        fallback_owners = {}
+        cmd_stdout = completed_proc.stdout.decode("utf-8")
+
+        for line in cmd_stdout.splitlines():
+            pkg_name, sep, path = line.partition(": ")
+            if sep:
+                fallback_owners.setdefault(path, []).append(pkg_name)
+
+        for path, pkg_names in fallback_owners.items():
+            self.fallback_index[path] = self.PACKAGES_SEPARATOR.join(pkg_names)
+
+        logger.debug("apt-file found owners of {} out of {} files.".format(
+                     len(fallback_owners), len(missing_paths)))
+
+    def _get_source_mtime(self):
+        """Return modification time of the package manager's database, which
+           is changed every time any package is installed or removed."""
+
+        if self.distro_name == self.DEBIAN_DISTRO_NAME:
+            source_path = self.DPKG_STATUS_PATH
+        else:
+            source_path = self.PACMAN_LOCAL_DB_DIR
+
+        try:
+            return os.stat(source_path).st_mtime_ns
+        except OSError as e:
+            logger.warning("Failed to get modification time of the package "
+                           "manager's database '{}' ({}).".format(
+                               source_path, e))
+
+        return None
+
+    def _load_persisted_index(self, source_mtime):
+        if source_mtime is None or not os.path.isfile(self.index_path):
+            return False
+
+        try:
+            with open(self.index_path, "rb") as index_f:
+                persisted = pickle.load(index_f)
+        except (OSError, pickle.PickleError, EOFError) as e:
+            logger.warning("Failed to load package ownership index '{}' ({})."
+                           .format(self.index_path, e))
+            return False
+
+        if persisted.get("version") != self.INDEX_FORMAT_VERSION or\
+           persisted.get("source_mtime") != source_mtime:
+            logger.debug("Package ownership index '{}' is outdated.".format(
+                         self.index_path))
+            return False
+
+        self.index = persisted["index"]
+
+        return True
+
+    def _save_index(self, source_mtime):
+        if source_mtime is None:
+            return
+
+        persisted = {
+            "version": self.INDEX_FORMAT_VERSION,
+            "source_mtime": source_mtime,
+            "index": self.index
+        }
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+            with NamedTemporaryFile(mode="wb", dir=self.cache_dir,
+                                    delete=False) as index_f:
+                pickle.dump(persisted, index_f, pickle.HIGHEST_PROTOCOL)
+
+            os.replace(index_f.name, self.index_path)
+        except OSError as e:
+            logger.warning("Failed to save package ownership index '{}' ({})."
+                           .format(self.index_path, e))
+
+    def _build_debian_index(self):
+        """Build index from /var/lib/dpkg/info/*.list files. Every *.list file
+           lists (line by line) paths of the files installed by the package
+           whose name is the name of the *.list file (eg. libc6:amd64.list)."""
+
+        owners = {}
+
+        try:
+            list_fnames = os.listdir(self.DPKG_INFO_DIR)
+        except OSError as e:
+            logger.warning("Failed to list dpkg database directory '{}' ({})."
+                           .format(self.DPKG_INFO_DIR, e))
+            return owners
+
+        for fname in list_fnames:
+            if not fname.endswith(self.DPKG_LIST_EXT):
+                continue
+
+            pkg_name = fname[:-len(self.DPKG_LIST_EXT)]
+            list_path = os.path.join(self.DPKG_INFO_DIR, fname)
 
-    for pkg_name in detailed_pkg_names:
-        pkg_name_match = regex.fullmatch(pkg_name)
+            try:
+                with open(list_path, errors="surrogateescape") as list_f:
+                    for line in list_f:
+                        path = line.rstrip("\n")
+                        if path and path != "/.":
+                            owners.setdefault(path, []).append(pkg_name)
+            except OSError as e:
+                logger.warning("Failed to read '{}' ({}).".format(list_path, e))
 
-        if not pkg_name_match or len(pkg_name_match.groups()) != 1:
-            print(pkg_name)
-            m = "Unexpected output of the '{}' command".format(" ".join(cmd))
-            raise PackageManagerError(m)
+        return self._join_owners(owners)
 
-        pkg_name_str = pkg_name_match.group(1)
-        pkg_names.append(pkg_name_str)
+    def _build_arch_index(self):
+        """Build index from pacman's local database. Every installed package
+           has its own directory with `desc` file holding package name and
+           `files` file listing (relative) paths of the package's files."""
 
-    return ",".join(pkg_names)
+        owners = {}
 
+        try:
+            pkg_dirs = os.listdir(self.PACMAN_LOCAL_DB_DIR)
+        except OSError as e:
+            logger.warning("Failed to list pacman database directory '{}' "
+                           "({}).".format(self.PACMAN_LOCAL_DB_DIR, e))
+            return owners
 
-def get_file_arch_package_name(file_path):
-    """Get Arch Linux package name of the given file path."""
+        for pkg_dir in pkg_dirs:
+            pkg_dir_path = os.path.join(self.PACMAN_LOCAL_DB_DIR, pkg_dir)
 
-    cmd = ["pacman", "-Qo", file_path]
+            try:
+                desc_path = os.path.join(pkg_dir_path, self.PACMAN_DESC_FNAME)
+                name_lines = self._read_pacman_section(desc_path,
+                                                       self.PACMAN_NAME_SECTION)
+                files_path = os.path.join(pkg_dir_path,
+                                          self.PACMAN_FILES_FNAME)
+                paths = self._read_pacman_section(files_path,
+                                                  self.PACMAN_FILES_SECTION)
+            except OSError as e:
+                logger.warning("Failed to read pacman database entry '{}' ({})."
+                               .format(pkg_dir_path, e))
+                continue
 
-    msg = "to get package Arch Linux name of the file"
-    completed_proc = long_run_cmd(cmd, check_exitcode=False, suffix_msg=msg,
-                                  debug_log=True)
+            if not name_lines:
+                continue
 
-    if completed_proc.returncode:
-        return "?"
+            pkg_name = name_lines[0]
 
-    cmd_stdout = completed_proc.stdout.decode("utf-8").strip()
-    detailed_pkg_names = cmd_stdout.split("\n")
-    regex_str = r".* is owned by (.*) .*"
-    regex = re.compile(regex_str)
-    pkg_names = []
+            for path in paths:
+                path = os.path.sep + path.rstrip(os.path.sep)
+                owners.setdefault(path, []).append(pkg_name)
 
-    for pkg_name in detailed_pkg_names:
-        pkg_name_match = regex.fullmatch(pkg_name)
+        return self._join_owners(owners)
 
-        if not pkg_name_match or len(pkg_name_match.groups()) != 1:
-            print(pkg_name)
-            m = "Unexpected output of the '{}' command".format(" ".join(cmd))
-            raise PackageManagerError(m)
+    def _read_pacman_section(self, path, section):
+        """Return lines of the given %SECTION% of the pacman's database file.
+           Section ends with an empty line."""
 
-        pkg_name_str = pkg_name_match.group(1)
-        pkg_names.append(pkg_name_str)
+        lines = []
 
-    return ",".join(pkg_names)
+        if not os.path.isfile(path):
+            return lines
 
+        with open(path, errors="surrogateescape") as f:
+            in_section = False
 
-def get_file_package_name(file_path, server_config):
-    package_getter_fun = None
+            for line in f:
+                line = line.rstrip("\n")
+
+                if in_section:
+                    if not line:
+                        break
+                    lines.append(line)
+                elif line == section:
+                    in_section = True
+
+        return lines
+
+    def _join_owners(self, owners):
+        joined_owners = {}
+        separator = self.PACKAGES_SEPARATOR
+
+        for path, pkg_names in owners.items():
+            joined_owners[path] = pkg_names[0] if len(pkg_names) == 1 else\
+                                  separator.join(pkg_names)
 
-    if server_config.distro_name.lower() == "debian":
-        package_getter_fun = get_file_debian_package_name
-    elif server_config.distro_name.lower() == "arch":
-        package_getter_fun = get_file_arch_package_name
-    else:
-        m = "Package manager of your {} distribution is not supported"
-        raise PackageManagerError(m)
+        return joined_owners
 
-    return package_getter_fun(file_path)
+
+def get_package_index(server_config):
+    """Return package ownership index loaded once per application run."""
+
+    global _package_index
+
+    if _package_index is None:
+        index = PackageOwnershipIndex(server_config.distro_name,
+                                      server_config.options.cache_dir)
+        index.load()
+        _package_index = index
+
+    return _package_index
+
+
+def preload_package_names(file_paths, server_config):
+    """Make sure that owners of all of the given files are known before they
+       are requested one by one with `get_file_package_name()`."""
+
+    get_package_index(server_config).preload_fallback(file_paths)
+
+
+def get_file_package_name(file_path, server_config):
+    return get_package_index(server_config).get_package_name(file_path)
@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
+import collections
+import concurrent.futures
+import fcntl
 import logging
 import os
 import shutil
-import binaryornot.check
 
 from myscm.common.cmd import long_run_cmd, run_check_cmd, CommandLineError
+from myscm.server.aidedbindex import AIDEDatabaseIndex, AIDEDatabaseIndexError
 from myscm.server.aidedbmanager import AIDEDatabasesManager
 from myscm.server.aidedbmanager import AIDEDatabasesManagerError
 from myscm.server.error import ServerError
+from myscm.server.incrementalscanner import IncrementalScanner
+from myscm.server.incrementalscanner import IncrementalScannerError
+from myscm.server.parser import FreshnessCheckConfigOption, ScanModeConfigOption
+from myscm.server.statsnapshot import StatSnapshot, StatSnapshotError
 
 logger = logging.getLogger(__name__)
 
@@ -50,6 +57,29 @@ class Scanner:
         aide_db_manager = AIDEDatabasesManager(self.server_config)
         self._create_tmp_out_dir_if_doesnt_exist()
 
+        # Snapshot is taken before scanning, so files modified during scanning
+        # make it outdated
+
+        snapshot = StatSnapshot(self.server_config.options.AIDE_config_path)
+        snapshot_taken = self._take_stat_snapshot(snapshot)
+
+        if not self._run_incremental_aide_init():
+            self._run_aide_init()
+
+        self._index_new_aide_db()
+
+        if snapshot_taken:
+            self._save_stat_snapshot(snapshot)
+
+        old_db_dir_path = aide_db_manager.replace_old_aide_db_with_new_one()
+        self._copy_selected_tracked_dirs(old_db_dir_path)
+
+        m = "New reference AIDE database '{}' setup successful. Run "\
+            "--list-db option to list all available AIDE databases created "\
+            "so far.".format(self.server_config.aide_reference_db_path)
+        logger.info(m)
+
+    def _run_aide_init(self):
         aide_config_path = self.server_config.options.AIDE_config_path
         cmd = ["aide", "--init", "-c", aide_config_path]
 
@@ -61,31 +91,95 @@ class Scanner:
                 "AIDE configuration '{}' are valid".format(aide_config_path)
             raise ScannerError(m, e) from e
 
-        aide_db_manager.replace_old_aide_db_with_new_one()
-        self._copy_selected_tracked_dirs()
+    def _run_incremental_aide_init(self):
+        """Create new AIDE database rehashing only new and modified files if
+           incremental scanning is enabled. Return False if full AIDE --init
+           is needed."""
 
-        m = "New reference AIDE database '{}' setup successful. Run "\
-            "--list-db option to list all available AIDE databases created "\
-            "so far.".format(self.server_config.aide_reference_db_path)
-        logger.info(m)
+        if self.server_config.options.scan_mode !=\
+           ScanModeConfigOption.INCREMENTAL_SCAN_MODE:
+            return False
+
+        try:
+            return IncrementalScanner(self.server_config).scan()
+        except IncrementalScannerError as e:
+            logger.warning("{}. Falling back to full AIDE --init.".format(e))
+
+        return False
+
+    def _index_new_aide_db(self):
+        """Create index of the new AIDE database to speed up looking up
+           files' properties while generating system images (index is renamed
+           along with the database)."""
+
+        aide_db_index = AIDEDatabaseIndex(self.server_config.aide_out_db_path)
+
+        try:
+            aide_db_index.build()
+        except AIDEDatabaseIndexError as e:
+            logger.warning("{}. Database will be scanned instead of using its "
+                           "index.".format(e))
+
+    def _take_stat_snapshot(self, snapshot):
+        try:
+            return snapshot.take()
+        except StatSnapshotError as e:
+            logger.warning("{}. Snapshot of the scanned files' metadata will "
+                           "not be saved.".format(e))
+
+        return False
+
+    def _save_stat_snapshot(self, snapshot):
+        """Save snapshot of the scanned files' metadata along with the new
+           AIDE database (snapshot is renamed along with the database)."""
+
+        try:
+            snapshot.save(self.server_config.aide_out_db_path)
+        except StatSnapshotError as e:
+            logger.warning("{}. AIDE --check will be used to check if AIDE "
+                           "database is up-to-date.".format(e))
+
+    def _copy_selected_tracked_dirs(self, old_db_dir_path=None):
+        """Copy files selected in the AIDE configuration. Files unchanged
+           since they were copied along with the previous AIDE database
+           (stored in `old_db_dir_path` directory) are hard linked instead."""
+
+        prev_dir_path = None
+
+        if old_db_dir_path:
+            prev_dir_path = os.path.join(old_db_dir_path,
+                                         self.COPIED_FILES_DIRNAME)
+
+        threads = self.server_config.options.worker_threads or 1
 
-    def _copy_selected_tracked_dirs(self):
         try:
             dst_dir_path = self._create_copied_files_dir()
-            self.__copy_selected_tracked_dirs_to_scan_dir(dst_dir_path)
+
+            with _SnapshotCopier(dst_dir_path, prev_dir_path, threads,
+                                 self.check_if_copy_file) as copier:
+                self.__copy_selected_tracked_dirs_to_scan_dir(dst_dir_path,
+                                                              copier)
+                copier.wait()
         except OSError as e:
             m = "Failed to copy files that were specified in AIDE '{}' "\
                 "configuration to be copied to myscm-srv --scan result".format(
                     self.server_config.options.AIDE_config_path)
             raise ScannerError(m, e) from e
 
+        if copier.linked_files_count:
+            logger.info("{} of {} copied files were unchanged and hard linked "
+                        "to their previous copies.".format(
+                            copier.linked_files_count,
+                            copier.linked_files_count +
+                            copier.copied_files_count))
+
     def _create_copied_files_dir(self):
         dst_dir_path = os.path.join(self.server_config.aide_reference_db_dir,
                                     self.COPIED_FILES_DIRNAME)
         os.makedirs(dst_dir_path)
         return dst_dir_path
 
-    def __copy_selected_tracked_dirs_to_scan_dir(self, dst_dir_path):
+    def __copy_selected_tracked_dirs_to_scan_dir(self, dst_dir_path, copier):
         src_paths = self.server_config.get_all_realpaths_of_files_to_copy()
         n = len(src_paths)
 
@@ -121,13 +215,13 @@ class Scanner:
             os.makedirs(os.path.dirname(dst_file_path), exist_ok=True)
 
             if os.path.isdir(src):
-                shutil.copytree(src, dst_file_path, ignore=self.ignore_handler)
-                logger.debug("'{}' directory copied recursively successfully "
-                             "to '{}' directory.".format(src, dst_file_path))
-            elif check_if_copy_file(src):
-                shutil.copy2(src, dst_file_path)
-                logger.debug("'{}' file copied successfully.".format(
-                             dst_file_path))
+                logger.debug("Copying '{}' directory recursively to '{}' "
+                             "directory.".format(src, dst_file_path))
+                copier.copy_tree(src, dst_file_path)
+            elif self.check_if_copy_file(src):
+                logger.debug("Copying '{}' file to '{}'.".format(
+                             src, dst_file_path))
+                copier.copy(src, dst_file_path)
 
     def _create_tmp_out_dir_if_doesnt_exist(self):
         try:
@@ -137,37 +231,252 @@ class Scanner:
                 "result of the AIDE --init call"
             raise ScannerError(m, e) from e
 
-    def check_if_copy_file(self, path):
-        if_copy = None
-        details = None
-        is_dir = None
+    def check_if_copy_file(self, path, dir_entry=None):
+        """Return True if given path is a directory or a regular file. Both
+           text and binary files are copied, since patches of the text files
+           and block deltas of the binary files are created while generating
+           system images. Type of the file listed with `os.scandir()` (given
+           as `dir_entry`) is known without calling stat(2) unless it's a
+           symbolic link."""
+
+        if dir_entry is not None:
+            is_copied = dir_entry.is_dir() or dir_entry.is_file()
+        else:
+            is_copied = os.path.isdir(path) or os.path.isfile(path)
+
+        if is_copied:
+            return True
+
+        logger.debug("'{}' is not copied since it's neither regular file nor "
+                     "directory.".format(path))
+
+        return False
+
+
+class _SnapshotCopier:
+    """Copier of the files to the COPIED directory, which works the way
+       `rsync --link-dest` does. File whose size, modification time (kept by
+       copying) and mode are the same as its copy in the COPIED directory of
+       the previous AIDE database is hard linked to that copy, so unchanged
+       files neither are rewritten nor take disk space of every version.
+       Other files are cloned (reflinked) if filesystem supports it or copied
+       within the kernel (copy_file_range(2) or sendfile(2)) otherwise. Copies
+       must never be modified in place.
+
+       Directories are walked (and created) by the calling thread, while
+       files are copied by the pool of threads, so many files are copied at
+       once. Metadata of the directories is copied once all of the files are
+       copied (see `wait()`). Files are classified by the types of the
+       directories' entries and stat(2) of every file (cached by its entry)
+       is called once, so unchanged file costs stat(2) of the file and its
+       previous copy only."""
+
+    FICLONE = getattr(fcntl, "FICLONE", 0x40049409)  # Linux ioctl
+    COPY_CHUNK_SIZE = 64 * 1024 * 1024
+    MAX_PENDING_FILES_PER_THREAD = 64
+
+    def __init__(self, dst_dir_path, prev_dir_path=None, threads=1,
+                 check_if_copy_file=None):
+        """Constructor initialized by the COPIED directory, COPIED directory
+           of the previous AIDE database (if any), number of the threads and
+           optional callable (see `Scanner.check_if_copy_file()`) returning
+           False for the directories' entries that shouldn't be copied."""
+
+        self.dst_dir_path = dst_dir_path
+        self.prev_dir_path = prev_dir_path
+        self.check_if_copy_file = check_if_copy_file
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self.max_pending = threads * self.MAX_PENDING_FILES_PER_THREAD
+        self.pending = collections.deque()  # futures of the copied files
+        self.copied_dirs = []  # (source, destination) tuples
+        self.linked_files_count = 0
+        self.copied_files_count = 0
+        self.no_reflink_devices = set()  # of the source files
+        self.no_copy_range_devices = set()
+
+    def copy_tree(self, src, dst):
+        """Copy directory recursively the way `shutil.copytree()` does
+           (symbolic links are followed). Files are copied asynchronously."""
+
+        dirs = [(src, dst)]
+
+        while dirs:
+            src_dir, dst_dir = dirs.pop()
+            os.makedirs(dst_dir, exist_ok=True)
+            self.copied_dirs.append((src_dir, dst_dir))
+
+            with os.scandir(src_dir) as entries:
+                for entry in entries:
+                    if self.check_if_copy_file and\
+                       not self.check_if_copy_file(entry.path, entry):
+                        continue
+
+                    dst_path = os.path.join(dst_dir, entry.name)
+
+                    if entry.is_dir():
+                        dirs.append((entry.path, dst_path))
+                    else:
+                        self.copy(entry.path, dst_path, entry)
+
+    def copy(self, src, dst, dir_entry=None):
+        """Copy (or hard link) file asynchronously. Stat of the file is
+           taken from its `os.DirEntry` (if given)."""
+
+        self.pending.append(self.executor.submit(self._copy, src, dst,
+                                                 dir_entry))
+
+        while len(self.pending) > self.max_pending:
+            self._wait_for_next_file()
+
+    def wait(self):
+        """Wait until all of the files are copied (error of the first failed
+           copy is raised) and copy metadata of the directories, whose
+           modification times were changed by adding files."""
+
+        while self.pending:
+            self._wait_for_next_file()
+
+        for src_dir, dst_dir in reversed(self.copied_dirs):
+            shutil.copystat(src_dir, dst_dir)
+
+        self.copied_dirs.clear()
+
+    def close(self):
+        for future in self.pending:
+            future.cancel()
+
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _wait_for_next_file(self):
+        if self.pending.popleft().result():
+            self.linked_files_count += 1
+        else:
+            self.copied_files_count += 1
+
+    def _copy(self, src, dst, dir_entry=None):
+        """Copy file opening it once. Return True if it was hard linked."""
+
+        if self._link_previous_copy(src, dst, dir_entry):
+            return True
+
+        with open(src, "rb", buffering=0) as src_f,\
+                open(dst, "wb", buffering=0) as dst_f:
+            device = os.fstat(src_f.fileno()).st_dev
+
+            if not self._reflink_file(src_f, dst_f, device):
+                self._copy_file_data(src_f, dst_f, device)
+
+        shutil.copystat(src, dst)
+
+        return False
+
+    def _link_previous_copy(self, src, dst, dir_entry=None):
+        if not self.prev_dir_path:
+            return False
+
+        prev_path = os.path.join(self.prev_dir_path,
+                                 os.path.relpath(dst, self.dst_dir_path))
 
         try:
-            is_dir = os.path.isdir(path)
-            if_copy = not binaryornot.check.is_binary(path)
-        except Exception as e:
-            if_copy = False
-            details = e
+            src_stat = dir_entry.stat() if dir_entry else os.stat(src)
+            prev_stat = os.lstat(prev_path)
+        except OSError:
+            return False
 
-        m = "'{}' is not copied since it's non-text file".format(path)
+        if (src_stat.st_size, src_stat.st_mtime_ns, src_stat.st_mode) !=\
+           (prev_stat.st_size, prev_stat.st_mtime_ns, prev_stat.st_mode):
+            return False
 
-        if details:
-            m += ". Details: {}".format(details)
+        try:
+            os.link(prev_path, dst)
+        except OSError as e:  # e.g. too many links
+            logger.debug("Failed to hard link '{}' to '{}' ({}).".format(
+                         dst, prev_path, e))
+            return False
 
-        if not if_copy and not is_dir:
-            logger.debug(m)
+        return True
 
-        return if_copy
+    def _reflink_file(self, src_f, dst_f, device):
+        """Clone file sharing its data blocks (copy on write). Return False if
+           filesystem doesn't support it."""
 
-    def ignore_handler(self, dir_path, dir_content):
-        return [f for f in dir_content if not self.check_if_copy_file(os.path.join(dir_path, f))]
+        if device in self.no_reflink_devices:
+            return False
+
+        try:
+            fcntl.ioctl(dst_f.fileno(), self.FICLONE, src_f.fileno())
+        except OSError as e:
+            logger.debug("Cloning '{}' is not supported ({}) - files of its "
+                         "filesystem will be copied.".format(src_f.name, e))
+            self.no_reflink_devices.add(device)
+            return False
+
+        return True
+
+    def _copy_file_data(self, src_f, dst_f, device):
+        """Copy data within the kernel. copy_file_range(2) may also clone data
+           or offload copying to the storage, sendfile(2) is used if it's not
+           supported (e.g. between filesystems on older kernels)."""
+
+        src_fd, dst_fd = src_f.fileno(), dst_f.fileno()
+
+        if hasattr(os, "copy_file_range") and\
+           device not in self.no_copy_range_devices:
+            try:
+                self._copy_chunks(lambda n: os.copy_file_range(src_fd, dst_fd,
+                                                               n))
+                return
+            except OSError as e:
+                logger.debug("copy_file_range(2) of '{}' failed ({}) - files "
+                             "of its filesystem will be copied with "
+                             "sendfile(2).".format(src_f.name, e))
+                self.no_copy_range_devices.add(device)
+                os.lseek(src_fd, 0, os.SEEK_SET)
+                os.lseek(dst_fd, 0, os.SEEK_SET)
+                os.ftruncate(dst_fd, 0)
+
+        self._copy_chunks(lambda n: os.sendfile(dst_fd, src_fd, None, n))
+
+    def _copy_chunks(self, copy_chunk):
+        while copy_chunk(self.COPY_CHUNK_SIZE):
+            pass
 
 
 def is_reference_aide_db_outdated(server_config):
-    """Return True if reference AIDE database aide.db is outdated."""
+    """Return True if reference AIDE database aide.db is outdated. AIDE --check
+       is skipped if metadata of the tracked files matches its snapshot saved
+       along with the reference database (see `StatSnapshot`)."""
+
+    freshness_check = server_config.options.freshness_check
+
+    if freshness_check == FreshnessCheckConfigOption.SNAPSHOT_FRESHNESS_CHECK\
+       and _is_stat_snapshot_unchanged(server_config):
+        logger.debug("Metadata of the tracked files wasn't changed since "
+                     "'{}' was created - skipping AIDE --check.".format(
+                         server_config.aide_reference_db_path))
+        return False
 
     aide_config_path = server_config.options.AIDE_config_path
     completed_proc = run_check_cmd(aide_config_path, False)
     uptodate_msg = "AIDE found NO differences between database and "\
                    "filesystem. Looks okay!!"
     return uptodate_msg not in completed_proc.stdout.decode("utf-8")
+
+
+def _is_stat_snapshot_unchanged(server_config):
+    snapshot = StatSnapshot(server_config.options.AIDE_config_path)
+
+    try:
+        if not snapshot.take():
+            return False
+    except StatSnapshotError as e:
+        logger.warning("{}. AIDE --check will be used instead.".format(e))
+        return False
+
+    return snapshot.matches_saved(server_config.aide_reference_db_path)
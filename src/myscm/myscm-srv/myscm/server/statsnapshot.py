@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import os
+import struct
+
+from tempfile import NamedTemporaryFile
+
+from myscm.server.aideselection import AIDESelection
+from myscm.server.error import ServerError
+
+logger = logging.getLogger(__name__)
+
+
+class StatSnapshotError(ServerError):
+    pass
+
+
+class StatSnapshot:
+    """Cheap snapshot of the metadata (type, permissions, owner, size, mtime,
+       ctime, i-node and number of hard links - attributes that AIDE itself
+       checks) of all of the files selected by the AIDE configuration. Only
+       digest of the metadata is saved (aide.db[.X].myscm-snapshot), right
+       after AIDE --init, along with the AIDE database. If current snapshot
+       matches the saved one, then reference AIDE database is up-to-date and
+       there is no need to run AIDE --check which hashes all of the files.
+
+       Snapshot is taken before AIDE --init, so files modified during scanning
+       are reported as changed. It may cover more files than AIDE does (see
+       `AIDESelection`), which is safe since changed snapshot only means that
+       AIDE --check has to be ran to find out if anything was really
+       changed."""
+
+    SNAPSHOT_EXT = ".myscm-snapshot"
+    FORMAT_VERSION = 1
+    STAT_STRUCT = struct.Struct("=IIIQqqQQ")  # mode, uid, gid, size, mtime,
+                                              # ctime [ns], i-node, links
+
+    def __init__(self, aide_config_path):
+        self.aide_config_path = aide_config_path
+        self.aide_config_digest = None
+        self.digest = None
+        self.files_count = 0
+
+    @classmethod
+    def get_snapshot_path(cls, aide_db_path):
+        return aide_db_path + cls.SNAPSHOT_EXT
+
+    def take(self):
+        """Take snapshot of the selected files. Return False if AIDE
+           configuration uses features that are not supported by the snapshot
+           (e.g. @@include or regular expressions in the selection lines), so
+           AIDE --check has to be used."""
+
+        selection = AIDESelection(self.aide_config_path)
+
+        try:
+            if not selection.read():
+                return False
+        except OSError as e:
+            m = "Failed to read AIDE configuration '{}'".format(
+                    self.aide_config_path)
+            raise StatSnapshotError(m, e) from e
+
+        self.aide_config_digest = hashlib.blake2b(
+                                        selection.config_bytes).hexdigest()
+        files_hash = hashlib.blake2b()
+        self.files_count = 0
+
+        for path, st, error in selection.iterate_selected_files():
+            files_hash.update(path.encode("utf-8", "surrogateescape"))
+
+            if error:
+                files_hash.update("\0{}\n".format(error.errno).encode())
+                continue
+
+            files_hash.update(self.STAT_STRUCT.pack(
+                st.st_mode, st.st_uid, st.st_gid, st.st_size, st.st_mtime_ns,
+                st.st_ctime_ns, st.st_ino, st.st_nlink))
+            self.files_count += 1
+
+        self.digest = files_hash.hexdigest()
+        logger.debug("Snapshot of {} files selected by '{}' taken.".format(
+                     self.files_count, self.aide_config_path))
+
+        return True
+
+    def save(self, aide_db_path):
+        """Save taken snapshot next to the given (new) AIDE database."""
+
+        db_stat = os.stat(aide_db_path)
+        snapshot = {
+            "version": self.FORMAT_VERSION,
+            "aide_config_digest": self.aide_config_digest,
+            "db_size": db_stat.st_size,
+            "db_mtime_ns": db_stat.st_mtime_ns,
+            "files_count": self.files_count,
+            "digest": self.digest
+        }
+        snapshot_path = self.get_snapshot_path(aide_db_path)
+        snapshot_dir = os.path.dirname(os.path.abspath(snapshot_path))
+
+        try:
+            with NamedTemporaryFile(mode="w", dir=snapshot_dir,
+                                    delete=False) as snapshot_f:
+                json.dump(snapshot, snapshot_f)
+
+            os.replace(snapshot_f.name, snapshot_path)
+        except OSError as e:
+            m = "Failed to save snapshot '{}' of the files selected by the "\
+                "AIDE configuration".format(snapshot_path)
+            raise StatSnapshotError(m, e) from e
+
+    def matches_saved(self, aide_db_path):
+        """Return True if taken snapshot matches the one saved along with
+           given AIDE database, which wasn't modified since then."""
+
+        saved = self.load_saved(aide_db_path)
+
+        return saved is not None and\
+            saved.get("aide_config_digest") == self.aide_config_digest and\
+            saved.get("files_count") == self.files_count and\
+            saved.get("digest") == self.digest
+
+    @classmethod
+    def load_saved(cls, aide_db_path):
+        """Return dictionary with the snapshot saved along with the given AIDE
+           database or None if it doesn't exist or the database was modified
+           after saving snapshot."""
+
+        snapshot_path = cls.get_snapshot_path(aide_db_path)
+
+        try:
+            with open(snapshot_path) as snapshot_f:
+                saved = json.load(snapshot_f)
+            db_stat = os.stat(aide_db_path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Failed to load snapshot '{}' of the files selected "
+                           "by the AIDE configuration ({}).".format(
+                               snapshot_path, e))
+            return None
+
+        if saved.get("version") != cls.FORMAT_VERSION or\
+           saved.get("db_size") != db_stat.st_size or\
+           saved.get("db_mtime_ns") != db_stat.st_mtime_ns:
+            return None
+
+        return saved
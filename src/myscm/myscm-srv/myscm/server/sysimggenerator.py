@@ -5,18 +5,24 @@ import os
 import platform
 import progressbar
 import re
-import tarfile
 import textwrap
 
-import diff_match_patch as patcher
-from tempfile import TemporaryFile, NamedTemporaryFile
+from tempfile import NamedTemporaryFile, TemporaryDirectory
 
-from myscm.common.cmd import run_check_cmd
+from myscm.common.chunklist import ChunkList, ChunkListError
+from myscm.common.cmd import stream_check_cmd, CommandLineError
 from myscm.common.signaturemanager import SignatureManager, SignatureManagerError
+from myscm.common.sysimgarchive import IndexedSysImgWriter
+from myscm.common.sysimgcatalog import SysImgCatalog, SysImgCatalogError
 from myscm.server.aidecheckparser import AIDECheckParser, AIDECheckParserError
+from myscm.server.aidedbcomparator import AIDEDatabasesComparator
+from myscm.server.aidedbcomparator import AIDEDatabasesComparatorError
 from myscm.server.aidedbmanager import AIDEDatabasesManager
-from myscm.server.aideentry import AIDEEntry
+from myscm.server.blobstore import BlobStore
+from myscm.server.aideentry import AIDEEntry, PropertyType
 from myscm.server.error import ServerError
+from myscm.server.parser import DiffEngineConfigOption
+from myscm.server.patchmaker import PatchCache, PatchMaker, PatchMakerError
 from myscm.server.scanner import Scanner
 import myscm.server.pkgmanager as pkgmgr
 import myscm.server.scanner
@@ -33,7 +39,7 @@ class SystemImageGenerator:
     """Generator of the reference system image that will be applied by the
        client's myscm-cli application."""
 
-    MYSCM_IMG_EXT = ".tar.gz"
+    MYSCM_IMG_EXT = ".tar.gz"  # regardless of the compression codec
     MYSCM_IMG_FILE_NAME = "myscm-img.{}.{}" + MYSCM_IMG_EXT
     MYSCM_IMG_FILE_NAME_REGEX = MYSCM_IMG_FILE_NAME.format(r"(\d+)", r"(\d+)")
     AIDE_MIN_EXITCODE = 14  # see AIDE's manual for details about exitcodes
@@ -43,30 +49,48 @@ class SystemImageGenerator:
     REMOVED_FILES_FNAME = "removed.txt"
     CHANGED_FILES_FNAME = "changed.txt"
     PATCH_EXT = ".myscmsrv-patch"
+    BLOCK_DELTA_EXT = ".myscmsrv-delta"
     TEMPLATE_PATH_EXT = ".myscm-template"
-    TARFILE_COMPRESSION = "w:gz"
     SYSTEM_STR = "System"
     LINUX_DISTRO_STR = "GNU/Linux distribution"
     CPU_ARCHITECTURE_STR = "CPU architecture"
 
-    def __init__(self, server_config):
+    def __init__(self, server_config, from_db_id=None, reference_rows=None):
+        """Constructor initialized by the server's configuration. Client's
+           AIDE database version defaults to `server_config.options.gen_img`.
+           Already loaded rows of the reference AIDE database can be shared by
+           many generators (see `BatchSystemImageGenerator`)."""
+
         self.server_config = server_config
         self.aide_db_manager = AIDEDatabasesManager(server_config)
-        self.from_db_id = self.server_config.options.gen_img
+        self.from_db_id = from_db_id if from_db_id is not None\
+            else self.server_config.options.gen_img
         self.to_db_id = self.aide_db_manager.get_recent_aide_db_version()
         self.client_db_path = self._get_client_db_path(self.from_db_id)
+        self.sign_img = True
+        self.update_catalog = True
+        self.signature_manager = SignatureManager()
+        self.compression_threads = server_config.options.worker_threads or 1
+        self.patch_processes = server_config.options.worker_threads or 1
+        self.blob_store = self._get_blob_store()
+        self.patch_cache = self._get_patch_cache()
         self.aide_output_parser = AIDECheckParser(
                 self.client_db_path, self.server_config.aide_reference_db_path)
+        self.aide_db_comparator = AIDEDatabasesComparator(
+                self.client_db_path, self.server_config.aide_reference_db_path,
+                reference_rows)
 
-    def generate_img(self):
+    def generate_img(self, check_outdated=True):
         """Generate system image file for client whose AIDE configuration is
            identified by unique client's ID `server_config.options.gen_img`
            (which is integer number) and return full path to the created system
-           image."""
+           image. Checking if reference AIDE database is up-to-date can be
+           skipped if it was already done by the caller."""
 
         system_img_path = None
 
-        if myscm.server.scanner.is_reference_aide_db_outdated(self.server_config):
+        if check_outdated and\
+           myscm.server.scanner.is_reference_aide_db_outdated(self.server_config):
             m = "Current reference AIDE database '{}' is NOT up-to-date. Run "\
                 "myscm-srv with --scan option to create up-to-date aide.db "\
                 "and than rerun with --gen-img.".format(
@@ -114,24 +138,46 @@ class SystemImageGenerator:
         return client_db_path
 
     def _generate_img(self):
-        """Generates system image based on AIDE's --check output ran on the
-           AIDE's temporary configuration file."""
+        """Generates system image based on the differences between current
+           server's state and client's state described by its AIDE database.
+           Method of detecting differences depends on `DiffEngine` option."""
 
         logger.info("Generating system image based on current server's "
                     "configuration and AIDE database file '{}' corresponding "
                     "to client's system configuration.".format(
                         self.client_db_path))
 
+        diff_engine = self.server_config.options.diff_engine
+
+        if diff_engine == DiffEngineConfigOption.AIDE_DIFF_ENGINE:
+            return self._generate_img_from_aide_check()
+
+        return self._generate_img_from_aide_db_comparison()
+
+    def _generate_img_from_aide_db_comparison(self):
+        """Generates system image based on the comparison of the client's AIDE
+           database with up-to-date reference AIDE database. No filesystem
+           scanning (nor hashing) is needed."""
+
+        try:
+            entries = self.aide_db_comparator.compare()
+        except AIDEDatabasesComparatorError as e:
+            m = "Error occurred while comparing AIDE databases"
+            raise SystemImageGeneratorError(m, e) from e
+
+        return self._generate_img_from_aide_entries(entries)
+
+    def _generate_img_from_aide_check(self):
+        """Generates system image based on AIDE's --check output ran on the
+           AIDE's temporary configuration file."""
+
         system_img_path = None
 
         with NamedTemporaryFile(mode="r+", suffix=".aide.conf") as tmp_aideconf_f:
             self._copy_aide_config_to_tmp_replacing_db_path(tmp_aideconf_f)
-
-            with TemporaryFile(mode="r+", suffix=".aide.diff") as aidediff_f:
-                self._save_aide_check_result_to_tmp_file(aidediff_f,
-                                                         tmp_aideconf_f)
-                system_img_path = self._generate_img_from_aide_check_result(
-                                                                    aidediff_f)
+            tmp_aideconf_f.flush()
+            system_img_path = self._generate_img_from_aide_check_result(
+                                                                tmp_aideconf_f)
 
         return system_img_path
 
@@ -174,33 +220,25 @@ class SystemImageGenerator:
                 .format(aide_conf_path, db_matches, opt_matches)
             raise SystemImageGeneratorError(m)
 
-    def _save_aide_check_result_to_tmp_file(self, aidediff_f, tmp_aideconf_f):
-        """Save AIDE --check output to temporary file that will be processed to
-           generate reference system image."""
-
-        aide_config_path = tmp_aideconf_f.name
-        tmp_aideconf_f.seek(0)
+    def _generate_img_from_aide_check_result(self, tmp_aideconf_f):
+        """Read added, removed and changed entries from AIDE --check output and
+           generate system image based those entries. Output is parsed while
+           AIDE is still running, without saving it to the temporary file."""
 
         # Alternatively it can be handled by using AIDE's --report option
-        # instead of capturing stdout
+        # instead of capturing stdout. AIDE returns exit code to indicate
+        # whether error occured - see manual.
 
-        completed_proc = run_check_cmd(aide_config_path, False, aidediff_f)
-
-        # AIDE returns exit code to indicate whether error occured - see manual
-
-        if completed_proc.returncode >= self.AIDE_MIN_EXITCODE:
-            m = "Erroneous exitcode {} for command AIDE --check. Refer "\
-                "AIDE's manual for details".format(completed_proc.returncode)
-            raise SystemImageGeneratorError(m)
-
-    def _generate_img_from_aide_check_result(self, aidediff_f):
-        """Read added, removed and changed entries from AIDE --check result and
-           generate system image based those entries."""
-
-        aidediff_f.seek(0)
+        max_exitcode = self.AIDE_MIN_EXITCODE - 1
 
         try:
-            entries = self.aide_output_parser.read_all_entries(aidediff_f)
+            with stream_check_cmd(tmp_aideconf_f.name,
+                                  max_exitcode) as aidediff_f:
+                entries = self.aide_output_parser.read_all_entries(aidediff_f)
+        except CommandLineError as e:
+            m = "Erroneous exitcode for command AIDE --check. Refer AIDE's "\
+                "manual for details"
+            raise SystemImageGeneratorError(m, e) from e
         except AIDECheckParserError as e:
             m = "Error occurred while parsing AIDE --check output"
             raise SystemImageGeneratorError(m, e) from e
@@ -209,7 +247,7 @@ class SystemImageGenerator:
 
     def _generate_img_from_aide_entries(self, entries):
         """Generate system image based on the entries read from AIDE --check
-           output."""
+           output or found by comparing AIDE databases."""
 
         img_path = self._get_img_file_full_path()
         img_sig_path = "{}{}".format(img_path, SignatureManager.SIGNATURE_EXT)
@@ -217,23 +255,81 @@ class SystemImageGenerator:
         if os.path.isfile(img_path):
             logger.warning("Overwriting '{}' system image.".format(img_path))
 
-        with tarfile.open(img_path, self.TARFILE_COMPRESSION) as f:
+        self._preload_package_names(entries)
+
+        codec = self.server_config.options.system_img_compression
+
+        with IndexedSysImgWriter(img_path, codec=codec,
+                                 threads=self.compression_threads,
+                                 blob_store=self.blob_store) as f:
             self._add_to_img_file_aide_added_entries(entries.added_entries, f)
             self._add_to_img_file_removed_entries(entries.removed_entries, f)
             self._add_to_img_file_changed_entries(entries.changed_entries, f)
 
+        if self.blob_store:
+            self.blob_store.prune()
+
+        if self.patch_cache:
+            self.patch_cache.prune()
+
+        self._create_img_chunk_list(img_path)
+
         logger.info("Successfully created system image '{}' for client "
                     "identified by AIDE's database '{}'.".format(
                         img_path, self.client_db_path))
 
-        img_sig_path = self._create_img_signature(img_path, img_sig_path)
+        signed = False
 
-        if img_sig_path:  # if generating signature was not skipped by the user
-            logger.info("Signature of the system image '{}' created "
-                        "successfully!".format(img_sig_path))
+        if self.sign_img:
+            img_sig_path = self._create_img_signature(img_path, img_sig_path)
+            signed = bool(img_sig_path)
+
+            if signed:  # if generating signature was not skipped
+                logger.info("Signature of the system image '{}' created "
+                            "successfully!".format(img_sig_path))
+
+        if self.update_catalog:  # not signed if signing image was skipped
+            update_signed_catalog(self.server_config, self.signature_manager,
+                                  signed)
 
         return img_path
 
+    def _preload_package_names(self, entries):
+        """Find owners of all of the listed files at once instead of looking
+           for them file by file."""
+
+        paths = list(entries.added_entries.keys())
+        paths.extend(entries.removed_entries.keys())
+        paths.extend(entries.changed_entries.keys())
+
+        try:
+            pkgmgr.preload_package_names(paths, self.server_config)
+        except pkgmgr.PackageManagerError as e:
+            m = "Failed to find packages owning files listed in system image"
+            raise SystemImageGeneratorError(m, e) from e
+
+    def _get_blob_store(self):
+        """Return store of the compressed content of the files shared by all
+           of the generated system images or None if it's disabled."""
+
+        cache_size = self.server_config.options.blob_cache_size
+
+        if not cache_size:
+            return None
+
+        return BlobStore(self.server_config.options.cache_dir, cache_size)
+
+    def _get_patch_cache(self):
+        """Return cache of the patches of the changed files shared by all of
+           the generated system images or None if it's disabled."""
+
+        cache_size = self.server_config.options.patch_cache_size
+
+        if not cache_size:
+            return None
+
+        return PatchCache(self.server_config.options.cache_dir, cache_size)
+
     def _get_img_file_full_path(self):
         fname = self.MYSCM_IMG_FILE_NAME.format(self.from_db_id, self.to_db_id)
         img_out_dir = self.server_config.options.system_img_out_dir
@@ -458,11 +554,12 @@ class SystemImageGenerator:
                         "thus list of changed files that was added to the "
                         "system image is empty.")
 
+        content_changed_entries = []
+
         with NamedTemporaryFile(mode="r+") as tmp_changed_f:
             self._append_changed_entries_header(tmp_changed_f)
-            bar = progressbar.ProgressBar(max_value=n)
 
-            for c in bar(changed_entries.values()):
+            for c in changed_entries.values():
                 path = c.get_full_path()
 
                 # If this file has corresponding template file, skip this file
@@ -483,25 +580,62 @@ class SystemImageGenerator:
                 # possible. Otherwise copy whole file to the system image.
 
                 if c.was_file_content_changed():
-                    changed_path = c.get_full_path()
-                    self._add_file_to_system_img_tar(changed_path,
-                                                     archive_file)
+                    content_changed_entries.append(c)
 
             tmp_changed_f.seek(0)
             archive_file.add(tmp_changed_f.name,
                              arcname=self.CHANGED_FILES_FNAME)
 
-    def _add_file_to_system_img_tar(self, changed_path, archive_file):
-        """Add whole missing file to system image unless it's possible to
-           create patch (diff) file."""
-
-        old_changed_path = self._get_old_changed_file_version(changed_path)
-
-        if os.path.isfile(old_changed_path):
-            self._add_patch_file_to_system_img(changed_path,
-                                               old_changed_path,
-                                               archive_file)
-        else:
+        self._add_content_changed_files_to_system_img_tar(
+            content_changed_entries, archive_file)
+
+    def _add_content_changed_files_to_system_img_tar(self, changed_entries,
+                                                     archive_file):
+        """Add changed files to the system image. Patches of the files whose
+           previous versions were copied by `Scanner` are created
+           concurrently (see `PatchMaker`) unless they are cached."""
+
+        patched_paths = []
+        bar = progressbar.ProgressBar(max_value=len(changed_entries))
+
+        for entry in changed_entries:
+            changed_path = entry.get_full_path()
+            old_changed_path = self._get_old_changed_file_version(changed_path)
+
+            if os.path.isfile(old_changed_path):
+                cache_key = PatchCache.get_key(
+                    entry.aide_prev_properties[PropertyType.SHA1],
+                    entry.aide_properties[PropertyType.SHA1])
+                patched_paths.append((changed_path, old_changed_path,
+                                      cache_key))
+            else:
+                self._add_file_to_system_img_tar(changed_path, archive_file)
+                bar.update(bar.value + 1)
+
+        options = self.server_config.options
+
+        with TemporaryDirectory() as patches_dir:
+            patch_maker = PatchMaker(patches_dir, self.patch_processes,
+                                     options.patch_timeout,
+                                     options.patch_size_limit,
+                                     self.patch_cache)
+
+            try:
+                for changed_path, patch_path, is_delta in\
+                        patch_maker.iterate_patches(patched_paths):
+                    self._add_file_to_system_img_tar(
+                        changed_path, archive_file, patch_path, is_delta)
+                    bar.update(bar.value + 1)
+            except PatchMakerError as e:
+                m = "Failed to add changed files to the system image"
+                raise SystemImageGeneratorError(m, e) from e
+
+    def _add_file_to_system_img_tar(self, changed_path, archive_file,
+                                    patch_path=None, is_block_delta=False):
+        """Add whole changed file to system image unless patch (diff) file or
+           block delta file was created (see `PatchMaker`)."""
+
+        if patch_path is None:
             intar_path = os.path.join(self.IN_ARCHIVE_CHANGED_DIR_NAME,
                                       changed_path.lstrip(os.path.sep))
 
@@ -509,38 +643,26 @@ class SystemImageGenerator:
                          .format(intar_path))
 
             archive_file.add(changed_path, arcname=intar_path)
+            return
+
+        ext = self.BLOCK_DELTA_EXT if is_block_delta else self.PATCH_EXT
+        intar_patch_path = os.path.join(self.IN_ARCHIVE_CHANGED_DIR_NAME,
+                                        changed_path.lstrip(os.path.sep) + ext)
+
+        try:
+            archive_file.add(patch_path, arcname=intar_patch_path)
+        finally:
+            os.remove(patch_path)
+
+        logger.debug("{} for '{}' saved as '{}' in '{}' system image.".format(
+                     "Block delta" if is_block_delta else "Patch",
+                     changed_path, intar_patch_path, archive_file.name))
 
     def _get_old_changed_file_version(self, changed_path):
         client_db_dir = os.path.dirname(self.client_db_path)
         copied_dir = os.path.join(client_db_dir, Scanner.COPIED_FILES_DIRNAME)
         return os.path.join(copied_dir, changed_path.lstrip(os.sep))
 
-    def _add_patch_file_to_system_img(self, changed_path, old_changed_path,
-                                      archive_file):
-        old_txt, new_txt = None, None
-
-        with open(old_changed_path) as old_f:
-            old_txt = old_f.read()
-
-        with open(changed_path) as new_f:
-            new_txt = new_f.read()
-
-        p = patcher.diff_match_patch()
-        patch = p.patch_make(old_txt, new_txt)
-        patch_text = p.patch_toText(patch)
-        patch_fname = changed_path.lstrip(os.path.sep) + self.PATCH_EXT
-        intar_patch_path = os.path.join(self.IN_ARCHIVE_CHANGED_DIR_NAME,
-                                        patch_fname)
-
-        with NamedTemporaryFile(mode="r+") as patch_f:
-            patch_f.write(patch_text)
-            patch_f.seek(0)
-            archive_file.add(patch_f.name, arcname=intar_patch_path)
-
-        logger.debug("Patch for '{}' --> '{}' saved as '{}' in '{}' system "
-                     "image.".format(old_changed_path, changed_path,
-                                     intar_patch_path, archive_file.name))
-
     def _append_changed_entries_header(self, changed_f):
         title = "MODIFIED FILES REPORT"
         m = "This file lists changes between current newest state of the "\
@@ -620,12 +742,56 @@ class SystemImageGenerator:
 
         f.write("\n\n")
 
+    def _create_img_chunk_list(self, img_path):
+        """Publish list of the chunks' digests next to the system image, so
+           clients can download the system image from many peers at once."""
+
+        chunk_list_path = img_path + ChunkList.CHUNK_LIST_EXT
+
+        try:
+            ChunkList.create(img_path).save(chunk_list_path)
+        except ChunkListError as e:
+            m = "Failed to create chunk list of the system image '{}'".format(
+                    img_path)
+            raise SystemImageGeneratorError(m, e) from e
+
     def _create_img_signature(self, img_path, img_sig_path):
-        m = SignatureManager()
+        m = self.signature_manager
 
         try:
             priv_key = self.server_config.options.SSL_cert_priv_key_path
-            m.ssl_sign(img_path, img_sig_path, priv_key)
+            img_sig_path = m.ssl_sign(img_path, img_sig_path, priv_key)
         except SignatureManagerError as e:
             m = "Failed to create digital signature for '{}'".format(img_path)
             raise SystemImageGeneratorError(m, e) from e
+
+        return img_sig_path
+
+
+def update_signed_catalog(server_config, signature_manager, sign=True):
+    """Update catalog of the system images (see `SysImgCatalog`) published in
+       the server's system images directory and sign it. If signing is
+       skipped, then stale signature of the catalog is removed."""
+
+    img_out_dir = server_config.options.system_img_out_dir
+    catalog_path = os.path.join(img_out_dir, SysImgCatalog.CATALOG_FILE_NAME)
+    catalog_sig_path = catalog_path + SignatureManager.SIGNATURE_EXT
+    signed = None
+
+    try:
+        SysImgCatalog.update(img_out_dir)
+
+        if sign:
+            priv_key = server_config.options.SSL_cert_priv_key_path
+            signed = signature_manager.ssl_sign(catalog_path, catalog_sig_path,
+                                                priv_key)
+
+        if not signed and os.path.exists(catalog_sig_path):
+            os.remove(catalog_sig_path)
+    except (SysImgCatalogError, SignatureManagerError, OSError) as e:
+        m = "Failed to update catalog of the system images in '{}'".format(
+                img_out_dir)
+        raise SystemImageGeneratorError(m, e) from e
+
+    logger.info("{} catalog of the system images '{}' updated.".format(
+                "Signed" if signed else "Not signed", catalog_path))
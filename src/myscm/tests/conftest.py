@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+MYSCM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES_DIR = os.path.join(MYSCM_DIR, "tests", "fixtures")
+
+# myscm-common links the client and server packages, so all of the packages
+# are importable without installing them.
+
+sys.path.insert(0, os.path.join(MYSCM_DIR, "myscm-common"))
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+
+from myscm.server.aidecheckparser import AIDECheckParser
+from myscm.server.aidedbcomparator import AIDEDatabasesComparator
+from myscm.server.aidedbcomparator import AIDEDatabasesComparatorError
+from myscm.server.aideentry import EntryType, PropertyType
+
+# aide.db.1 is the client's database and aide.db the reference one.
+# aide-check.txt is the output of AIDE 0.16 --check (with summarize_changes
+# set) for the server described by aide.db, run against aide.db.1.
+
+AIDE_FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures", "aide")
+CLIENT_DB_PATH = os.path.join(AIDE_FIXTURES_DIR, "aide.db.1")
+SERVER_DB_PATH = os.path.join(AIDE_FIXTURES_DIR, "aide.db")
+AIDE_CHECK_PATH = os.path.join(AIDE_FIXTURES_DIR, "aide-check.txt")
+
+
+def _get_aide_check_entries():
+    parser = AIDECheckParser(CLIENT_DB_PATH, SERVER_DB_PATH)
+
+    with open(AIDE_CHECK_PATH) as aidediff_f:
+        return parser.read_all_entries(aidediff_f)
+
+
+def _get_properties(properties):
+    return {p: properties[p] for p in PropertyType}
+
+
+def _assert_entries_equal(entries, expected_entries):
+    assert entries.keys() == expected_entries.keys()
+
+    for path, expected in expected_entries.items():
+        entry = entries[path]
+        assert entry.aide_info_str == expected.aide_info_str, path
+        assert entry.entry_type == expected.entry_type, path
+        assert _get_properties(entry.aide_properties) ==\
+            _get_properties(expected.aide_properties), path
+
+        if expected.aide_prev_properties is not None:
+            assert _get_properties(entry.aide_prev_properties) ==\
+                _get_properties(expected.aide_prev_properties), path
+
+
+def test_compare_matches_aide_check_output():
+    expected = _get_aide_check_entries()
+    entries = AIDEDatabasesComparator(CLIENT_DB_PATH, SERVER_DB_PATH).compare()
+
+    _assert_entries_equal(entries.added_entries, expected.added_entries)
+    _assert_entries_equal(entries.removed_entries, expected.removed_entries)
+    _assert_entries_equal(entries.changed_entries, expected.changed_entries)
+
+
+def test_compare_finds_all_kinds_of_changes():
+    entries = AIDEDatabasesComparator(CLIENT_DB_PATH, SERVER_DB_PATH).compare()
+
+    assert set(entries.added_entries) == {"/etc/new.conf"}
+    assert set(entries.removed_entries) == {"/etc/old.conf"}
+    assert set(entries.changed_entries) == {"/etc/motd", "/etc/shadow",
+                                            "/usr/bin/tool", "/var/log"}
+    assert entries.changed_entries["/etc/motd"].was_file_content_changed()
+    assert entries.changed_entries["/var/log"].entry_type == EntryType.CHANGED
+
+
+def test_compare_with_shared_reference_rows():
+    comparator = AIDEDatabasesComparator(CLIENT_DB_PATH, SERVER_DB_PATH)
+    reference_rows = comparator.load_reference_rows()
+    shared = AIDEDatabasesComparator(CLIENT_DB_PATH, SERVER_DB_PATH,
+                                     reference_rows)
+
+    entries = shared.compare()
+
+    assert set(entries.changed_entries) ==\
+        set(comparator.compare().changed_entries)
+
+
+def test_compare_same_databases():
+    entries = AIDEDatabasesComparator(SERVER_DB_PATH, SERVER_DB_PATH).compare()
+
+    assert not entries.added_entries
+    assert not entries.removed_entries
+    assert not entries.changed_entries
+
+
+def test_compare_malformed_database(tmp_path):
+    with open(CLIENT_DB_PATH) as db_f:
+        lines = db_f.readlines()
+
+    lines[4] = "/etc 0 3211263\n"  # missing columns
+    malformed_db_path = tmp_path / "aide.db.2"
+    malformed_db_path.write_text("".join(lines))
+
+    with pytest.raises(AIDEDatabasesComparatorError):
+        AIDEDatabasesComparator(str(malformed_db_path),
+                                SERVER_DB_PATH).compare()
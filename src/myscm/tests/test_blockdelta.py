@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import random
+
+import pytest
+
+from myscm.common.blockdelta import apply_delta, BlockDeltaError
+from myscm.common.blockdelta import get_block_size, write_delta
+
+
+def _get_random_bytes(n, seed=0):
+    return random.Random(seed).randbytes(n)
+
+
+def _round_trip(tmp_path, old_data, new_data, max_size=None):
+    old_path = tmp_path / "old"
+    new_path = tmp_path / "new"
+    old_path.write_bytes(old_data)
+    new_path.write_bytes(new_data)
+    delta_f = io.BytesIO()
+
+    size = write_delta(str(old_path), str(new_path), delta_f, max_size)
+
+    if size is None:
+        return None, None
+
+    assert size == len(delta_f.getvalue())
+    delta_f.seek(0)
+    new_f = io.BytesIO()
+    apply_delta(str(old_path), delta_f, new_f)
+
+    return new_f.getvalue(), size
+
+
+BLOCK = get_block_size(0)
+DATA = _get_random_bytes(64 * BLOCK)
+
+ROUND_TRIP_CASES = {
+    "both empty": (b"", b""),
+    "old empty": (b"", b"new content"),
+    "new empty": (DATA, b""),
+    "shorter than block": (b"old content", b"new content"),
+    "shorter than block to bigger": (b"old content", DATA),
+    "bigger to shorter than block": (DATA, DATA[:BLOCK // 2]),
+    "same": (DATA, DATA),
+    "changed in the middle": (DATA, DATA[:10 * BLOCK] + b"changed" +
+                              DATA[10 * BLOCK + 7:]),
+    "inserted": (DATA, DATA[:BLOCK + 3] + b"inserted" + DATA[BLOCK + 3:]),
+    "removed": (DATA, DATA[:5 * BLOCK] + DATA[7 * BLOCK + 1:]),
+    "appended partial block": (DATA, DATA + b"tail"),
+}
+
+
+@pytest.mark.parametrize("old_data, new_data", ROUND_TRIP_CASES.values(),
+                         ids=ROUND_TRIP_CASES.keys())
+def test_round_trip(tmp_path, old_data, new_data):
+    data, _ = _round_trip(tmp_path, old_data, new_data)
+
+    assert data == new_data
+
+
+def test_delta_of_similar_files_is_small(tmp_path):
+    new_data = DATA[:10 * BLOCK] + b"changed" + DATA[10 * BLOCK + 7:]
+    _, size = _round_trip(tmp_path, DATA, new_data)
+
+    assert size < 3 * BLOCK
+
+
+def test_delta_bigger_than_max_size(tmp_path):
+    data, _ = _round_trip(tmp_path, b"", DATA, max_size=BLOCK)
+
+    assert data is None
+
+
+def test_apply_delta_to_wrong_old_file(tmp_path):
+    old_path = tmp_path / "old"
+    new_path = tmp_path / "new"
+    old_path.write_bytes(DATA)
+    new_path.write_bytes(DATA + b"tail")
+    delta_f = io.BytesIO()
+    write_delta(str(old_path), str(new_path), delta_f)
+    old_path.write_bytes(os.urandom(len(DATA)))
+    delta_f.seek(0)
+
+    with pytest.raises(BlockDeltaError):
+        apply_delta(str(old_path), delta_f, io.BytesIO())
+
+
+def test_apply_truncated_delta(tmp_path):
+    old_path = tmp_path / "old"
+    new_path = tmp_path / "new"
+    old_path.write_bytes(DATA)
+    new_path.write_bytes(b"new content")
+    delta_f = io.BytesIO()
+    write_delta(str(old_path), str(new_path), delta_f)
+
+    with pytest.raises(BlockDeltaError):
+        apply_delta(str(old_path), io.BytesIO(delta_f.getvalue()[:-10]),
+                    io.BytesIO())
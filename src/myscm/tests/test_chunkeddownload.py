@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import threading
+
+import pytest
+
+from myscm.client.chunkeddownload import ChunkedDownload, ChunkedDownloadError
+from myscm.client.chunkeddownload import ChunkScheduler
+
+CHUNK_SIZE = 1024
+DATA = os.urandom(5 * CHUNK_SIZE + 100)  # last chunk is shorter
+
+
+def _get_chunk_data(chunk):
+    _, offset, length = chunk
+    return DATA[offset:offset + length]
+
+
+def _get_digests():
+    return [hashlib.sha256(DATA[i:i + CHUNK_SIZE]).hexdigest()
+            for i in range(0, len(DATA), CHUNK_SIZE)]
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "img.tar.gz")
+
+
+def test_download_chunks_in_any_order(path):
+    with ChunkedDownload(path, len(DATA), "v1", CHUNK_SIZE) as download:
+        chunks = download.get_missing_chunks()
+        assert len(chunks) == 6
+        assert chunks[-1] == (5, 5 * CHUNK_SIZE, 100)
+
+        for chunk in reversed(chunks):
+            download.write_chunk(chunk[0], _get_chunk_data(chunk))
+
+        download.finish()
+
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+
+    assert not os.path.exists(download.part_path)
+    assert not os.path.exists(download.state_path)
+
+
+def test_resume_after_failed_chunk(path):
+    with ChunkedDownload(path, len(DATA), "v1", CHUNK_SIZE,
+                         _get_digests()) as download:
+        chunks = download.get_missing_chunks()
+        download.write_chunk(0, _get_chunk_data(chunks[0]))
+        download.write_chunk(2, _get_chunk_data(chunks[2]))
+
+        with pytest.raises(ChunkedDownloadError):  # corrupted chunk
+            download.write_chunk(1, b"x" * CHUNK_SIZE)
+
+        with pytest.raises(ChunkedDownloadError):  # truncated chunk
+            download.write_chunk(3, b"x")
+
+        with pytest.raises(ChunkedDownloadError):
+            download.finish()
+
+    with ChunkedDownload(path, len(DATA), "v1", CHUNK_SIZE,
+                         _get_digests()) as download:
+        assert [c[0] for c in download.get_missing_chunks()] == [1, 3, 4, 5]
+
+        for chunk in download.get_missing_chunks():
+            download.write_chunk(chunk[0], _get_chunk_data(chunk))
+
+        download.finish()
+
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+
+
+def test_restart_when_remote_file_changed(path):
+    with ChunkedDownload(path, len(DATA), "v1", CHUNK_SIZE) as download:
+        download.write_chunk(0, DATA[:CHUNK_SIZE])
+
+    with ChunkedDownload(path, len(DATA), "v2", CHUNK_SIZE) as download:
+        assert len(download.get_missing_chunks()) == 6
+
+
+def test_corrupted_part_file_chunk_is_downloaded_again(path):
+    with ChunkedDownload(path, len(DATA), "v1", CHUNK_SIZE) as download:
+        for chunk in download.get_missing_chunks():
+            download.write_chunk(chunk[0], _get_chunk_data(chunk))
+
+        os.pwrite(download.part_fd, b"corrupted", 2 * CHUNK_SIZE)
+
+        with pytest.raises(ChunkedDownloadError):
+            download.finish()
+
+        assert [c[0] for c in download.get_missing_chunks()] == [2]
+
+
+def test_scheduler_gives_each_chunk_once():
+    chunks = [(i, i * CHUNK_SIZE, CHUNK_SIZE) for i in range(4)]
+    scheduler = ChunkScheduler(chunks)
+
+    taken = [scheduler.get_chunk("a"), scheduler.get_chunk("b"),
+             scheduler.get_chunk("a"), scheduler.get_chunk("b")]
+
+    assert taken == chunks
+
+    for chunk in taken:
+        scheduler.complete(chunk, "a" if chunk[0] % 2 == 0 else "b")
+
+    assert scheduler.get_chunk("a") is None
+    assert scheduler.downloaded == {"a": 2 * CHUNK_SIZE, "b": 2 * CHUNK_SIZE}
+
+
+def test_scheduler_duplicates_chunk_of_slower_source():
+    chunk = (0, 0, CHUNK_SIZE)
+    scheduler = ChunkScheduler([chunk])
+
+    assert scheduler.get_chunk("slow") == chunk
+    assert scheduler.get_chunk("fast") == chunk  # downloaded again
+
+    scheduler.complete(chunk, "fast")
+    scheduler.complete(chunk, "slow")
+
+    assert scheduler.get_chunk("slow") is None
+    assert scheduler.downloaded == {"fast": CHUNK_SIZE}
+
+
+def test_scheduler_gives_back_failed_chunk():
+    chunks = [(0, 0, CHUNK_SIZE), (1, CHUNK_SIZE, CHUNK_SIZE)]
+    scheduler = ChunkScheduler(chunks)
+
+    failed = scheduler.get_chunk("a")
+    scheduler.release(failed, "a")
+
+    assert scheduler.get_chunk("b") == failed
+
+
+def test_scheduler_waits_for_chunk_of_the_same_source():
+    chunk = (0, 0, CHUNK_SIZE)
+    scheduler = ChunkScheduler([chunk])
+    taken = []
+
+    assert scheduler.get_chunk("a") == chunk
+    worker = threading.Thread(target=lambda: taken.append(
+                                  scheduler.get_chunk("a")))
+    worker.start()
+    scheduler.release(chunk, "a")  # e.g. first worker's connection failed
+    worker.join(5)
+
+    assert taken == [chunk]
+
+
+def test_scheduler_abort():
+    scheduler = ChunkScheduler([(0, 0, CHUNK_SIZE)])
+    scheduler.abort()
+
+    assert scheduler.get_chunk("a") is None
+
+
+def test_scheduler_abort_event():
+    abort_event = threading.Event()
+    chunks = [(0, 0, CHUNK_SIZE), (1, CHUNK_SIZE, CHUNK_SIZE)]
+    scheduler = ChunkScheduler(chunks, abort_event)
+
+    assert scheduler.get_chunk("a") == chunks[0]
+
+    abort_event.set()
+
+    assert scheduler.get_chunk("a") is None
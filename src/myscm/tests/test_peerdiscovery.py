@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import socket
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+
+import pytest
+
+from myscm.client.peerdiscovery import PeerDiscovery
+
+
+class FakeDownloader:
+    def __init__(self, imgs):
+        self.imgs = imgs  # peer's name: probe() result or delay in seconds
+
+    def probe(self, host_details, sample_size):
+        result = self.imgs[host_details["name"]]
+
+        if isinstance(result, float):
+            time.sleep(result)
+
+        return result
+
+
+@pytest.fixture
+def ssh_port():
+    """Port of the server sending SSH banner to every connection."""
+
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+
+    def serve():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:  # closed
+                return
+
+            with conn:
+                conn.sendall(b"SSH-2.0-fake\r\n")
+
+    threading.Thread(target=serve, daemon=True).start()
+    yield server.getsockname()[1]
+    server.close()
+
+
+def _get_hosts_details(names, port):
+    return [{"name": n, "host": "127.0.0.1", "port": port} for n in names]
+
+
+def test_peers_ordered_by_version_and_download_time(ssh_port):
+    mib = 1024 * 1024
+    downloader = FakeDownloader({
+        "a": ("myscm-img.0.2.tar.gz", 2, 10 * mib, 1 * mib),
+        "b": ("myscm-img.0.2.tar.gz", 2, 10 * mib, 100 * mib),
+        "c": ("myscm-img.0.3.tar.gz", 3, 10 * mib, 1 * mib),
+        "d": ("myscm-img.0.3.tar.gz", 3, 0, 0)  # empty image
+    })
+    hosts_details = _get_hosts_details(downloader.imgs, ssh_port)
+
+    peers = PeerDiscovery(downloader, 5).discover(hosts_details)
+
+    assert [p.host_details["name"] for p in peers] == ["c", "b", "a"]
+
+
+def test_slow_peers_are_skipped(ssh_port):
+    downloader = FakeDownloader({
+        "a": ("myscm-img.0.2.tar.gz", 2, 1024, 1024),
+        "b": 60.0
+    })
+    hosts_details = _get_hosts_details(downloader.imgs, ssh_port)
+
+    peers = PeerDiscovery(downloader, 0.5).discover(hosts_details)
+
+    assert [p.host_details["name"] for p in peers] == ["a"]
+
+
+def test_slow_peers_dont_delay_exit(ssh_port):
+    code = textwrap.dedent("""
+        import sys, time
+        sys.path[:0] = {path!r}
+        from myscm.client.peerdiscovery import PeerDiscovery
+
+        class Downloader:
+            def probe(self, host_details, sample_size):
+                time.sleep(60)
+
+        PeerDiscovery(Downloader(), 0.5).discover(
+            [{{"host": "127.0.0.1", "port": {port}}}])
+    """).format(path=sys.path, port=ssh_port)
+    start = time.monotonic()
+
+    subprocess.run([sys.executable, "-c", code], check=True, timeout=30)
+
+    assert time.monotonic() - start < 10
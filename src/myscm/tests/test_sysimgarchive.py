@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import tarfile
+
+import pytest
+
+from myscm.common import sysimgarchive
+from myscm.common.sysimgarchive import IndexedSysImgWriter, SysImgArchiveError
+from myscm.common.sysimgarchive import open_sys_img
+
+BLOCK_SIZE = 64 * 1024
+
+
+@pytest.fixture
+def img_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(sysimgarchive._BlockCompressingWriter, "BLOCK_SIZE",
+                        BLOCK_SIZE)
+    path = str(tmp_path / "img.tar.gz")
+    files = [("big", os.urandom(3 * BLOCK_SIZE)), ("empty", b""),
+             ("small", b"x" * 10)]
+
+    with IndexedSysImgWriter(path, threads=2) as img_f:
+        for name, data in files:
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.size = len(data)
+            img_f.addfile(tarinfo, io.BytesIO(data))
+
+    return path
+
+
+def _corrupt_first_block(path, member_name):
+    with open_sys_img(path) as img:
+        index_entry = img.index[member_name]
+
+    length, _ = index_entry["blocks"][0]
+
+    with open(path, "r+b") as img_f:  # damage CRC-32 of the gzip member
+        img_f.seek(index_entry["offset"] + length - 8)
+        crc = img_f.read(4)
+        img_f.seek(-4, os.SEEK_CUR)
+        img_f.write(bytes(b ^ 0xff for b in crc))
+
+
+@pytest.mark.parametrize("threads", [1, 4])
+def test_read_image(img_path, threads):
+    with open_sys_img(img_path, threads) as img:
+        assert len(img.extractfile("big").read()) == 3 * BLOCK_SIZE
+        assert img.extractfile("empty").read() == b""
+        assert img.extractfile("small").read() == b"x" * 10
+
+        with img.open_tar() as tar_f:
+            assert [m.name for m in tar_f] == ["big", "empty", "small"]
+
+
+@pytest.mark.parametrize("threads", [1, 4])
+def test_read_corrupted_block(img_path, threads):
+    _corrupt_first_block(img_path, "big")
+
+    with open_sys_img(img_path, threads) as img:
+        with pytest.raises(SysImgArchiveError):
+            with img.open_tar() as tar_f:
+                for member in tar_f:
+                    tar_f.extractfile(member).read()
+
+        with pytest.raises(SysImgArchiveError):
+            img.extractfile("big")
+
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import types
+
+import OpenSSL
+import pytest
+
+from myscm.client.sftpdownloader import SFTPSysImgDownloader
+from myscm.common.signaturemanager import SignatureManager
+from myscm.common.sysimgcatalog import SysImgCatalog
+
+IMG_NAME = "myscm-img.0.3.tar.gz"
+HOST_DETAILS = {"protocol": "SFTP", "host": "peer", "port": 22,
+                "remote_dir": "/var/lib/myscm-srv"}
+
+
+class LocalSFTPConnection:
+    """Subset of the `pysftp.Connection` API serving files of the local
+       directory."""
+
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+
+    def stat(self, name):
+        return os.stat(os.path.join(self.dir_path, name))
+
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.dir_path, name))
+
+    def get(self, name, localpath):
+        shutil.copyfile(os.path.join(self.dir_path, name), localpath)
+
+
+@pytest.fixture
+def keys(tmp_path):
+    priv_key = OpenSSL.crypto.PKey()
+    priv_key.generate_key(OpenSSL.crypto.TYPE_RSA, 2048)
+    pub_key_path = tmp_path / "cert.pub"
+    pub_key_path.write_bytes(OpenSSL.crypto.dump_publickey(
+        OpenSSL.crypto.FILETYPE_PEM, priv_key))
+
+    return priv_key, str(pub_key_path)
+
+
+@pytest.fixture
+def peer_dir(tmp_path):
+    peer_dir = tmp_path / "peer"
+    peer_dir.mkdir()
+    (peer_dir / IMG_NAME).write_bytes(os.urandom(1024))
+    SysImgCatalog.update(str(peer_dir))
+
+    return peer_dir
+
+
+def _sign_catalog(peer_dir, priv_key):
+    catalog_path = peer_dir / SysImgCatalog.CATALOG_FILE_NAME
+    signature = OpenSSL.crypto.sign(priv_key, catalog_path.read_bytes(),
+                                    SignatureManager.SSL_CERT_DIGEST_TYPE)
+    sig_name = SysImgCatalog.CATALOG_FILE_NAME + SignatureManager.SIGNATURE_EXT
+    (peer_dir / sig_name).write_bytes(signature)
+
+
+def _get_catalog(tmp_path, peer_dir, pub_key_path):
+    options = types.SimpleNamespace(
+        sys_img_download_dir=str(tmp_path / "download"),
+        SSL_cert_public_key_path=pub_key_path)
+    downloader = SFTPSysImgDownloader(types.SimpleNamespace(options=options))
+
+    return downloader._sftp_get_catalog(LocalSFTPConnection(str(peer_dir)),
+                                        HOST_DETAILS)
+
+
+def test_signed_catalog(tmp_path, peer_dir, keys):
+    priv_key, pub_key_path = keys
+    _sign_catalog(peer_dir, priv_key)
+
+    catalog = _get_catalog(tmp_path, peer_dir, pub_key_path)
+
+    assert catalog.signed
+    assert catalog.get_img(IMG_NAME)["sha256"] ==\
+        SysImgCatalog.get_sha256(str(peer_dir / IMG_NAME))
+
+
+def test_not_signed_catalog(tmp_path, peer_dir, keys):
+    _, pub_key_path = keys
+
+    catalog = _get_catalog(tmp_path, peer_dir, pub_key_path)
+
+    assert not catalog.signed
+    assert catalog.get_img(IMG_NAME)
+
+
+def test_catalog_with_bad_signature_is_rejected(tmp_path, peer_dir, keys):
+    _, pub_key_path = keys
+    other_key = OpenSSL.crypto.PKey()
+    other_key.generate_key(OpenSSL.crypto.TYPE_RSA, 2048)
+    _sign_catalog(peer_dir, other_key)
+
+    assert _get_catalog(tmp_path, peer_dir, pub_key_path) is None
+
+
+def test_tampered_signed_catalog_is_rejected(tmp_path, peer_dir, keys):
+    priv_key, pub_key_path = keys
+    _sign_catalog(peer_dir, priv_key)
+    catalog_path = peer_dir / SysImgCatalog.CATALOG_FILE_NAME
+    catalog = SysImgCatalog.loads(catalog_path.read_bytes())
+    catalog.images[0]["sha256"] = "0" * 64
+    catalog_path.write_bytes(catalog.dumps())
+
+    assert _get_catalog(tmp_path, peer_dir, pub_key_path) is None
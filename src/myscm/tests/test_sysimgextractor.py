@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import types
+
+import pytest
+
+from myscm.client.sysimgextractor import SysImgExtractor, SysImgExtractorError
+from myscm.common.blockdelta import write_delta
+
+
+@pytest.fixture
+def extractor():
+    options = types.SimpleNamespace(dry_run=False, force_apply=False,
+                                    worker_threads=1)
+    client_config = types.SimpleNamespace(options=options, distro_name="")
+
+    return SysImgExtractor(client_config)
+
+
+def _write_delta(tmp_path, old_data, new_data):
+    old_path = tmp_path / "old"
+    new_path = tmp_path / "new"
+    delta_path = tmp_path / "file.delta"
+    old_path.write_bytes(old_data)
+    new_path.write_bytes(new_data)
+
+    with open(str(delta_path), "wb") as delta_f:
+        write_delta(str(old_path), str(new_path), delta_f)
+
+    return str(delta_path)
+
+
+def test_apply_block_delta_for_file(tmp_path, extractor):
+    old_data = os.urandom(64 * 1024)
+    new_data = old_data[:1000] + b"changed" + old_data[1000:]
+    delta_path = _write_delta(tmp_path, old_data, new_data)
+    path = tmp_path / "etc" / "file"
+    path.parent.mkdir()
+    path.write_bytes(old_data)
+    path.chmod(0o640)
+
+    extractor._apply_block_delta_for_file(str(path), delta_path)
+
+    assert path.read_bytes() == new_data
+    assert path.stat().st_mode & 0o777 == 0o640
+    assert os.listdir(str(path.parent)) == ["file"]
+
+
+def test_apply_block_delta_for_wrong_file(tmp_path, extractor):
+    old_data = os.urandom(64 * 1024)
+    delta_path = _write_delta(tmp_path, old_data, old_data + b"tail")
+    path = tmp_path / "etc" / "file"
+    path.parent.mkdir()
+    wrong_data = os.urandom(64 * 1024)
+    path.write_bytes(wrong_data)
+
+    with pytest.raises(SysImgExtractorError):
+        extractor._apply_block_delta_for_file(str(path), delta_path)
+
+    assert path.read_bytes() == wrong_data
+    assert os.listdir(str(path.parent)) == ["file"]
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import time
+import types
+
+import pytest
+
+from myscm.client import sysimgextractor
+from myscm.client.sftpdownloader import SFTPSysImgDownloaderError
+from myscm.client.sysimgupdater import SysImgUpdater
+from myscm.client.upgradeplanner import Hop
+
+PEER = {"host": "peer"}
+HOPS = [Hop(0, 1, "myscm-img.0.1.tar.gz", 100, [PEER]),
+        Hop(1, 2, "myscm-img.1.2.tar.gz", 100, [PEER]),
+        Hop(2, 3, "myscm-img.2.3.tar.gz", 100, [PEER])]
+
+
+class FakeDownloader:
+    downloaded = []
+    slow_imgs = set()  # downloaded until download is aborted
+
+    def __init__(self, client_config, abort_event=None):
+        self.abort_event = abort_event
+
+    def download(self, host_details, img_name=None):
+        if img_name in self.slow_imgs:
+            if not self.abort_event.wait(30):
+                pytest.fail("Download of '{}' was not aborted".format(
+                                img_name))
+
+            raise SFTPSysImgDownloaderError("Download aborted")
+
+        self.downloaded.append(img_name)
+
+        return img_name
+
+
+class FakeExtractor:
+    applied = []
+    failing_versions = set()
+
+    def __init__(self, client_config):
+        self.version = client_config.options.apply_img
+        self.sys_img_manager = types.SimpleNamespace(
+            get_sys_img_path=lambda: self.version,
+            assert_sys_img_signature_valid=lambda path: None)
+
+    def apply_sys_img(self):
+        if self.version in self.failing_versions:
+            raise sysimgextractor.SysImgExtractorError("Failed to apply")
+
+        self.applied.append(self.version)
+
+
+@pytest.fixture
+def updater(tmp_path, monkeypatch):
+    monkeypatch.setitem(SysImgUpdater.SUPPORTED_PROTOCOLS_MAPPING, "SFTP",
+                        FakeDownloader)
+    monkeypatch.setattr(sysimgextractor, "SysImgExtractor", FakeExtractor)
+    monkeypatch.setattr(FakeDownloader, "downloaded", [])
+    monkeypatch.setattr(FakeDownloader, "slow_imgs", set())
+    monkeypatch.setattr(FakeExtractor, "applied", [])
+    monkeypatch.setattr(FakeExtractor, "failing_versions", set())
+    monkeypatch.setattr(SysImgUpdater, "_plan_upgrade",
+                        lambda self, current_id, target_id: HOPS)
+    options = types.SimpleNamespace(
+        sys_img_update_protocol="SFTP", sys_img_download_dir=str(tmp_path),
+        swarm_peers=1, dry_run=False, apply_img=None)
+    client_config = types.SimpleNamespace(
+        options=options,
+        img_ver_file=types.SimpleNamespace(get_version=lambda create: 0))
+
+    return SysImgUpdater(client_config)
+
+
+def test_upgrade_applies_chain(updater):
+    updater.upgrade()
+
+    assert FakeDownloader.downloaded == [h.img_name for h in HOPS]
+    assert FakeExtractor.applied == [1, 2, 3]
+
+
+def test_failed_hop_aborts_prefetch(updater):
+    FakeDownloader.slow_imgs.add(HOPS[1].img_name)
+    FakeExtractor.failing_versions.add(1)
+    start = time.monotonic()
+
+    with pytest.raises(sysimgextractor.SysImgExtractorError):
+        updater.upgrade()
+
+    assert time.monotonic() - start < 10
+    assert FakeDownloader.downloaded == [HOPS[0].img_name]
+    assert not FakeExtractor.applied
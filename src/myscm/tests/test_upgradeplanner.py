@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from myscm.client.upgradeplanner import UpgradePlanner, UpgradePlannerError
+
+PEER_A = {"host": "a"}
+PEER_B = {"host": "b"}
+
+
+def _get_path(hops):
+    return [(h.from_id, h.to_id) for h in hops]
+
+
+def test_direct_img():
+    planner = UpgradePlanner()
+    planner.add_img("myscm-img.0.3.tar.gz", 100, PEER_A)
+
+    hops = planner.plan(0)
+
+    assert _get_path(hops) == [(0, 3)]
+    assert hops[0].hosts_details == [PEER_A]
+
+
+def test_chain_when_no_direct_img():
+    planner = UpgradePlanner()
+    planner.add_img("myscm-img.0.1.tar.gz", 100, PEER_A)
+    planner.add_img("myscm-img.1.2.tar.gz", 100, PEER_B)
+    planner.add_img("myscm-img.2.3.tar.gz", 100, PEER_A)
+
+    assert _get_path(planner.plan(0)) == [(0, 1), (1, 2), (2, 3)]
+    assert _get_path(planner.plan(1, 2)) == [(1, 2)]
+
+
+def test_cheapest_chain_is_selected():
+    planner = UpgradePlanner()
+    planner.add_img("myscm-img.0.3.tar.gz", 1000, PEER_A)
+    planner.add_img("myscm-img.0.1.tar.gz", 100, PEER_A)
+    planner.add_img("myscm-img.1.3.tar.gz", 100, PEER_B)
+
+    assert _get_path(planner.plan(0)) == [(0, 1), (1, 3)]
+
+
+def test_direct_img_preferred_when_cost_is_equal():
+    planner = UpgradePlanner()
+    planner.add_img("myscm-img.0.3.tar.gz", 200, PEER_A)
+    planner.add_img("myscm-img.0.1.tar.gz", 100, PEER_A)
+    planner.add_img("myscm-img.1.3.tar.gz", 100, PEER_B)
+
+    assert _get_path(planner.plan(0)) == [(0, 3)]
+
+
+def test_downloaded_imgs_cost_nothing():
+    planner = UpgradePlanner()
+    planner.add_img("myscm-img.0.3.tar.gz", 100, PEER_A)
+    planner.add_img("myscm-img.0.1.tar.gz", 100, PEER_A)
+    planner.add_img("myscm-img.1.3.tar.gz", 100, PEER_B)
+    planner.add_img("myscm-img.0.1.tar.gz", 0)
+    planner.add_img("myscm-img.1.3.tar.gz", 0)
+
+    hops = planner.plan(0)
+
+    assert _get_path(hops) == [(0, 1), (1, 3)]
+    assert all(h.is_local() for h in hops)
+
+
+def test_img_published_by_many_peers():
+    planner = UpgradePlanner()
+    planner.add_img("myscm-img.0.1.tar.gz", 100, PEER_A)
+    planner.add_img("myscm-img.0.1.tar.gz", 100, PEER_B)
+
+    assert planner.plan(0)[0].hosts_details == [PEER_A, PEER_B]
+
+
+def test_nothing_newer():
+    planner = UpgradePlanner()
+    planner.add_img("myscm-img.0.1.tar.gz", 100, PEER_A)
+    planner.add_img("myscm-img.3.2.tar.gz", 100, PEER_A)  # ignored
+    planner.add_img("not-myscm-img.1.5.tar.gz", 100, PEER_A)  # ignored
+
+    assert planner.plan(1) == []
+    assert UpgradePlanner().plan(0) == []
+
+
+def test_no_path_to_target():
+    planner = UpgradePlanner()
+    planner.add_img("myscm-img.0.1.tar.gz", 100, PEER_A)
+    planner.add_img("myscm-img.2.3.tar.gz", 100, PEER_A)
+
+    assert _get_path(planner.plan(0)) == [(0, 1)]
+
+    with pytest.raises(UpgradePlannerError):
+        planner.plan(0, 3)
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""Generators of the AIDE databases (aide.db[.X]) and AIDE --check outputs.
+   Databases are either synthetic (any number of entries describing
+   non-existing files, which is enough to benchmark parsers) or describe real
+   file tree (see `treegenerator`), so system images can be generated from
+   them and applied."""
+
+import base64
+import datetime
+import hashlib
+import os
+import random
+import stat
+import urllib.parse
+
+from myscm.server.aidecheckparser import AIDECheckParser
+from myscm.server.aidedbcomparator import AIDEDatabasesComparator
+from myscm.server.aidedbparser import AIDEDatabaseFileParser
+
+AIDE_DB_COLUMNS = ["name", "lname", "attr", "perm", "inode", "bcount", "uid",
+                   "gid", "size", "mtime", "ctime", "lcount", "md5", "sha1"]
+AIDE_DB_HEADER = "{}# This file was generated by Aide, version 0.16\n"\
+                 "# Time of generation was {}\n{} {}\n"
+AIDE_ATTR = "3211263"  # bitmask of the checked attributes (not interpreted)
+AIDE_ADDED_INFO_STR = "f++++++++++++++++"
+AIDE_REMOVED_INFO_STR = "f----------------"
+
+# Info string (YlZbpugamcinCAXSE pattern) of the synthetic changed files,
+# which have grown and have different mtime, ctime and checksums. Link name is
+# not checked for regular files and atime, ACLs, xattrs, SELinux and ext2
+# attributes are not tracked at all (see `AIDEDatabasesComparator`).
+
+AIDE_CHANGED_INFO_STR = "f >.... mc..C    "
+
+SYNTHETIC_ROOT_DIR = "/srv/myscm-benchmark"
+SYNTHETIC_FILES_PER_DIR = 1000
+SYNTHETIC_MTIME = 1500000000
+
+
+def write_aide_db(aide_db_path, rows):
+    """Write AIDE database with given rows (strings without trailing new line
+       character). Return number of written rows."""
+
+    n = 0
+    generation_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    with open(aide_db_path, "w") as db_f:
+        db_f.write(AIDE_DB_HEADER.format(
+            AIDEDatabaseFileParser.AIDE_DB_FILE_OPENING, generation_time,
+            AIDEDatabaseFileParser.AIDE_DB_PROPERTIES_OPENING,
+            " ".join(AIDE_DB_COLUMNS)))
+
+        for row in rows:
+            db_f.write(row + "\n")
+            n += 1
+
+        db_f.write(AIDEDatabaseFileParser.AIDE_DB_FILE_CLOSING)
+
+    return n
+
+
+def get_aide_db_row(path, lname="0", perm=0o100644, inode=1, bcount=8, uid=0,
+                    gid=0, size=0, mtime=SYNTHETIC_MTIME, ctime=None,
+                    lcount=1, md5=None, sha1=None):
+    """Return AIDE database row. Checksums are given as bytes (or None for
+       files other than regular files)."""
+
+    return " ".join([
+        _encode_path(path),
+        _encode_path(lname) if lname != "0" else lname,
+        AIDE_ATTR,
+        "{:o}".format(perm),
+        str(inode),
+        str(bcount),
+        str(uid),
+        str(gid),
+        str(size),
+        _encode_int(mtime),
+        _encode_int(mtime if ctime is None else ctime),
+        str(lcount),
+        base64.b64encode(md5).decode() if md5 is not None else "0",
+        base64.b64encode(sha1).decode() if sha1 is not None else "0"
+    ])
+
+
+def _encode_path(path):
+    return urllib.parse.quote(path, safe="/")
+
+
+def _encode_int(n):
+    return base64.b64encode(str(int(n)).encode()).decode()
+
+
+###########################
+# Synthetic AIDE database #
+###########################
+
+def generate_synthetic_aide_dbs(client_db_path, server_db_path,
+                                aide_check_path, entries, changed=0.01,
+                                added=0.005, removed=0.005, seed=0):
+    """Generate client's database with given number of entries, server's
+       (reference) database where given fractions of the client's files were
+       changed, added and removed and AIDE --check output comparing both
+       databases. Return lists of the added, removed and changed paths."""
+
+    rng = random.Random(seed)
+    added_paths, removed_paths, changed_paths = [], [], []
+
+    # Rows are written to the temporary files first, since database's header
+    # and closing are written by `write_aide_db()`.
+
+    with open(client_db_path + ".rows", "w") as cli_rows_f,\
+            open(server_db_path + ".rows", "w") as srv_rows_f:
+        for i in range(entries):
+            path, row = _get_synthetic_row(i, rng)
+            cli_rows_f.write(row + "\n")
+            r = rng.random() if i % SYNTHETIC_FILES_PER_DIR else 1.0
+
+            if r < removed:
+                removed_paths.append(path)
+                continue
+
+            if r < removed + changed:
+                changed_paths.append(path)
+                row = _get_synthetic_changed_row(path, row, rng)
+
+            srv_rows_f.write(row + "\n")
+
+            if rng.random() < added:
+                path, row = _get_synthetic_row(i, rng, "new")
+                added_paths.append(path)
+                srv_rows_f.write(row + "\n")
+
+    for rows_path, db_path in [(client_db_path + ".rows", client_db_path),
+                               (server_db_path + ".rows", server_db_path)]:
+        with open(rows_path) as rows_f:
+            write_aide_db(db_path, (r.rstrip("\n") for r in rows_f))
+        os.remove(rows_path)
+
+    with open(aide_check_path, "w") as check_f:
+        write_aide_check_output(
+            check_f,
+            [(AIDE_ADDED_INFO_STR, p) for p in added_paths],
+            [(AIDE_REMOVED_INFO_STR, p) for p in removed_paths],
+            [(AIDE_CHANGED_INFO_STR, p) for p in changed_paths])
+
+    return added_paths, removed_paths, changed_paths
+
+
+def _get_synthetic_row(i, rng, prefix="file"):
+    """Return (path, row) tuple of the i-th synthetic file. First entry of
+       every directory describes directory itself (which is never changed
+       nor removed)."""
+
+    dir_path = os.path.join(SYNTHETIC_ROOT_DIR, "dir{:05d}".format(
+                            i // SYNTHETIC_FILES_PER_DIR))
+
+    if prefix == "file" and i % SYNTHETIC_FILES_PER_DIR == 0:
+        return dir_path, get_aide_db_row(dir_path, perm=0o40755, inode=i + 1,
+                                         size=4096, lcount=2)
+
+    path = os.path.join(dir_path, "{}{:07d}".format(prefix, i))
+    size = rng.randrange(1, 64 * 1024)
+    content = "{} {}".format(path, size).encode()
+
+    return path, get_aide_db_row(path, inode=i + 1, bcount=-(-size // 512),
+                                 size=size, md5=hashlib.md5(content).digest(),
+                                 sha1=hashlib.sha1(content).digest())
+
+
+def _get_synthetic_changed_row(path, row, rng):
+    """Return row of the grown file with new content."""
+
+    values = row.split()
+    size = int(values[8]) + rng.randrange(1, 4096)
+    content = "{} {}".format(path, size).encode()
+
+    return get_aide_db_row(path, inode=int(values[4]), bcount=int(values[5]),
+                           size=size, mtime=SYNTHETIC_MTIME + 1,
+                           md5=hashlib.md5(content).digest(),
+                           sha1=hashlib.sha1(content).digest())
+
+
+#############################
+# AIDE database of the tree #
+#############################
+
+def iterate_tree_rows(root_dir):
+    """Generator yielding AIDE database rows of all of the files of the given
+       tree (including its root), the way AIDE --init creates them."""
+
+    yield _get_file_row(root_dir)
+
+    for dir_path, dirs, files in os.walk(root_dir):
+        dirs.sort()
+
+        for fname in sorted(dirs + files):
+            yield _get_file_row(os.path.join(dir_path, fname))
+
+
+def _get_file_row(path):
+    st = os.lstat(path)
+    lname, md5, sha1 = "0", None, None
+
+    if stat.S_ISLNK(st.st_mode):
+        lname = os.readlink(path)
+    elif stat.S_ISREG(st.st_mode):
+        md5, sha1 = hashlib.md5(), hashlib.sha1()
+
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                md5.update(chunk)
+                sha1.update(chunk)
+
+        md5, sha1 = md5.digest(), sha1.digest()
+
+    return get_aide_db_row(path, lname, st.st_mode, st.st_ino, st.st_blocks,
+                           st.st_uid, st.st_gid, st.st_size, st.st_mtime,
+                           st.st_ctime, st.st_nlink, md5, sha1)
+
+
+#######################
+# AIDE --check output #
+#######################
+
+def write_aide_check_output_for_dbs(client_db_path, server_db_path,
+                                    aide_check_path):
+    """Write AIDE --check output comparing given databases (as AIDE would
+       print it comparing client's database with the current state of the
+       server). Return (added, removed, changed) counts."""
+
+    comparator = AIDEDatabasesComparator(client_db_path, server_db_path)
+    entries = comparator.compare()
+    entries_lists = [
+        [(e.aide_info_str, p) for p, e in d.items()]
+        for d in [entries.added_entries, entries.removed_entries,
+                  entries.changed_entries]]
+
+    with open(aide_check_path, "w") as check_f:
+        write_aide_check_output(check_f, *entries_lists)
+
+    return tuple(len(e) for e in entries_lists)
+
+
+def write_aide_check_output(check_f, added, removed, changed):
+    """Write AIDE --check output (with 'summarize_changes' option set) listing
+       given (AIDE info string, path) tuples of the added, removed and changed
+       files. Empty sections are skipped, as AIDE does."""
+
+    separator = AIDECheckParser.AIDE_SEPARATOR
+    n = len(added) + len(removed) + len(changed)
+
+    check_f.write("AIDE 0.16 found differences between database and "
+                  "filesystem!!\n\nSummary:\n")
+    check_f.write("  Total number of entries:\t{}\n".format(n))
+    check_f.write("  Added entries:\t\t{}\n".format(len(added)))
+    check_f.write("  Removed entries:\t{}\n".format(len(removed)))
+    check_f.write("  Changed entries:\t{}\n".format(len(changed)))
+
+    for title, entries in [(AIDECheckParser.ADDED_ENTRIES, added),
+                           (AIDECheckParser.REMOVED_ENTRIES, removed),
+                           (AIDECheckParser.CHANGED_ENTRIES, changed)]:
+        if not entries:
+            continue
+
+        check_f.write("\n" + separator + title + separator + "\n")
+
+        for info_str, path in sorted(entries, key=lambda e: e[1]):
+            check_f.write("{}: {}\n".format(info_str, path))
+
+    check_f.write("\n" + separator + AIDECheckParser.DETAILED_INFO +
+                  separator + "\n")
@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""mySCM benchmark suite timing hot paths of the myscm-srv and myscm-cli
+   applications and printing results as JSON, so they can be compared across
+   releases.
+
+   Parsers (AIDE databases and AIDE --check output) are benchmarked on the
+   synthetic AIDE databases with given numbers of entries. Generating,
+   validating and applying system images is benchmarked on the copies of the
+   sample file tree (see dirtree-generator.sh) created in the scratch
+   directory - client's state is the sample tree and server's state is the
+   modified one. Nothing outside of the scratch directory is modified, but
+   package ownership index (see `PackageOwnershipIndex`) is built from the
+   local package manager's database before timing anything.
+
+   mySCM packages (myscm-common, myscm-srv and myscm-cli) have to be
+   importable, e.g.:
+
+     PYTHONPATH=src/myscm/myscm-common:src/myscm/myscm-srv:src/myscm/myscm-cli \\
+     src/scripts/benchmark/benchmark.py -e 10000 100000 -o results.json"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import types
+
+import aidegenerator
+import treegenerator
+
+from myscm.client.myscmimgverfile import MySCMImgVersionFile
+from myscm.client.parser import ApplyModeConfigOption
+from myscm.client.sysimgextractor import SysImgExtractor
+from myscm.client.sysimgvalidator import SysImgValidator
+from myscm.common.config import BaseConfig, ConfigOptions
+from myscm.common.constants import __version__
+from myscm.common.sysimgarchive import open_sys_img
+from myscm.common.sysimgarchive import SYS_IMG_CODECS, DEFAULT_SYS_IMG_CODEC
+from myscm.server.aidecheckparser import AIDECheckParser
+from myscm.server.aidedbindex import AIDEDatabaseIndex
+from myscm.server.aidedbparser import AIDEDatabaseFileParser
+from myscm.server.aidedbverfile import MySCMDatabaseVersionFile
+from myscm.server.parser import PatchSizeLimitConfigOption
+from myscm.server.parser import PatchTimeoutConfigOption
+from myscm.server.scanner import Scanner
+from myscm.server.sysimggenerator import SystemImageGenerator
+import myscm.server.patchmaker
+import myscm.server.pkgmanager as pkgmgr
+
+logger = logging.getLogger(__name__)
+
+RESULTS_FORMAT_VERSION = 1
+PARSER_BENCHMARKS = ["aide-db-parser", "aide-check-parser"]
+SYS_IMG_BENCHMARKS = ["sys-img-generator", "sys-img-validator",
+                      "sys-img-extractor"]
+BENCHMARKS = PARSER_BENCHMARKS + SYS_IMG_BENCHMARKS
+CLIENT_DB_VERSION = 0
+SERVER_DB_VERSION = 1
+
+
+def time_fun(fun, repeats, setup=None):
+    """Return list of the durations [s] of the given function's calls. Setup
+       function (if given) is called before every call and its result is
+       passed to the timed function."""
+
+    durations = []
+
+    for _ in range(repeats):
+        args = [setup()] if setup else []
+        start = time.perf_counter()
+        fun(*args)
+        durations.append(time.perf_counter() - start)
+
+    return durations
+
+
+def get_result(name, params, durations):
+    return {
+        "name": name,
+        "params": params,
+        "seconds": durations,
+        "min": min(durations),
+        "median": statistics.median(durations)
+    }
+
+
+######################
+# Parsers benchmarks #
+######################
+
+def run_parser_benchmarks(args, scratch_dir, entries):
+    """Benchmark parsers on the synthetic AIDE databases with given number of
+       entries. Return list of the results."""
+
+    data_dir = os.path.join(scratch_dir, "synthetic-{}".format(entries))
+    os.makedirs(data_dir)
+    cli_db_path = os.path.join(data_dir, "aide.db.{}".format(
+                               CLIENT_DB_VERSION))
+    srv_db_path = os.path.join(data_dir, "aide.db")
+    aide_check_path = os.path.join(data_dir, "aide.check")
+
+    logger.info("Generating synthetic AIDE databases with {} entries..."
+                .format(entries))
+
+    added, removed, changed = aidegenerator.generate_synthetic_aide_dbs(
+        cli_db_path, srv_db_path, aide_check_path, entries, args.changed,
+        args.added, args.removed, args.seed)
+    params = {"entries": entries, "added": len(added),
+              "removed": len(removed), "changed": len(changed)}
+    requested_paths = set(changed)
+    srv_db_parser = AIDEDatabaseFileParser(srv_db_path)
+    results = []
+
+    def iterate_rows():
+        for _ in srv_db_parser.iterate_rows():
+            pass
+
+    def read_all_entries():
+        with open(aide_check_path) as aide_check_f:
+            AIDECheckParser(cli_db_path, srv_db_path).read_all_entries(
+                                                                aide_check_f)
+
+    def build_indexes():
+        for db_path in [cli_db_path, srv_db_path]:
+            AIDEDatabaseIndex(db_path).build()
+
+    if "aide-db-parser" in args.benchmarks:
+        logger.info("Benchmarking AIDE database parser...")
+        results.append(get_result(
+            "AIDEDatabaseFileParser.iterate_rows", params,
+            time_fun(iterate_rows, args.repeats)))
+        results.append(get_result(
+            "AIDEDatabaseFileParser.get_files_properties", params,
+            time_fun(lambda: srv_db_parser.get_files_properties(
+                                requested_paths), args.repeats)))
+
+        results.append(get_result("AIDEDatabaseIndex.build", params,
+                                  time_fun(build_indexes, args.repeats)))
+        results.append(get_result(
+            "AIDEDatabaseFileParser.get_files_properties[indexed]", params,
+            time_fun(lambda: srv_db_parser.get_files_properties(
+                                requested_paths), args.repeats)))
+
+    if "aide-check-parser" in args.benchmarks:
+        if "aide-db-parser" not in args.benchmarks:
+            build_indexes()
+
+        logger.info("Benchmarking AIDE --check output parser...")
+        results.append(get_result(
+            "AIDECheckParser.read_all_entries[indexed]", params,
+            time_fun(read_all_entries, args.repeats)))
+
+    shutil.rmtree(data_dir)
+
+    return results
+
+
+############################
+# System images benchmarks #
+############################
+
+def run_sys_img_benchmarks(args, scratch_dir):
+    """Benchmark generating, validating and applying system image upgrading
+       the sample file trees. Return list of the results."""
+
+    root_dir = os.path.join(scratch_dir, "root")
+    var_dir = os.path.join(scratch_dir, "var")
+    srv_config = create_server_config(args, scratch_dir)
+    cli_config = create_client_config(args, scratch_dir)
+    cli_db_path = srv_config.aide_old_db_path_pattern.format(
+                            CLIENT_DB_VERSION, CLIENT_DB_VERSION)
+    srv_db_path = srv_config.aide_reference_db_path
+    aide_check_path = os.path.join(var_dir, "aide.check")
+
+    logger.info("Creating {} sample file trees and their AIDE databases..."
+                .format(args.tree_copies))
+
+    n = treegenerator.generate_sample_dirtrees(root_dir, args.tree_copies,
+                                               args.file_size)
+    os.makedirs(os.path.dirname(cli_db_path))
+    aidegenerator.write_aide_db(cli_db_path,
+                                aidegenerator.iterate_tree_rows(root_dir))
+    copy_client_files(root_dir, cli_db_path)
+
+    treegenerator.modify_sample_dirtrees(root_dir, args.tree_copies)
+    os.makedirs(os.path.dirname(srv_db_path))
+    aidegenerator.write_aide_db(srv_db_path,
+                                aidegenerator.iterate_tree_rows(root_dir))
+
+    for db_path in [cli_db_path, srv_db_path]:
+        AIDEDatabaseIndex(db_path).build()
+
+    added, removed, changed = aidegenerator.write_aide_check_output_for_dbs(
+                                cli_db_path, srv_db_path, aide_check_path)
+    params = {"tree_copies": args.tree_copies, "files": n,
+              "file_size": args.file_size, "added": added,
+              "removed": removed, "changed": changed,
+              "threads": args.threads, "apply_mode": args.apply_mode,
+              "compression": args.compression,
+              "blob_cache_size": args.blob_cache_size,
+              "patch_cache_size": args.patch_cache_size}
+    pkgmgr.get_package_index(srv_config)
+    results = []
+    sys_img_path = None
+
+    def create_generator():
+        with open(aide_check_path) as aide_check_f:
+            entries = AIDECheckParser(cli_db_path, srv_db_path)\
+                        .read_all_entries(aide_check_f)
+
+        # Measure reading changed files, which are cached in the process
+        # generating many system images
+
+        myscm.server.patchmaker._read_cached_text_file.cache_clear()
+        generator = SystemImageGenerator(srv_config, CLIENT_DB_VERSION)
+        generator.sign_img = False
+
+        if sys_img_path:
+            os.remove(sys_img_path)
+
+        return generator, entries
+
+    def generate_img(generator_entries):
+        nonlocal sys_img_path
+        generator, entries = generator_entries
+        sys_img_path = generator._generate_img_from_aide_entries(entries)
+
+    def validate_img():
+        with open_sys_img(sys_img_path, args.threads) as sys_img_f:
+            SysImgValidator(cli_config.distro_name, False, args.threads)\
+                .assert_sys_img_valid(sys_img_f)
+
+    def restore_client_state():
+        treegenerator.remove_sample_dirtrees(root_dir)
+        treegenerator.generate_sample_dirtrees(root_dir, args.tree_copies,
+                                               args.file_size)
+        cli_config.img_ver_file.set_value(CLIENT_DB_VERSION)
+
+    def apply_img(_):
+        SysImgExtractor(cli_config).apply_sys_img()
+
+    # Image is generated at least once since it's validated and applied
+
+    generator_repeats = args.repeats\
+        if "sys-img-generator" in args.benchmarks else 1
+    logger.info("Benchmarking system image generator...")
+    durations = time_fun(generate_img, generator_repeats, create_generator)
+    params["sys_img_size"] = os.path.getsize(sys_img_path)
+
+    if "sys-img-generator" in args.benchmarks:
+        results.append(get_result(
+            "SystemImageGenerator._generate_img_from_aide_entries", params,
+            durations))
+
+    restore_client_state()
+
+    if "sys-img-validator" in args.benchmarks:
+        logger.info("Benchmarking system image validator...")
+        results.append(get_result(
+            "SysImgValidator.assert_sys_img_valid", params,
+            time_fun(validate_img, args.repeats)))
+
+    if "sys-img-extractor" in args.benchmarks:
+        logger.info("Benchmarking system image extractor...")
+        results.append(get_result(
+            "SysImgExtractor.apply_sys_img", params,
+            time_fun(apply_img, args.repeats, restore_client_state)))
+
+    return results
+
+
+def create_server_config(args, scratch_dir):
+    """Return minimal server's configuration (see `ServerConfig`) with all
+       of the paths pointing to the scratch directory."""
+
+    var_dir = os.path.join(scratch_dir, "var")
+    db_fname = "aide.db"
+    old_db_fname_pattern = db_fname + ".{}"
+    options = ConfigOptions({
+        "GenImg": CLIENT_DB_VERSION,
+        "SystemImgOutDir": os.path.join(scratch_dir, "img"),
+        "CacheDir": os.path.join(scratch_dir, "cache"),
+        "SSLCertPrivKeyPath": None,
+        "SystemImgCompression": args.compression,
+        "PatchTimeout": PatchTimeoutConfigOption.DEFAULT_PATCH_TIMEOUT,
+        "PatchSizeLimit": PatchSizeLimitConfigOption.DEFAULT_PATCH_SIZE_LIMIT,
+        "BlobCacheSize": args.blob_cache_size,
+        "PatchCacheSize": args.patch_cache_size,
+        "WorkerThreads": args.threads
+    })
+    config = types.SimpleNamespace(
+        options=options,
+        distro_name=args.distro,
+        aide_reference_db_path=os.path.join(var_dir, "aide.db.current",
+                                            db_fname),
+        aide_old_db_dir=var_dir,
+        aide_old_db_fname_pattern=old_db_fname_pattern,
+        aide_old_db_path_pattern=os.path.join(var_dir, old_db_fname_pattern,
+                                              old_db_fname_pattern),
+        db_ver_file=MySCMDatabaseVersionFile(os.path.join(var_dir,
+                                                          "aide.db.ver")))
+
+    for d in [var_dir, options.system_img_out_dir, options.cache_dir]:
+        os.makedirs(d, exist_ok=True)
+
+    config.db_ver_file.set_value(SERVER_DB_VERSION)
+
+    return config
+
+
+def create_client_config(args, scratch_dir):
+    """Return minimal client's configuration (see `ClientConfig`) with all
+       of the paths pointing to the scratch directory."""
+
+    options = ConfigOptions({
+        "ApplyImg": SERVER_DB_VERSION,
+        "ApplyMode": args.apply_mode,
+        "SysImgDownloadDir": os.path.join(scratch_dir, "img"),
+        "SysImgExtractDir": os.path.join(scratch_dir, "extract"),
+        "DryRun": False,
+        "ForceApply": False,
+        "WorkerThreads": args.threads
+    })
+    os.makedirs(options.sys_img_extract_dir, exist_ok=True)
+
+    return types.SimpleNamespace(
+        options=options,
+        distro_name=args.distro,
+        img_ver_file=MySCMImgVersionFile(os.path.join(scratch_dir,
+                                                      "img.ver")))
+
+
+def copy_client_files(root_dir, cli_db_path):
+    """Copy regular files of the client's state next to its AIDE database
+       (as `Scanner` does), so patches are created for the changed files."""
+
+    copied_dir = os.path.join(os.path.dirname(cli_db_path),
+                              Scanner.COPIED_FILES_DIRNAME)
+
+    for dir_path, _, files in os.walk(root_dir):
+        dst_dir = os.path.join(copied_dir, dir_path.lstrip(os.path.sep))
+        os.makedirs(dst_dir, exist_ok=True)
+
+        for fname in files:
+            src = os.path.join(dir_path, fname)
+
+            if os.path.isfile(src) and not os.path.islink(src):
+                shutil.copy2(src, dst_dir)
+
+
+########
+# Main #
+########
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark mySCM hot paths and print results as JSON.")
+    parser.add_argument(
+        "-b", "--benchmarks", nargs="+", choices=BENCHMARKS,
+        default=BENCHMARKS, help="benchmarks to run (all by default)")
+    parser.add_argument(
+        "-e", "--entries", nargs="+", type=int, default=[10000],
+        metavar="N", help="numbers of the entries of the synthetic AIDE "
+        "databases used to benchmark parsers (default: 10000)")
+    parser.add_argument(
+        "--changed", type=float, default=0.01, metavar="FRACTION",
+        help="fraction of the changed files in synthetic AIDE databases")
+    parser.add_argument(
+        "--added", type=float, default=0.005, metavar="FRACTION",
+        help="fraction of the added files in synthetic AIDE databases")
+    parser.add_argument(
+        "--removed", type=float, default=0.005, metavar="FRACTION",
+        help="fraction of the removed files in synthetic AIDE databases")
+    parser.add_argument(
+        "--seed", type=int, default=0,
+        help="seed of the synthetic AIDE databases generator")
+    parser.add_argument(
+        "-c", "--tree-copies", type=int, default=100, metavar="N",
+        help="number of the copies of the sample file tree used to benchmark "
+        "system images (default: 100)")
+    parser.add_argument(
+        "-s", "--file-size", type=int, default=4096, metavar="BYTES",
+        help="minimal size of the regular files of the sample file trees "
+        "(default: 4096)")
+    parser.add_argument(
+        "-r", "--repeats", type=int, default=3, metavar="N",
+        help="number of the timed runs of every benchmark (default: 3)")
+    parser.add_argument(
+        "-t", "--threads", type=int, default=1, metavar="N",
+        help="number of the worker threads (default: 1)")
+    parser.add_argument(
+        "-z", "--compression", choices=SYS_IMG_CODECS,
+        default=DEFAULT_SYS_IMG_CODEC, help="compression of the system "
+        "images (default: {})".format(DEFAULT_SYS_IMG_CODEC))
+    parser.add_argument(
+        "--blob-cache-size", type=int, default=0, metavar="MIB",
+        help="size limit of the server's cache of the compressed files; if "
+        "enabled, then only the first run of the system image generator "
+        "compresses them (default: 0 - disabled)")
+    parser.add_argument(
+        "--patch-cache-size", type=int, default=0, metavar="MIB",
+        help="size limit of the server's cache of the patches; if enabled, "
+        "then only the first run of the system image generator creates them "
+        "(default: 0 - disabled)")
+    parser.add_argument(
+        "-m", "--apply-mode", choices=ApplyModeConfigOption.APPLY_MODES,
+        default=ApplyModeConfigOption.DEFAULT_APPLY_MODE,
+        help="how system image is applied (default: {})".format(
+            ApplyModeConfigOption.DEFAULT_APPLY_MODE))
+    parser.add_argument(
+        "-d", "--distro", choices=sorted(BaseConfig.SUPPORTED_LINUX_DISTROS),
+        default="debian", help="distribution of the package manager "
+        "(default: debian)")
+    parser.add_argument(
+        "--scratch-dir", metavar="DIR",
+        help="directory for the generated data (temporary one by default)")
+    parser.add_argument(
+        "-o", "--output", metavar="PATH",
+        help="path of the JSON results (standard output by default)")
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="print progress")
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose
+                        else logging.WARNING)
+
+    with tempfile.TemporaryDirectory(prefix="myscm-benchmark-",
+                                     dir=args.scratch_dir) as scratch_dir:
+        results = []
+
+        if any(b in args.benchmarks for b in PARSER_BENCHMARKS):
+            for entries in args.entries:
+                results.extend(run_parser_benchmarks(args, scratch_dir,
+                                                     entries))
+
+        if any(b in args.benchmarks for b in SYS_IMG_BENCHMARKS):
+            results.extend(run_sys_img_benchmarks(args, scratch_dir))
+
+    report = {
+        "format_version": RESULTS_FORMAT_VERSION,
+        "myscm_version": __version__,
+        "created": datetime.datetime.utcnow().isoformat() + "Z",
+        "platform": {
+            "system": platform.system(),
+            "machine": platform.machine(),
+            "python_implementation": platform.python_implementation(),
+            "python_version": platform.python_version(),
+            "cpu_count": os.cpu_count()
+        },
+        "results": results
+    }
+
+    if args.output:
+        with open(args.output, "w") as output_f:
+            json.dump(report, output_f, indent=2)
+            output_f.write("\n")
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""Python counterpart of the dirtree-generator.sh script which creates (and
+   modifies with -m flag) sample testing file tree. Here many copies of the
+   sample tree can be created at once and content of the regular files can be
+   inflated to the given size, so the tree is big enough to benchmark
+   generating and applying mySCM system images.
+
+   Changing group of the files (chgrp) is skipped, since groups used by the
+   original script may not exist and only root is allowed to change them.
+   Sample tree contains also binary file (a stand-in for the shared library)
+   whose few bytes are changed, which is not done by the original script."""
+
+import os
+import random
+import shutil
+
+SAMPLE_TREE_DIRNAME = "tree{}"
+SAMPLE_FILES = [
+    ("file0", "0th file"),
+    ("file1", "1st file"),
+    ("dir1/file", None),
+    ("dir1/file2", "2nd file"),
+    ("dir1/file3", "3rd file"),
+    ("dir1/subdir1/file4", "4th file"),
+    ("dir1/subdir1/file5", "5th file"),
+    ("dir1/subdir2/file6", "6th file"),
+    ("dir1/subdir2/file7", "7th file"),
+    ("dir3/file8", "8th file"),
+    ("dir3/file9", "9th file"),
+]
+SAMPLE_DIRS = ["dir0", "dir1", "dir2", "dir3", "dir1/subdir0", "dir1/subdir1",
+               "dir1/subdir2", "dir1/subdir3"]
+SAMPLE_BINARY_FILE = "dir3/libsample.so"
+SAMPLE_BINARY_FILE_MIN_SIZE = 64 * 1024
+
+
+def generate_sample_dirtrees(root_dir, copies, file_size=0):
+    """Create given number of copies of the sample file tree (`tree0`,
+       `tree1`, ...) in the (non-existing) root directory. Regular files
+       (except empty one) have at least `file_size` bytes. Return number of
+       created files (including directories)."""
+
+    os.makedirs(root_dir)
+    n = 1
+
+    for i in range(copies):
+        n += generate_sample_dirtree(
+                os.path.join(root_dir, SAMPLE_TREE_DIRNAME.format(i)),
+                file_size)
+
+    return n
+
+
+def modify_sample_dirtrees(root_dir, copies):
+    """Modify all copies of the sample file tree created by
+       `generate_sample_dirtrees()`."""
+
+    for i in range(copies):
+        modify_sample_dirtree(
+                os.path.join(root_dir, SAMPLE_TREE_DIRNAME.format(i)))
+
+
+def remove_sample_dirtrees(root_dir):
+    if os.path.lexists(root_dir):
+        shutil.rmtree(root_dir)
+
+
+def generate_sample_dirtree(path, file_size=0):
+    """Create single sample file tree (see dirtree-generator.sh). Return
+       number of created files (including directories)."""
+
+    os.makedirs(path)
+
+    for d in SAMPLE_DIRS:
+        os.mkdir(os.path.join(path, d))
+
+    for fname, content in SAMPLE_FILES:
+        _write_file(os.path.join(path, fname), content, file_size)
+
+    _write_binary_file(os.path.join(path, SAMPLE_BINARY_FILE), file_size)
+    os.symlink("file1", os.path.join(path, "file1_symlink"))
+    os.symlink("dir3", os.path.join(path, "dir3_symlink"))
+
+    for fname in ["fifo0", "fifo1"]:
+        os.mkfifo(os.path.join(path, "dir2", fname))
+
+    os.link(os.path.join(path, "dir3/file8"),
+            os.path.join(path, "file8_hardlink"))
+    os.chmod(os.path.join(path, "dir1/file2"), 0o777)
+    os.link(os.path.join(path, "dir1/subdir1/file4"),
+            os.path.join(path, "file4_hardlink"))
+
+    return 1 + len(SAMPLE_DIRS) + len(SAMPLE_FILES) + 7
+
+
+def modify_sample_dirtree(path):
+    """Make the same changes in the sample file tree as dirtree-generator.sh
+       ran with -m flag does."""
+
+    def p(fname):
+        return os.path.join(path, fname)
+
+    os.rename(p("dir2/fifo0"), p("dir0/fifo0"))
+
+    with open(p("file1"), "a") as f:
+        f.write("x\n")
+
+    os.remove(p("file8_hardlink"))
+    os.remove(p("dir1/subdir1/file4"))
+    os.rename(p("dir3/file9"), p("file9"))
+    os.chmod(p("dir1/file2"), 0o770)
+    os.rename(p("file0"), p("file0_renamed"))
+    os.symlink("dir1/subdir2/file6", p("file6_symlink"))
+    os.link(p("dir1/subdir2/file7"), p("file7_hardlink"))
+    os.utime(p("dir1/subdir1/file5"))
+    _modify_binary_file(p(SAMPLE_BINARY_FILE))
+
+
+def _write_file(path, content, file_size):
+    with open(path, "w") as f:
+        if content is None:
+            return
+
+        line = content + "\n"
+        f.write(line * max(1, -(-file_size // len(line))))
+
+
+def _write_binary_file(path, file_size):
+    size = max(file_size, SAMPLE_BINARY_FILE_MIN_SIZE)
+    rng = random.Random(size)  # the same content in every tree
+
+    with open(path, "wb") as f:
+        f.write(rng.getrandbits(8 * size).to_bytes(size, "little"))
+
+
+def _modify_binary_file(path):
+    """Overwrite a few bytes in the middle of the binary file and append a
+       few bytes (as recompiled library would be changed)."""
+
+    size = os.path.getsize(path)
+
+    with open(path, "r+b") as f:
+        f.seek(size // 2)
+        f.write(b"\xff" * 64)
+        f.seek(0, os.SEEK_END)
+        f.write(b"\0" * 16)